@@ -0,0 +1,161 @@
+# alert_payload.py
+import io
+import logging
+import threading
+
+import numpy as np
+from PIL import Image
+
+''' Изображение для оповещения: один JPEG заданного размера и качества для всех каналов '''
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_EDGE = 1600
+DEFAULT_QUALITY = 80
+# Зазор между кадрами коллажа (пиксели) и его цвет
+COLLAGE_GAP = 4
+COLLAGE_BACKGROUND = (255, 255, 255)
+
+
+def merge_captions(captions, limit=4000):
+    """
+    Общая подпись для серии кадров: число кадров и подписи всех кадров.
+
+    Args:
+        captions (list): Подписи кадров.
+        limit (int): Максимальная длина подписи (не уместившееся обрезается).
+    """
+    merged = f"Серия из {len(captions)} кадров\n\n" + "\n\n".join(captions)
+    return merged if len(merged) <= limit else merged[:limit - 1] + '…'
+
+
+def crop_around_boxes(boxes, width, height, margin=0.25, min_fraction=0.4):
+    """
+    Область кадра вокруг всех рамок.
+
+    Args:
+        boxes (numpy.ndarray): Рамки (N, 4) xyxy в пикселях кадра.
+        width (int): Ширина кадра.
+        height (int): Высота кадра.
+        margin (float): Поля вокруг рамок в долях их общего размера.
+        min_fraction (float): Минимальный размер области в долях кадра - чтобы сохранить обстановку вокруг.
+
+    Returns:
+        tuple: (x1, y1, x2, y2) или None, если рамок нет.
+    """
+    if boxes is None or not len(boxes):
+        return None
+    x1, y1 = boxes[:, :2].min(axis=0).tolist()
+    x2, y2 = boxes[:, 2:].max(axis=0).tolist()
+
+    crop_width = min(width, max((x2 - x1) * (1 + 2 * margin), width * min_fraction))
+    crop_height = min(height, max((y2 - y1) * (1 + 2 * margin), height * min_fraction))
+    # Центр области - центр рамок, но область не выходит за кадр
+    left = int(np.clip((x1 + x2 - crop_width) / 2, 0, width - crop_width))
+    top = int(np.clip((y1 + y2 - crop_height) / 2, 0, height - crop_height))
+    return left, top, left + int(crop_width), top + int(crop_height)
+
+
+class AlertPayloadBuilder:
+    """
+    Готовит изображение оповещения один раз для всех каналов.
+
+    Кадр с рамками (при crop - только область вокруг рамок) уменьшается так,
+    чтобы длинная сторона не превышала max_edge, и кодируется в JPEG с
+    качеством quality. Эти байты ставятся в очередь оповещений и без
+    перекодирования уходят и в Telegram, и в TDM.
+    """
+
+    def __init__(self, max_edge=DEFAULT_MAX_EDGE, quality=DEFAULT_QUALITY, crop=False, crop_margin=0.25):
+        """
+        Args:
+            max_edge (int): Максимальная длинная сторона (None - без уменьшения).
+            quality (int): Качество JPEG (1-95).
+            crop (bool): Вырезать область вокруг обнаруженных объектов.
+            crop_margin (float): Поля вокруг объектов в долях их размера (см. crop_around_boxes).
+        """
+        self.max_edge = max_edge
+        self.quality = quality
+        self.crop = crop
+        self.crop_margin = crop_margin
+
+        self.count = 0
+        self.bytes_total = 0
+        self._lock = threading.Lock()
+
+    def encode(self, image, boxes=None):
+        """
+        JPEG из изображения RGB.
+
+        Args:
+            image (numpy.ndarray): Изображение RGB (например, DetectionResult.annotated_image).
+            boxes (numpy.ndarray): Рамки (N, 4) xyxy для crop (None - кадр целиком).
+
+        Returns:
+            bytes: JPEG.
+        """
+        if self.crop:
+            region = crop_around_boxes(boxes, image.shape[1], image.shape[0], self.crop_margin)
+            if region is not None:
+                x1, y1, x2, y2 = region
+                # Срез numpy без копирования - копию делает PIL
+                image = image[y1:y2, x1:x2]
+
+        pil_image = Image.fromarray(np.ascontiguousarray(image))
+        if self.max_edge and max(pil_image.size) > self.max_edge:
+            # thumbnail сохраняет пропорции и сначала грубо уменьшает кадр, потом сглаживает
+            pil_image.thumbnail((self.max_edge, self.max_edge), Image.Resampling.LANCZOS)
+
+        buffer = io.BytesIO()
+        # optimize: оптимальные таблицы Хаффмана - файл меньше при том же качестве
+        pil_image.save(buffer, format='JPEG', quality=self.quality, optimize=True)
+        data = buffer.getvalue()
+
+        with self._lock:
+            self.count += 1
+            self.bytes_total += len(data)
+        return data
+
+    def build(self, detection):
+        """JPEG оповещения для результата детекции (кадр с рамками, см. encode)."""
+        return self.encode(detection.annotated_image, detection.boxes)
+
+    def collage(self, images):
+        """
+        Один JPEG из нескольких: кадры серии сеткой (почти квадратной) с длинной стороной до max_edge.
+
+        Для каналов без альбомов - серия уходит одним изображением.
+
+        Args:
+            images (list): JPEG (bytes) кадров.
+
+        Returns:
+            bytes: JPEG коллажа.
+        """
+        frames = [Image.open(io.BytesIO(image)) for image in images]
+        columns = int(np.ceil(np.sqrt(len(frames))))
+        rows = int(np.ceil(len(frames) / columns))
+        # Ячейка - по пропорциям первого кадра; кадры серии одной ловушки одного размера
+        frame_width, frame_height = frames[0].size
+        edge = self.max_edge or max(frame_width * columns, frame_height * rows)
+        scale = min(1.0, edge / max(frame_width * columns, frame_height * rows))
+        cell_width, cell_height = int(frame_width * scale), int(frame_height * scale)
+
+        canvas = Image.new('RGB', (columns * cell_width + (columns - 1) * COLLAGE_GAP,
+                                   rows * cell_height + (rows - 1) * COLLAGE_GAP), COLLAGE_BACKGROUND)
+        for index, frame in enumerate(frames):
+            # draft: JPEG декодируется сразу уменьшенным, если ячейка много меньше кадра
+            frame.draft('RGB', (cell_width, cell_height))
+            frame = frame.convert('RGB')
+            frame.thumbnail((cell_width, cell_height), Image.Resampling.LANCZOS)
+            row, column = divmod(index, columns)
+            canvas.paste(frame, (column * (cell_width + COLLAGE_GAP), row * (cell_height + COLLAGE_GAP)))
+
+        buffer = io.BytesIO()
+        canvas.save(buffer, format='JPEG', quality=self.quality, optimize=True)
+        return buffer.getvalue()
+
+    @property
+    def average_size(self):
+        """Средний размер изображения в байтах (None - изображений еще не было)."""
+        return self.bytes_total / self.count if self.count else None
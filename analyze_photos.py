@@ -3,18 +3,33 @@
 # Импортируем настройку логирования
 from logging_config import setup_logging
 
-import psycopg2
 import json
 import os
+import time
 from datetime import datetime
 
 import config
 from truck_detector import TruckDetector
-from telegram_bot import TelegramBot  # Импортируем новый класс
+from detection_cache import DetectionCache
+from scene_filter import SceneFilter, frame_hash
+from inference_pool import InferencePool
+from media_index import MediaIndex
+from pipeline import Pipeline
+from db import ResultWriter, claim_batch, count_pending, get_pool
+from migrations import migrate
+from notify_outbox import NotificationOutbox, OutboxSender
+from alert_payload import AlertPayloadBuilder, merge_captions
+from telegram_bot import CAPTION_MAX, MEDIA_GROUP_MAX, TelegramBot  # Импортируем новый класс
 from tdm_bot import initialize_tdm_bot  # Импортируем TDM бот
 
 from config import TDM_DICT
 
+# Области интереса ловушек {imei: (x1, y1, x2, y2) или [(x, y), ...]} в долях кадра - рядом с TDM_DICT в config
+TRAP_ROI = getattr(config, 'TRAP_ROI', {})
+# Размер входа модели: общий и для отдельных ловушек {imei: imgsz} (подбирается tune_imgsz.py)
+DETECT_IMGSZ = getattr(config, 'DETECT_IMGSZ', 640)
+TRAP_IMGSZ = getattr(config, 'TRAP_IMGSZ', {})
+
 # Настраиваем логирование  ОДИН РАЗ в главном скрипте
 setup_logging()
 import logging
@@ -22,219 +37,529 @@ logger = logging.getLogger(__name__)
 
 DB_CONFIG = config.DB_CONFIG
 TELEGRAM_CONFIG = config.TELEGRAM_CONFIG  # Конфиг Telegram
+DETECT_BATCH_SIZE = getattr(config, 'DETECT_BATCH_SIZE', 8)  # Размер пачки для детекции
+CONF_THRESHOLD = 0.6  # Порог уверенности детекции
+DECODE_SCALE = getattr(config, 'DECODE_SCALE', 1)  # Уменьшение JPEG при декодировании для inference
+TARGET_CLASSES = getattr(config, 'TARGET_CLASSES', ('truck', 'lorry'))  # Искомые классы объектов
+DETECT_BACKEND = getattr(config, 'DETECT_BACKEND', 'torch')  # torch / onnxruntime / openvino
+BACKEND_OPTIONS = getattr(config, 'BACKEND_OPTIONS', None)  # Настройки потоков/сессии бэкенда
+DETECT_PRECISION = getattr(config, 'DETECT_PRECISION', 'fp32')  # fp32 / fp16 (openvino) / int8
+CASCADE_SCREEN_MODEL = getattr(config, 'CASCADE_SCREEN_MODEL', None)  # Быстрая модель каскада ('yolov8n.pt')
+CASCADE_POLICY = getattr(config, 'CASCADE_POLICY', 'uncertain')  # uncertain / any
+CASCADE_UNCERTAIN_BAND = getattr(config, 'CASCADE_UNCERTAIN_BAND', (0.25, 0.8))
+# Кэш детекций по хэшу файла (None - выключен)
+DETECTION_CACHE_PATH = getattr(config, 'DETECTION_CACHE_PATH', './fc_media/detect_cache.sqlite3')
+DETECTION_CACHE_MAX_ENTRIES = getattr(config, 'DETECTION_CACHE_MAX_ENTRIES', 200_000)
+DETECTION_CACHE_MAX_AGE_DAYS = getattr(config, 'DETECTION_CACHE_MAX_AGE_DAYS', 180)
+# Подавление статичной сцены: порог расстояния Хэмминга dHash области интереса (из 256 бит), None - выключено.
+# По умолчанию выключено; включается для отдельных ловушек после проверки test_scene_filter.py
+SCENE_DEFAULT_THRESHOLD = getattr(config, 'SCENE_DEFAULT_THRESHOLD', None)
+SCENE_THRESHOLDS = getattr(config, 'SCENE_THRESHOLDS', {})  # {imei: порог} для отдельных ловушек
+SCENE_STATE_PATH = getattr(config, 'SCENE_STATE_PATH', './fc_media/scene_state.json')
+# Каталог с фото ловушек (туда же сохраняет вложения mail_pusher)
+MEDIA_DIR = getattr(config, 'MEDIA_DIR', './fc_media/')
+# Конвейер анализа: потоки загрузки (чтение, хэш, декодирование) и подготовки оповещений, размер очередей
+LOADER_THREADS = getattr(config, 'LOADER_THREADS', 2)
+NOTIFY_THREADS = getattr(config, 'NOTIFY_THREADS', 1)
+PIPELINE_QUEUE_SIZE = getattr(config, 'PIPELINE_QUEUE_SIZE', 2 * DETECT_BATCH_SIZE)
+# Декодированные кадры (десятки МБ каждый) держат очередь детекции (одна пачка впереди inference) и
+# очередь оповещений (кадры с грузовиком ждут отрисовки рамок и JPEG; после постановки в очередь оповещений
+# кадр отпускается). Всего в памяти не больше
+# 2 * DETECT_BATCH_SIZE + LOADER_THREADS + NOTIFY_QUEUE_SIZE + NOTIFY_THREADS кадров
+DETECT_QUEUE_SIZE = getattr(config, 'DETECT_QUEUE_SIZE', DETECT_BATCH_SIZE)
+NOTIFY_QUEUE_SIZE = getattr(config, 'NOTIFY_QUEUE_SIZE', DETECT_BATCH_SIZE)
+# Сколько взятых в работу строк может одновременно быть в конвейере: источник не берет новые, пока их больше.
+# Аренда этих строк продлевается (ResultWriter.renew_if_due), но если продление не проходит, они должны
+# успеть пройти inference за DB_LEASE_SECONDS: CLAIM_AHEAD * (секунд на кадр) < DB_LEASE_SECONDS
+CLAIM_AHEAD = getattr(config, 'CLAIM_AHEAD', 4 * DETECT_BATCH_SIZE)
+PIPELINE_STATS_INTERVAL = getattr(config, 'PIPELINE_STATS_INTERVAL', 30)  # Как часто писать глубину очередей
+# Пул процессов для inference (0 - детекция в основном процессе)
+INFERENCE_WORKERS = getattr(config, 'INFERENCE_WORKERS', 0)
+THREADS_PER_WORKER = getattr(config, 'THREADS_PER_WORKER', 1)  # torch.set_num_threads в каждом процессе
+# Очередь оповещений: файл SQLite, одновременные отправки, повторы с растущей задержкой (секунды)
+NOTIFY_OUTBOX_PATH = getattr(config, 'NOTIFY_OUTBOX_PATH', './fc_media/notify_outbox.sqlite3')
+NOTIFY_MAX_WORKERS = getattr(config, 'NOTIFY_MAX_WORKERS', 4)
+NOTIFY_MAX_ATTEMPTS = getattr(config, 'NOTIFY_MAX_ATTEMPTS', 8)
+NOTIFY_RETRY_DELAY = getattr(config, 'NOTIFY_RETRY_DELAY', 5)
+NOTIFY_MAX_RETRY_DELAY = getattr(config, 'NOTIFY_MAX_RETRY_DELAY', 600)
+# Одновременные отправки в один канал: зависший мессенджер не занимает все NOTIFY_MAX_WORKERS потоков
+NOTIFY_CHANNEL_WORKERS = getattr(config, 'NOTIFY_CHANNEL_WORKERS', {'telegram': 2, 'tdm': 2})
+# Аренда доставки на время отправки (секунды); None - вдвое больше самой долгой отправки в Telegram или TDM
+NOTIFY_SENDING_LEASE = getattr(config, 'NOTIFY_SENDING_LEASE', None)
+# Серия кадров одной ловушки за NOTIFY_COALESCE_WINDOW секунд уходит одним сообщением (0 - каждый кадр отдельно):
+# в Telegram - альбомом, в TDM - коллажем с общей подписью; не больше NOTIFY_ALBUM_MAX кадров в сообщении
+NOTIFY_COALESCE_WINDOW = getattr(config, 'NOTIFY_COALESCE_WINDOW', 10)
+NOTIFY_ALBUM_MAX = min(getattr(config, 'NOTIFY_ALBUM_MAX', MEDIA_GROUP_MAX), MEDIA_GROUP_MAX)
+# Сколько ждать отправки очереди при завершении разового запуска (остальное уйдет при следующем)
+NOTIFY_DRAIN_TIMEOUT = getattr(config, 'NOTIFY_DRAIN_TIMEOUT', 30)
+# Как часто служба удаляет из очереди оповещения, обработанные больше недели назад (секунды)
+NOTIFY_PURGE_INTERVAL = getattr(config, 'NOTIFY_PURGE_INTERVAL', 3600)
+# Таймауты запросов к Telegram (подключение, чтение ответа) в секундах
+TELEGRAM_TIMEOUT = getattr(config, 'TELEGRAM_TIMEOUT', (5, 30))
+# Изображение оповещения: длинная сторона (None - без уменьшения), качество JPEG, вырезать область вокруг объектов
+ALERT_MAX_EDGE = getattr(config, 'ALERT_MAX_EDGE', 1600)
+ALERT_JPEG_QUALITY = getattr(config, 'ALERT_JPEG_QUALITY', 80)
+ALERT_CROP = getattr(config, 'ALERT_CROP', False)
+ALERT_CROP_MARGIN = getattr(config, 'ALERT_CROP_MARGIN', 0.25)  # Поля вокруг объектов в долях их размера
 
 # Инициализируем бота один раз
-telegram_bot = TelegramBot(TELEGRAM_CONFIG['token'], TELEGRAM_CONFIG['chat_id'])
+# Соединения с Telegram держатся открытыми - по одному на поток отправки оповещений
+telegram_bot = TelegramBot(TELEGRAM_CONFIG['token'], TELEGRAM_CONFIG['chat_id'], timeout=TELEGRAM_TIMEOUT,
+                           pool_maxsize=NOTIFY_MAX_WORKERS)
 tdm_bot = initialize_tdm_bot()  # Инициализируем TDM бот
 
-def find_file_case_insensitive(filename, directory):
-    """Поиск файла без учета регистра"""
-    logger.debug(f"Поиск файла {filename} в {directory}")
+def tdm_group_for(id_foto_catch):
+    """Группа TDM (канал округа), в котором стоит ловушка; None - ловушки нет в TDM_DICT."""
+    # -------- выбираем из словаря ОКРУГОВ тот округ (калал ТЛМ), в котором стоит ловушка (по ID)
+    for group_id, traps in TDM_DICT.items():
+        if id_foto_catch in traps:
+            return group_id
+    return None
 
-    if os.path.exists(os.path.join(directory, filename)):
-        return os.path.join(directory, filename)
 
-    for file in os.listdir(directory):
-        if file.lower() == filename.lower():
-            return os.path.join(directory, file)
+def alert_targets(id_foto_catch):
+    """Каналы оповещения о ловушке и получатели в них: {канал: ID чата/группы}."""
+    targets = {'telegram': telegram_bot.chat_id}
+    group_id = tdm_group_for(id_foto_catch)
+    if group_id is None:
+        logger.warning(f"❌ Не найден group_id для ID ловушки: {id_foto_catch}")
+    else:
+        targets['tdm'] = group_id
+    return targets
 
-    logger.warning(f"Файл {filename} не найден в {directory}")
 
-    return None
+def build_alert_builder():
+    """Кодировщик изображений оповещений по настройкам из config."""
+    return AlertPayloadBuilder(max_edge=ALERT_MAX_EDGE, quality=ALERT_JPEG_QUALITY, crop=ALERT_CROP,
+                               crop_margin=ALERT_CROP_MARGIN)
 
 
-def send_to_both_bots(image_path, caption, id_foto_catch):
+def build_notifier():
     """
-    Автоматическая отправка изображения и текста в оба бота одновременно
-    """
-    logger.info(f"Отправка в боты: {caption[:15]}...")
+    Очередь оповещений с фоновой отправкой в Telegram и TDM (см. notify_outbox).
 
-    results = []
+    Анализ только ставит оповещения в очередь, поэтому медленный мессенджер
+    не задерживает inference, а неотправленное переживает перезапуск процесса.
+    """
+    # Аренда не должна истечь, пока отправка еще идет: иначе другой процесс отправит оповещение повторно.
+    # В Telegram до (max_retries + 1) запросов с ожиданием retry_after, TDM ограничен send_timeout
+    sending_lease = NOTIFY_SENDING_LEASE or 2 * max(telegram_bot.max_send_seconds, tdm_bot.send_timeout)
+    outbox = NotificationOutbox(NOTIFY_OUTBOX_PATH, sending_lease=sending_lease)
+    channels = {
+        'telegram': lambda target, image, caption: telegram_bot.send_photo(image, caption, chat_id=target),
+        'tdm': lambda target, image, caption: tdm_bot.send_photo_with_caption(group_id=target, image_path=image,
+                                                                              caption=caption),
+    }
+    # Серия кадров ловушки: в Telegram - альбом (общая подпись у первого фото),
+    # в TDM (альбомов нет) - коллаж с общей подписью
+    alert_builder = build_alert_builder()
+    group_channels = {
+        'telegram': lambda target, images, captions: telegram_bot.send_media_group(
+            images, merge_captions(captions, limit=CAPTION_MAX), chat_id=target),
+        'tdm': lambda target, images, captions: tdm_bot.send_photo_with_caption(
+            group_id=target, image_path=alert_builder.collage(images), caption=merge_captions(captions)),
+    }
+    return OutboxSender(outbox, channels, max_workers=NOTIFY_MAX_WORKERS, max_attempts=NOTIFY_MAX_ATTEMPTS,
+                        base_delay=NOTIFY_RETRY_DELAY, max_delay=NOTIFY_MAX_RETRY_DELAY,
+                        group_channels=group_channels, coalesce_window=NOTIFY_COALESCE_WINDOW,
+                        max_group=NOTIFY_ALBUM_MAX, channel_workers=NOTIFY_CHANNEL_WORKERS,
+                        purge_interval=NOTIFY_PURGE_INTERVAL).start()
+
+
+def detect_batch(detector, filepaths, rois=None, pool=None, imgsizes=None, frames=None):
+    """
+    Пакетная детекция для списка файлов.
+
+    Args:
+        detector (TruckDetector): Детектор.
+        filepaths (list): Пути к файлам.
+        rois (list): Области интереса ловушек для каждого файла (None - весь кадр).
+        pool (InferencePool): Пул процессов; если задан, детекция идет в нем.
+        imgsizes (list): Размер входа модели для каждого файла (None - размер детектора).
+                         Файлы с одинаковым размером идут в модель одной пачкой.
+        frames (list): Кадры, заранее подготовленные TruckDetector.prepare (None в списке -
+                       кадр не подготовлен); без пула детекция идет по ним без повторного чтения.
+
+    Если пачка целиком не обработалась (например, из-за битого файла),
+    файлы прогоняются по одному, чтобы ошибка затронула только сам файл.
+
+    Returns:
+        list: Результат detect_truck для каждого файла или None при ошибке.
+    """
+    rois = rois if rois is not None else [None] * len(filepaths)
+    imgsizes = imgsizes if imgsizes is not None else [None] * len(filepaths)
+
+    # Группируем файлы по размеру входа: один вызов predict принимает только один imgsz
+    groups = {}
+    for index, imgsz in enumerate(imgsizes):
+        groups.setdefault(imgsz, []).append(index)
+
+    detections = [None] * len(filepaths)
+    for imgsz, indices in groups.items():
+        group_paths = [filepaths[i] for i in indices]
+        group_rois = [rois[i] for i in indices]
+        group_frames = [frames[i] for i in indices] if frames is not None else None
+        for index, detection in zip(indices, _detect_group(detector, group_paths, group_rois, pool, imgsz,
+                                                           group_frames)):
+            detections[index] = detection
+    return detections
+
+
+def _detect_group(detector, filepaths, rois, pool, imgsz, frames=None):
+    """Детекция файлов с одним размером входа модели (см. detect_batch)."""
+    if pool is not None:
+        return pool.detect_batch(filepaths, rois, conf_threshold=CONF_THRESHOLD, imgsz=imgsz)
 
-    # Отправка в Telegram
     try:
-        telegram_success = telegram_bot.send_photo(image_path, caption)
-        results.append(("Telegram", telegram_success))
-        if telegram_success:
-            print("✅ Сообщение отправлено в Telegram")
-            logger.info("✅ Сообщение отправлено в Telegram")
-        else:
-            print("❌ Не удалось отправить в Telegram")
-            logger.warning("❌ Не удалось отправить в Telegram")
+        if frames is not None:
+            # Кадры, которые загрузчики не подготовили, читаем здесь
+            frames = [frame if frame is not None else detector.prepare(filepath, CONF_THRESHOLD, roi, imgsz=imgsz)
+                      for frame, filepath, roi in zip(frames, filepaths, rois)]
+            return detector.detect_prepared(frames, CONF_THRESHOLD, imgsz=imgsz)
+        return detector.detect_trucks_batch(filepaths, conf_threshold=CONF_THRESHOLD, batch_size=DETECT_BATCH_SIZE,
+                                            rois=rois, imgsz=imgsz)
     except Exception as e:
-        print(f"❌ Ошибка отправки в Telegram: {e}")
-        logger.error(f"❌ Ошибка отправки в Telegram: {e}")
-        results.append(("Telegram", False))
+        logger.warning(f"⚠️ Пакетная детекция не удалась ({e}), обрабатываем файлы по одному")
 
-    # Отправка в TDM (упрощенная версия)
+    detections = []
+    for filepath, roi in zip(filepaths, rois):
+        try:
+            detections.append(detector.detect_truck(filepath, conf_threshold=CONF_THRESHOLD, roi=roi, imgsz=imgsz))
+        except Exception as e:
+            logger.error(f"❌ Ошибка при анализе {os.path.basename(filepath)}: {e}")
+            detections.append(None)
+    return detections
 
-    try:
-        # tdm_success = tdm_simple_bot.send_photo_with_caption(image_path, caption)
-        # tdm_success = tdm_bot.send_photo_with_caption(image_path, caption)
-
-        # -------- выбираем из словаря ОКРУГОВ тот округ (калал ТЛМ), в котором стоит ловушка (по ID)
-        group_id = None
-        for i in TDM_DICT.keys():
-            if id_foto_catch in TDM_DICT.get(i):
-                group_id = i
-                break
-
-        if group_id is None:
-            logger.warning(f"❌ Не найден group_id для ID ловушки: {id_foto_catch}")
-            results.append(("TDM", False))
-        else:
-            tdm_success = tdm_bot.send_photo_with_caption(
-                group_id=group_id,
-                image_path=image_path,
-                caption=caption
-            )
-            results.append(("TDM", tdm_success))
-            if tdm_success:
-                logger.info("✅ Сообщение отправлено в TDM")
-            else:
-                logger.warning("❌ Не удалось отправить в TDM")
 
-    except Exception as e:
-        logger.error(f"❌ Ошибка отправки в TDM: {e}")
-        results.append(("TDM", False))
+def build_detector():
+    """Создает детектор (с кэшем детекций) по настройкам из config."""
+    detection_cache = None
+    if DETECTION_CACHE_PATH:
+        detection_cache = DetectionCache(DETECTION_CACHE_PATH, max_entries=DETECTION_CACHE_MAX_ENTRIES,
+                                         max_age_days=DETECTION_CACHE_MAX_AGE_DAYS)
 
-    return results
+    return TruckDetector(decode_scale=DECODE_SCALE, target_classes=TARGET_CLASSES,
+                         backend=DETECT_BACKEND, backend_options=BACKEND_OPTIONS,
+                         screen_model_path=CASCADE_SCREEN_MODEL, cascade_policy=CASCADE_POLICY,
+                         uncertain_band=CASCADE_UNCERTAIN_BAND, cache=detection_cache,
+                         precision=DETECT_PRECISION, imgsz=DETECT_IMGSZ)
 
 
+def build_scene_filter():
+    """Создает фильтр статичной сцены по настройкам из config."""
+    return SceneFilter(SCENE_DEFAULT_THRESHOLD, SCENE_THRESHOLDS, SCENE_STATE_PATH)
 
-def analyze_photos():
-    """Основная функция анализа фотографий"""
-    logger.info("🚀 Запуск анализа фотографий")
 
-    try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        cursor = conn.cursor()
+def build_inference_pool(detector):
+    """Создает пул процессов для inference, если он включен в config (иначе None)."""
+    if INFERENCE_WORKERS <= 0:
+        return None
+    return InferencePool(detector, workers=INFERENCE_WORKERS, threads_per_worker=THREADS_PER_WORKER)
 
-        # Получаем необработанные фотографии
-        cursor.execute("""
-            SELECT filename, imei FROM fotos_data 
-            WHERE info_detect IS NULL OR info_detect = ''
-        """)
 
-        undetected_files = cursor.fetchall()
+def build_media_index(base_dir=MEDIA_DIR):
+    """Индекс файлов каталога с фото: читается один раз, дальше дочитывается по mtime."""
+    return MediaIndex(base_dir)
 
-        if not undetected_files:
-            print("✅ Все фотографии уже обработаны")
-            logger.info("✅ Все фотографии уже обработаны")
-            return
 
-        print(f"📷 Найдено {len(undetected_files)} необработанных фотографий")
-        logger.info(f"📷 Найдено {len(undetected_files)} необработанных фотографий")
+class _PhotoTask:
+    """Фото, проходящее через конвейер анализа."""
 
-        detector = TruckDetector()
-        processed_count = 0
-        # base_dir = 'c:/Users/TurchinMV/Downloads/truck_foto/foto_catcher/'
-        base_dir = './fc_media/'
-        # base_dir = '/home/adm_1/foto_catcher/fc_media'
+    def __init__(self, work_item, filepath):
+        self.work_item = work_item
+        self.filepath = filepath
+        self.frame_hash = None
+        self.frame = None
+        self.is_repeat = False
+        self.reference = None
+        self.detection = None
 
-        for item_ in undetected_files:
-            filename = item_[0]
-            imei_id = item_[1]
 
-            try:
-                file_conn = psycopg2.connect(**DB_CONFIG)
-                file_cursor = file_conn.cursor()
+class _AnalyzerStages:
+    """
+    Стадии конвейера анализа.
+
+    load (несколько потоков) - поиск файла, хэш кадра, чтение, проверка кэша и декодирование;
+    detect (один поток) - фильтр статичной сцены и пакетный inference;
+    notify - отрисовка рамок, JPEG и постановка оповещения в очередь (отправляет OutboxSender);
+    write (один поток) - пакетная запись результатов в БД.
+    Пока модель считает пачку, загрузчики готовят следующую, а подготовка
+    оповещений и запись в БД идут параллельно с inference.
+    """
 
-                # Поиск файла без учета регистра
-                filepath = find_file_case_insensitive(filename, base_dir)
+    def __init__(self, detector, scene_filter, media_index, writer, notifier, pool=None, should_stop=None):
+        self.detector = detector
+        self.scene_filter = scene_filter
+        self.media_index = media_index
+        self.writer = writer
+        self.notifier = notifier
+        self.alert_builder = build_alert_builder()
+        self.pool = pool
+        self.should_stop = should_stop
+        self.processed_count = 0
+        self.pipeline = Pipeline('analyzer')
+
+        queue_size = PIPELINE_QUEUE_SIZE
+        self.pipeline.add_stage('load', self.load, threads=LOADER_THREADS, queue_size=queue_size)
+        self.pipeline.add_stage('detect', self.detect, queue_size=DETECT_QUEUE_SIZE, batch_size=DETECT_BATCH_SIZE)
+        self.pipeline.add_stage('notify', self.notify, threads=NOTIFY_THREADS, queue_size=NOTIFY_QUEUE_SIZE)
+        self.pipeline.add_stage('write', self.write, queue_size=queue_size, idle_interval=1.0,
+                                on_idle=writer.flush_if_due, on_close=writer.flush)
+
+    def run(self):
+        """Прогоняет все необработанные фото через конвейер; возвращает счетчики стадий."""
+        return self.pipeline.run(self.claimed_items(), stats_interval=PIPELINE_STATS_INTERVAL)
+
+    def claimed_items(self):
+        """
+        Источник: берет в работу пачки строк, пока они есть и не пришел сигнал остановки.
+
+        В конвейере не больше CLAIM_AHEAD взятых и еще не обработанных строк;
+        их аренду продлевает writer (см. ResultWriter.hold).
+        """
+        while True:
+            if self.should_stop is not None and self.should_stop():
+                logger.info("⏹️ Получен сигнал остановки, обработка прервана")
+                return
+            if self.writer.in_progress >= CLAIM_AHEAD:
+                time.sleep(0.1)
+                continue
 
-                if not filepath:
-                    print(f"⚠️ Файл не найден: {filename} в директории {base_dir}")
-                    logger.warning(f"⚠️ Файл не найден: {filename} в директории {base_dir}")
-                    file_cursor.close()
-                    file_conn.close()
-                    continue
+            # Строки, взятые другими анализаторами, пропускаются без ожидания, а свои еще не записанные
+            # не берутся повторно, даже если продлить их аренду не удалось
+            claimed = claim_batch(DETECT_BATCH_SIZE, worker=self.writer.worker, exclude=self.writer.held_ids())
+            if not claimed:
+                return
+            self.writer.hold(work_item.id for work_item in claimed)
+            yield from claimed
+
+    def load(self, work_item):
+        filename, imei_id = work_item.filename, work_item.imei
+        # Поиск файла без учета регистра
+        filepath = self.media_index.find(filename)
+
+        if not filepath:
+            print(f"⚠️ Файл не найден: {filename} в директории {self.media_index.directory}")
+            logger.warning(f"⚠️ Файл не найден: {filename} в директории {self.media_index.directory}")
+            self.writer.release(work_item.id)
+            return
 
-                print(f"🔍 Анализируем: {os.path.basename(filepath)}")
-                logger.info(f"🔍 Анализируем: {os.path.basename(filepath)}")
-
-                # Детекция объектов
-                trucks, image_with_boxes = detector.detect_truck(filepath, conf_threshold=0.6)
-
-                # Формируем результаты
-                detection_results = [(truck['class'], float(truck['confidence'])) for truck in trucks]
-
-                # Проверяем, есть ли грузовики
-                has_truck = any(object[0] == 'truck' for object in detection_results)
-
-                for object in detection_results:
-                    if object[0] == 'truck':
-                        print(f'truck = {object[1]}')
-
-                # Получаем данные из БД
-                # cursor.execute(f"SELECT imei, time_accident, date FROM fotos_data WHERE filename = %s", (filename,))
-                cursor.execute(
-                    "SELECT time_accident, date, imei FROM fotos_data WHERE filename = %s AND imei = %s",
-                    (filename, imei_id)
-                                )
-                row_data_file = cursor.fetchall()
-
-                # if row_data_file:
-                output_message = f'В {row_data_file[0][1]} ловушкой {row_data_file[0][0]} был обнаружен объект "Грузовик"'
-                #     # print(f'{output_message=}')
-
-                # Отправляем сообщение в Telegram только если найден грузовик
-                if has_truck:
-                    # Отправляем текстовое сообщение
-                    # telegram_bot.send_message(output_message)
-                    # Отправляем изображение с bounding boxes
-                    photo_caption = (f"Локация:\t'----'\n"
-                                     f"Дата:\t\t{row_data_file[0][1]}\n"
-                                     f"Время:\t\t{row_data_file[0][0]}\n"
-                                     f"ID ловушки:\t{row_data_file[0][2][-4:]} - {filename}")
-
-                    # ----- id ЛОВУШКИ ----------------
-                    id_foto_catch = row_data_file[0][2]
-
-                    # telegram_bot.send_photo(image_with_boxes, photo_caption)
-                    # Отправляем в оба бота одновременно
-                    send_results = send_to_both_bots(image_with_boxes, photo_caption, id_foto_catch)
-                    logger.info(f"Результаты отправки: {send_results}")
-
-
-                # Обновляем запись в БД
-                info_detect = {
-                    'файл': filename,
-                    'реальный_файл': os.path.basename(filepath),
-                    'детекции': detection_results,
-                    'время_анализа': datetime.now().isoformat()
-                }
-
-                file_cursor.execute(
-                    "UPDATE fotos_data SET info_detect = %s WHERE filename = %s",
-                    (json.dumps(info_detect, ensure_ascii=False), filename)
-                )
-
-                file_conn.commit()
-                processed_count += 1
-                print(f"✅ Обновлено: {filename} - найдено {len(detection_results)} объектов")
-                logger.info(f"✅ Обновлено: {filename} - найдено {len(detection_results)} объектов")
-
-                file_cursor.close()
-                file_conn.close()
+        task = _PhotoTask(work_item, filepath)
+        # Хэш нужен только ловушкам с включенным подавлением статичной сцены
+        if self.scene_filter.threshold_for(imei_id) is not None:
+            try:
+                task.frame_hash = frame_hash(filepath, TRAP_ROI.get(imei_id))
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось посчитать хэш кадра {filename}: {e}")
 
+        # Кадр, похожий на повтор сцены, скорее всего не понадобится - его не декодируем.
+        # С пулом процессов файлы читают рабочие процессы.
+        if self.pool is None and (task.frame_hash is None
+                                  or not self.scene_filter.looks_repeated(imei_id, task.frame_hash)):
+            try:
+                task.frame = self.detector.prepare(filepath, CONF_THRESHOLD, TRAP_ROI.get(imei_id),
+                                                   imgsz=TRAP_IMGSZ.get(imei_id))
             except Exception as e:
-                logger.error(f"❌ Ошибка при анализе {filename}: {e}")
-                if 'file_conn' in locals():
-                    file_cursor.close()
-                    file_conn.close()
+                # Файл еще раз прочитает стадия детекции и запишет ошибку для него
+                logger.warning(f"⚠️ Не удалось подготовить кадр {filename}: {e}")
+
+        self.pipeline.emit('detect', task)
+
+    def detect(self, tasks):
+        # Статичная сцена: кадр почти не отличается от последнего проанализированного кадра ловушки.
+        # Решение принимается здесь, в одном потоке и в порядке поступления кадров.
+        for task in tasks:
+            if task.frame_hash is not None:
+                task.is_repeat, task.reference = self.scene_filter.check(task.work_item.imei, task.frame_hash,
+                                                                         task.work_item.filename)
+
+        # Детекция объектов сразу для всей пачки (кроме повторов статичной сцены)
+        to_detect = [task for task in tasks if not task.is_repeat]
+        detections = detect_batch(self.detector, [task.filepath for task in to_detect],
+                                  [TRAP_ROI.get(task.work_item.imei) for task in to_detect], self.pool,
+                                  [TRAP_IMGSZ.get(task.work_item.imei) for task in to_detect],
+                                  [task.frame for task in to_detect]) if to_detect else []
+        for task, detection in zip(to_detect, detections):
+            task.detection = detection
+            task.frame = None
+            if task.reference is not None:
+                if detection is None:
+                    self.scene_filter.forget(task.work_item.imei, task.reference)
+                else:
+                    task.reference.detection = detection.detections_only()
+
+        for task in tasks:
+            filename = task.work_item.filename
+            if task.is_repeat:
+                # Опорный кадр не удалось проанализировать - кадр останется до следующего запуска
+                if task.reference.detection is None:
+                    self.writer.release(task.work_item.id)
+                    continue
+                task.detection = task.reference.detection
+                logger.info(f"♻️ {filename}: сцена не изменилась с {task.reference.filename}, inference пропущен")
+            elif task.detection is None:
+                self.writer.release(task.work_item.id)
                 continue
 
+            print(f"🔍 Анализируем: {os.path.basename(task.filepath)}")
+            logger.info(f"🔍 Анализируем: {os.path.basename(task.filepath)}")
+            for class_name, conf in zip(task.detection.class_names, task.detection.confidences.tolist()):
+                if class_name == 'truck':
+                    print(f'truck = {conf}')
+
+            # Отправляем оповещение только если найден грузовик
+            # (для повтора статичной сцены оповещение уже было отправлено по опорному кадру)
+            if task.detection.has_class('truck') and not task.is_repeat:
+                self.pipeline.emit('notify', task)
+            else:
+                # Кадр для отрисовки больше не нужен - не держим его в очереди записи
+                task.detection = task.detection.detections_only()
+                self.pipeline.emit('write', task)
+
+    def notify(self, task):
+        work_item = task.work_item
+        try:
+            # Дата, время и ловушка пришли вместе с работой - повторный запрос к БД не нужен
+            photo_caption = (f"Локация:\t'----'\n"
+                             f"Дата:\t\t{work_item.date}\n"
+                             f"Время:\t\t{work_item.time_accident}\n"
+                             f"ID ловушки:\t{work_item.imei[-4:]} - {work_item.filename}")
+
+            # Изображение с рамками рисуется только здесь - для кадров с грузовиком.
+            # JPEG кодируется один раз и ставится в очередь для обоих ботов; отправка идет в фоне
+            image = self.alert_builder.build(task.detection)
+            # Кадр больше не нужен - отпускаем его до записи в очередь оповещений
+            task.detection = task.detection.detections_only()
+            alert_id = self.notifier.enqueue(image, photo_caption, work_item.imei, alert_targets(work_item.imei))
+            logger.info(f"📨 Оповещение {alert_id} поставлено в очередь: {work_item.filename}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка постановки оповещения в очередь для {work_item.filename}: {e}")
+        finally:
+            task.detection = task.detection.detections_only()
+            self.pipeline.emit('write', task)
+
+    def write(self, task):
+        filename = task.work_item.filename
+        detection_results = list(zip(task.detection.class_names, task.detection.confidences.tolist()))
+
+        # Обновляем запись в БД
+        info_detect = {
+            'файл': filename,
+            'реальный_файл': os.path.basename(task.filepath),
+            'детекции': detection_results,
+            'время_анализа': datetime.now().isoformat()
+        }
+        if task.is_repeat:
+            info_detect['повтор_кадра'] = task.reference.filename
+
+        self.writer.add(task.work_item.id, json.dumps(info_detect, ensure_ascii=False))
+        self.processed_count += 1
+        print(f"✅ Обработано: {filename} - найдено {len(detection_results)} объектов")
+        logger.info(f"✅ Обработано: {filename} - найдено {len(detection_results)} объектов")
+
+
+def analyze_photos(detector=None, scene_filter=None, conn=None, should_stop=None, pool=None, media_index=None,
+                   notifier=None):
+    """
+    Основная функция анализа фотографий
+
+    Фото проходят через конвейер стадий (см. _AnalyzerStages), связанных
+    ограниченными очередями: чтение и декодирование, inference, подготовка
+    оповещений и запись в БД выполняются одновременно. Оповещения отправляются
+    в фоне из постоянной очереди (см. build_notifier).
+
+    Args:
+        detector (TruckDetector): Готовый детектор (None - создать на время вызова).
+        scene_filter (SceneFilter): Фильтр статичной сцены (None - создать на время вызова).
+        conn: Открытое соединение с БД (None - взять из общего пула db на время вызова).
+        should_stop (callable): Проверяется перед взятием новой пачки; True - прервать обработку (для службы).
+        pool (InferencePool): Пул процессов для inference (None - создать по config вместе с детектором).
+        media_index (MediaIndex): Индекс каталога с фото (None - построить на время вызова).
+        notifier (OutboxSender): Отправка оповещений (None - запустить на время вызова).
+    """
+    logger.info("🚀 Запуск анализа фотографий")
+
+    own_conn = conn is None
+    own_detector = detector is None
+    own_notifier = notifier is None
+
+    try:
+        if own_conn:
+            conn = get_pool().getconn()
+        # Результаты пишутся пачками в одной транзакции (размер пачки и интервал - в config)
+        writer = ResultWriter()
+
+        # Схема fotos_data (ключ, аренда, статус, JSONB) доводится до актуальной один раз за процесс
+        migrate()
+        pending_count = count_pending(conn)
+
+        if pending_count and own_detector:
+            detector = build_detector()
+            # Пул создается сразу после загрузки модели, до первого inference в этом процессе и до
+            # запуска потоков отправки оповещений: fork копирует только текущий поток, и блокировка,
+            # захваченная другим потоком, осталась бы захваченной в рабочих процессах
+            pool = build_inference_pool(detector)
+        if own_notifier:
+            # Запускается и без новых фото: дошлет оповещения, оставшиеся в очереди с прошлого запуска
+            notifier = build_notifier()
+
+        if not pending_count:
+            print("✅ Все фотографии уже обработаны")
+            logger.info("✅ Все фотографии уже обработаны")
+            return
+
+        print(f"📷 Найдено {pending_count} необработанных фотографий")
+        logger.info(f"📷 Найдено {pending_count} необработанных фотографий")
+
+        if scene_filter is None:
+            scene_filter = build_scene_filter()
+        detection_cache = detector.cache
+        # base_dir = 'c:/Users/TurchinMV/Downloads/truck_foto/foto_catcher/'
+        # base_dir = '/home/adm_1/foto_catcher/fc_media'
+        if media_index is None:
+            media_index = build_media_index()
+        stages = _AnalyzerStages(detector, scene_filter, media_index, writer, notifier, pool, should_stop)
+        pipeline_stats = stages.run()
+        processed_count = stages.processed_count
+
         print(f"🎉 Обработка завершена. Обработано {processed_count} фотографий")
-        logger.info(f"🎉 Обработка завершена. Обработано {processed_count} фотографий")
+        logger.info(f"🎉 Обработка завершена. Обработано {processed_count} фотографий, "
+                    f"записано в БД {writer.written}, ошибок записи {writer.failed}")
+        logger.info(f"📊 Конвейер: {pipeline_stats}")
+        if stages.alert_builder.count:
+            logger.info(f"📊 Оповещения: {stages.alert_builder.count} изображений, "
+                        f"в среднем {stages.alert_builder.average_size / 1024:.0f} КБ")
+
+        scene_filter.save()
+        if scene_filter.skipped:
+            logger.info(f"📊 Статичная сцена: inference пропущен для {scene_filter.skipped} кадров")
+
+        if detection_cache is not None and detection_cache.hit_rate is not None:
+            logger.info(f"📊 Кэш детекций: попаданий {detection_cache.hits}, промахов {detection_cache.misses} "
+                        f"({detection_cache.hit_rate:.1%})")
+        if detector.screen_model is not None and detector.escalation_rate is not None:
+            logger.info(f"📊 Каскад: в {detector.model_path} передано {detector.stats['escalated']} "
+                        f"из {detector.stats['frames']} кадров ({detector.escalation_rate:.1%})")
 
     except Exception as e:
         print(f"❌ Критическая ошибка: {e}")
         logger.error(f"❌ Критическая ошибка: {e}")
     finally:
-        if 'conn' in locals():
-            cursor.close()
-            conn.close()
+        if locals().get('writer') is not None:
+            # Уже готовые результаты не теряем и при критической ошибке
+            writer.flush()
+        if own_conn and conn is not None:
+            if not conn.closed:
+                conn.rollback()
+            get_pool().putconn(conn, close=bool(conn.closed))
+        if own_notifier and notifier is not None:
+            # Неотправленное за NOTIFY_DRAIN_TIMEOUT остается в очереди до следующего запуска
+            notifier.stop(drain_timeout=NOTIFY_DRAIN_TIMEOUT)
+            notifier.outbox.close()
+        if own_detector and pool is not None:
+            pool.close()
+        if own_detector and locals().get('detection_cache') is not None:
+            detection_cache.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,118 @@
+# analyzer_service.py
+import select
+import signal
+import threading
+import time
+
+import psycopg2
+
+import config
+from db import close_pool
+# Канал LISTEN/NOTIFY: триггер на вставку в fotos_data (миграция 0005) будит службу сразу
+from migrations import NOTIFY_CHANNEL
+# Импорт analyze_photos настраивает логирование и один раз создает клиентов Telegram и TDM
+from analyze_photos import (analyze_photos, build_detector, build_inference_pool, build_media_index,
+                            build_notifier, build_scene_filter, DB_CONFIG, NOTIFY_DRAIN_TIMEOUT)
+
+import logging
+logger = logging.getLogger(__name__)
+
+''' Служба анализа фотографий: модель загружается один раз, новые строки fotos_data обрабатываются сразу '''
+
+# Как часто проверять fotos_data, если уведомлений нет (секунды)
+POLL_INTERVAL = getattr(config, 'ANALYZER_POLL_INTERVAL', 30)
+
+
+class AnalyzerService:
+    """
+    Долгоживущий процесс анализатора.
+
+    Детектор, фильтр сцены, соединение с БД и HTTP-клиенты ботов создаются
+    один раз и переиспользуются между циклами. Между циклами служба ждет
+    уведомления NOTIFY или истечения POLL_INTERVAL. По SIGTERM/SIGINT текущая
+    пачка дорабатывается, после чего служба корректно завершается.
+    """
+
+    def __init__(self, poll_interval=POLL_INTERVAL, notify_channel=NOTIFY_CHANNEL):
+        self.poll_interval = poll_interval
+        self.notify_channel = notify_channel
+        self.stop_event = threading.Event()
+        self.conn = None
+
+    def _handle_signal(self, signum, frame):
+        logger.info(f"⏹️ Получен сигнал {signal.Signals(signum).name}, завершаем работу после текущей пачки")
+        self.stop_event.set()
+
+    def _connect(self):
+        """Открывает (или переоткрывает после обрыва) соединение с БД и подписывается на уведомления."""
+        if self.conn is not None and not self.conn.closed:
+            return
+        self.conn = psycopg2.connect(**DB_CONFIG)
+        # autocommit: чтение не держит транзакцию открытой между циклами, а NOTIFY доходит сразу
+        self.conn.autocommit = True
+        if self.notify_channel:
+            with self.conn.cursor() as cursor:
+                cursor.execute(f'LISTEN "{self.notify_channel}"')
+        logger.info("Соединение с БД установлено")
+
+    def _wait_for_work(self):
+        """Ждет уведомления о новых фото, таймаута опроса или сигнала остановки."""
+        deadline = time.monotonic() + self.poll_interval
+        while not self.stop_event.is_set():
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return
+            # Короткие интервалы, чтобы быстро реагировать на сигнал остановки
+            readable, _, _ = select.select([self.conn], [], [], min(timeout, 1.0))
+            if readable:
+                self.conn.poll()
+                if self.conn.notifies:
+                    self.conn.notifies.clear()
+                    logger.debug("Получено уведомление о новых фото")
+                    return
+
+    def run(self):
+        """Основной цикл службы."""
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+
+        logger.info(f"🚀 Запуск службы анализа (опрос каждые {self.poll_interval} с, канал: {self.notify_channel})")
+        detector = build_detector()
+        # Пул процессов (если включен) создается до первого inference и живет все время работы службы
+        pool = build_inference_pool(detector)
+        scene_filter = build_scene_filter()
+        # Каталог с фото читается один раз, дальше индекс дочитывает только новые файлы
+        media_index = build_media_index()
+        # Оповещения отправляются в фоне все время работы службы, в том числе между циклами
+        notifier = build_notifier()
+
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    self._connect()
+                    analyze_photos(detector=detector, scene_filter=scene_filter, conn=self.conn,
+                                   should_stop=self.stop_event.is_set, pool=pool, media_index=media_index,
+                                   notifier=notifier)
+                    self._wait_for_work()
+                except psycopg2.Error as e:
+                    logger.error(f"❌ Ошибка БД: {e}, переподключение через {self.poll_interval} с")
+                    if self.conn is not None:
+                        self.conn.close()
+                    self.stop_event.wait(self.poll_interval)
+        finally:
+            # Неотправленное остается в очереди и уйдет после перезапуска
+            notifier.stop(drain_timeout=NOTIFY_DRAIN_TIMEOUT)
+            notifier.outbox.close()
+            if pool is not None:
+                pool.close()
+            scene_filter.save()
+            if detector.cache is not None:
+                detector.cache.close()
+            if self.conn is not None and not self.conn.closed:
+                self.conn.close()
+            close_pool()
+            logger.info("🛑 Служба анализа остановлена")
+
+
+if __name__ == "__main__":
+    AnalyzerService().run()
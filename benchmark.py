@@ -0,0 +1,257 @@
+import argparse
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+import config
+from alert_payload import AlertPayloadBuilder
+from logging_config import setup_logging
+
+''' Замер времени по этапам detect_truck (декодирование, inference, отрисовка, JPEG) для разных моделей и бэкендов '''
+
+logger = logging.getLogger('benchmark')
+
+STAGES = ('decode', 'preprocess', 'inference', 'postprocess', 'annotate', 'encode')
+
+# Размер кадра фотоловушки для синтетического набора
+SYNTHETIC_SIZE = (2592, 1944)
+# Изображение оповещения - те же настройки, что у анализатора (см. analyze_photos.build_alert_builder)
+ALERT_SETTINGS = {
+    'max_edge': getattr(config, 'ALERT_MAX_EDGE', 1600),
+    'quality': getattr(config, 'ALERT_JPEG_QUALITY', 80),
+    'crop': getattr(config, 'ALERT_CROP', False),
+    'crop_margin': getattr(config, 'ALERT_CROP_MARGIN', 0.25),
+}
+
+
+def make_synthetic_corpus(folder, count=50, size=SYNTHETIC_SIZE, seed=0):
+    """
+    Создает набор синтетических JPEG: градиентный фон, шум и несколько прямоугольников.
+
+    Содержимое не похоже на настоящие кадры, поэтому детекций почти не будет -
+    набор годится для замера декодирования, inference и кодирования, а не точности.
+
+    Returns:
+        list: Пути к созданным файлам.
+    """
+    rng = np.random.default_rng(seed)
+    width, height = size
+    gradient = np.linspace(40, 200, width, dtype=np.float32)[None, :, None]
+    paths = []
+    for index in range(count):
+        image = np.broadcast_to(gradient, (height, width, 3)).astype(np.float32)
+        image = np.clip(image + rng.normal(0, 12, image.shape), 0, 255).astype(np.uint8)
+        for _ in range(rng.integers(1, 5)):
+            x1, y1 = int(rng.integers(0, width - 200)), int(rng.integers(0, height - 200))
+            x2, y2 = x1 + int(rng.integers(100, 800)), y1 + int(rng.integers(80, 500))
+            cv2.rectangle(image, (x1, y1), (x2, y2), tuple(int(c) for c in rng.integers(0, 255, 3)), -1)
+        path = os.path.join(folder, f'synthetic_{index:04d}.jpg')
+        cv2.imwrite(path, image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        paths.append(path)
+    return paths
+
+
+def summarize(values_ms):
+    """Среднее, p50 и p95 в миллисекундах."""
+    values = np.asarray(values_ms, dtype=np.float64)
+    return {
+        'mean_ms': round(float(values.mean()), 3),
+        'p50_ms': round(float(np.percentile(values, 50)), 3),
+        'p95_ms': round(float(np.percentile(values, 95)), 3),
+    }
+
+
+def run_config(image_paths, model_path, backend, precision='fp32', decode_scale=1,
+               conf_threshold=0.6, warmup=3, alert_settings=None):
+    """
+    Прогоняет набор через один вариант детектора и замеряет каждый этап.
+
+    Этапы повторяют путь detect_truck: decode - чтение и декодирование файла,
+    preprocess / inference / postprocess - по Results.speed ultralytics
+    (в postprocess добавлен наш отбор рамок), annotate - отрисовка рамок и
+    перевод в RGB, encode - JPEG оповещения (AlertPayloadBuilder.encode с
+    настройками alert_settings, по умолчанию ALERT_SETTINGS из config).
+
+    Returns:
+        dict: Результаты по этапам, пропускная способность и пиковый RSS процесса.
+    """
+    from truck_detector import TruckDetector, _Frame, load_image
+
+    started = time.perf_counter()
+    detector = TruckDetector(model_path, decode_scale=decode_scale, backend=backend, precision=precision)
+    load_seconds = time.perf_counter() - started
+    alert_builder = AlertPayloadBuilder(**(alert_settings or ALERT_SETTINGS))
+
+    for image_path in image_paths[:warmup]:
+        detector.detect_truck(image_path, conf_threshold=conf_threshold, render=False)
+
+    timings = {stage: [] for stage in STAGES}
+    totals = []
+    detections = 0
+    wall_started = time.perf_counter()
+    for image_path in image_paths:
+        t0 = time.perf_counter()
+        image = load_image(image_path, decode_scale)
+        frame = _Frame(image_path, image)
+        t1 = time.perf_counter()
+
+        result = detector._predict(detector.model, [frame.input], conf_threshold, detector.class_ids,
+                                   detector.imgsz)[0]
+        t2 = time.perf_counter()
+        detection = detector._make_result(frame, result, conf_threshold, True, detector.class_ids)
+        t3 = time.perf_counter()
+
+        # Отрисовка и JPEG замеряются на каждом кадре, даже без детекций, - как худший случай отправки
+        annotated = detection.annotated_image
+        t4 = time.perf_counter()
+        alert_builder.encode(annotated, detection.boxes)
+        t5 = time.perf_counter()
+
+        speed = result.speed
+        timings['decode'].append((t1 - t0) * 1000)
+        timings['preprocess'].append(speed['preprocess'])
+        timings['inference'].append(speed['inference'])
+        timings['postprocess'].append(speed['postprocess'] + (t3 - t2) * 1000)
+        timings['annotate'].append((t4 - t3) * 1000)
+        timings['encode'].append((t5 - t4) * 1000)
+        totals.append((t5 - t0) * 1000)
+        detections += len(detection)
+    wall_seconds = time.perf_counter() - wall_started
+
+    return {
+        'model': model_path,
+        'backend': backend,
+        'precision': precision,
+        'decode_scale': decode_scale,
+        'frames': len(image_paths),
+        'detections': detections,
+        'model_load_s': round(load_seconds, 3),
+        'throughput_fps': round(len(image_paths) / wall_seconds, 3),
+        'stages': {stage: summarize(values) for stage, values in timings.items()},
+        'total': summarize(totals),
+        'alert_avg_kb': round(alert_builder.average_size / 1024, 1) if alert_builder.count else None,
+        # В Linux ru_maxrss - в килобайтах
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def run_isolated(image_paths, model_path, backend, **kwargs):
+    """Запуск варианта в отдельном процессе, чтобы пиковый RSS и прогрев не смешивались между вариантами."""
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(run_config, image_paths, model_path, backend, **kwargs).result()
+
+
+def find_regressions(report, baseline, tolerance=0.1):
+    """
+    Сравнивает отчет с эталонным прогоном.
+
+    Регрессия - падение пропускной способности или рост p95 общего времени
+    больше чем на tolerance (доля) для того же варианта модели и бэкенда.
+
+    Returns:
+        list: Описания найденных регрессий.
+    """
+    def key(item):
+        return item['model'], item['backend'], item.get('precision', 'fp32'), item.get('decode_scale', 1)
+
+    baseline_items = {key(item): item for item in baseline.get('results', []) if 'error' not in item}
+    regressions = []
+    for item in report['results']:
+        base = baseline_items.get(key(item))
+        if base is None or 'error' in item:
+            continue
+        name = '/'.join(str(part) for part in key(item))
+        if item['throughput_fps'] < base['throughput_fps'] * (1 - tolerance):
+            regressions.append(f"{name}: пропускная способность {base['throughput_fps']} -> {item['throughput_fps']} кадр/с")
+        if item['total']['p95_ms'] > base['total']['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {base['total']['p95_ms']} -> {item['total']['p95_ms']} мс")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк этапов детекции')
+    parser.add_argument('folder', nargs='?', help='Каталог с jpg (если не задан - синтетический набор)')
+    parser.add_argument('--limit', type=int, default=100, help='Сколько файлов взять из каталога')
+    parser.add_argument('--synthetic', type=int, default=50, help='Размер синтетического набора')
+    parser.add_argument('--models', nargs='+', default=['yolov8n.pt', 'yolov8s.pt', 'yolov8m.pt', 'yolov8l.pt'])
+    parser.add_argument('--backends', nargs='+', default=['torch'], choices=['torch', 'onnxruntime', 'openvino'])
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'fp16', 'int8'])
+    parser.add_argument('--decode-scale', type=int, default=1, choices=[1, 2, 4, 8])
+    parser.add_argument('--conf', type=float, default=0.6, help='Порог уверенности')
+    parser.add_argument('--output', help='Сохранить отчет в JSON')
+    parser.add_argument('--baseline', help='Отчет прошлого релиза для поиска регрессий')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Допустимое ухудшение (доля)')
+    args = parser.parse_args()
+
+    setup_logging()
+    with tempfile.TemporaryDirectory() as synthetic_dir:
+        if args.folder:
+            image_paths = sorted(
+                os.path.join(args.folder, name) for name in os.listdir(args.folder)
+                if name.lower().endswith(('.jpg', '.jpeg'))
+            )[:args.limit]
+            corpus = os.path.abspath(args.folder)
+        else:
+            logger.info(f"Каталог не задан - создаем синтетический набор из {args.synthetic} кадров")
+            image_paths = make_synthetic_corpus(synthetic_dir, args.synthetic)
+            corpus = 'synthetic'
+        if not image_paths:
+            logger.error(f"В {args.folder} нет jpg файлов")
+            sys.exit(2)
+
+        results = []
+        for model_path in args.models:
+            for backend in args.backends:
+                logger.info(f"▶️ {model_path} / {backend} на {len(image_paths)} кадрах")
+                try:
+                    item = run_isolated(image_paths, model_path, backend, precision=args.precision,
+                                        decode_scale=args.decode_scale, conf_threshold=args.conf)
+                    logger.info(f"✅ {model_path} / {backend}: {item['throughput_fps']} кадр/с, "
+                                f"p95 {item['total']['p95_ms']} мс, RSS {item['peak_rss_mb']} МБ")
+                except Exception as e:
+                    logger.error(f"❌ {model_path} / {backend}: {e}")
+                    item = {'model': model_path, 'backend': backend, 'precision': args.precision,
+                            'decode_scale': args.decode_scale, 'error': str(e)}
+                results.append(item)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'host': platform.node(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'corpus': corpus,
+            'frames': len(image_paths),
+            'conf_threshold': args.conf,
+            'alert': ALERT_SETTINGS,
+        },
+        'results': results,
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = find_regressions(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            logger.error(f"📉 Регрессия: {regression}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+# db.py
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from typing import NamedTuple
+
+import psycopg2
+import psycopg2.pool
+from psycopg2.extras import execute_values
+
+import config
+
+''' Общий пул соединений с PostgreSQL и пакетная запись результатов анализа в fotos_data '''
+
+logger = logging.getLogger(__name__)
+
+DB_CONFIG = config.DB_CONFIG
+DB_POOL_MIN = getattr(config, 'DB_POOL_MIN', 1)
+DB_POOL_MAX = getattr(config, 'DB_POOL_MAX', 4)
+# Сколько результатов писать одной транзакцией и как долго результат может ждать записи (секунды)
+DB_WRITE_CHUNK_SIZE = getattr(config, 'DB_WRITE_CHUNK_SIZE', 100)
+DB_FLUSH_INTERVAL = getattr(config, 'DB_FLUSH_INTERVAL', 5.0)
+# Срок аренды взятых в работу строк (секунды): после него строки умершего процесса забирают другие
+DB_LEASE_SECONDS = getattr(config, 'DB_LEASE_SECONDS', 300)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class WorkItem(NamedTuple):
+    """Необработанная строка fotos_data - все, что нужно циклу анализа, одним запросом."""
+    id: int
+    filename: str
+    imei: str
+    date: str
+    time_accident: str
+
+
+def get_pool():
+    """Пул соединений процесса (создается при первом обращении)."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.closed:
+            _pool = psycopg2.pool.ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, **DB_CONFIG)
+            logger.info(f"Пул соединений с БД: {DB_POOL_MIN}-{DB_POOL_MAX}")
+        return _pool
+
+
+@contextmanager
+def connection():
+    """
+    Соединение из пула на время блока with.
+
+    При выходе без ошибки транзакция фиксируется, при ошибке - откатывается.
+    Оборванное соединение не возвращается в пул, а закрывается.
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    broken = False
+    try:
+        yield conn
+        conn.commit()
+    except Exception as e:
+        broken = conn.closed or isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn, close=bool(broken))
+
+
+def close_pool():
+    """Закрывает все соединения пула."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+        _pool = None
+
+
+def worker_id():
+    """Имя процесса-анализатора в очереди: хост и PID."""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def count_pending(conn):
+    """Сколько фото еще не обработано (включая взятые в работу другими процессами)."""
+    with conn.cursor() as cursor:
+        # Частичный индекс fotos_data_pending содержит только ожидающие строки (см. migrations)
+        cursor.execute("SELECT count(*) FROM fotos_data WHERE status = 'pending'")
+        return cursor.fetchone()[0]
+
+
+def claim_batch(limit, lease_seconds=DB_LEASE_SECONDS, worker=None, exclude=()):
+    """
+    Берет в работу до limit необработанных фото.
+
+    Строки блокируются через FOR UPDATE SKIP LOCKED, поэтому несколько
+    анализаторов (на одном или разных хостах) получают непересекающиеся
+    наборы и не ждут друг друга. Взятая строка получает аренду на lease_seconds;
+    если процесс умер и не записал результат, после истечения аренды строку
+    возьмет другой анализатор. Строки, пропущенные в этом прогоне (нет файла,
+    ошибка детекции), тоже ждут истечения аренды - так они не берутся повторно
+    в том же цикле. Пока строки обрабатываются, аренду продлевает ResultWriter
+    (см. ResultWriter.hold).
+
+    Args:
+        limit (int): Максимум строк.
+        lease_seconds (int): Срок аренды.
+        worker (str): Имя анализатора (None - worker_id()).
+        exclude (list): id строк, которые этот процесс еще обрабатывает, - не брать, даже если аренда истекла.
+
+    Returns:
+        list: WorkItem, упорядоченные по id.
+    """
+    with connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            """
+            WITH picked AS (
+                SELECT id FROM fotos_data
+                WHERE status = 'pending'
+                  AND (claimed_until IS NULL OR claimed_until < now())
+                  AND NOT (id = ANY(%s))
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE fotos_data AS f
+            SET claimed_by = %s, claimed_until = now() + %s * interval '1 second'
+            FROM picked WHERE f.id = picked.id
+            RETURNING f.id, f.filename, f.imei, f.date, f.time_accident
+            """,
+            (list(exclude), limit, worker or worker_id(), lease_seconds)
+        )
+        return sorted((WorkItem(*row) for row in cursor.fetchall()), key=lambda item: item.id)
+
+
+class ResultWriter:
+    """
+    Накопитель результатов анализа для пакетной записи в fotos_data.
+
+    Результаты копятся в памяти и пишутся одним UPDATE ... FROM (VALUES ...)
+    в одной транзакции, когда набралось chunk_size строк или самый старый
+    результат ждет дольше flush_interval секунд. Если запись не удалась,
+    строки остаются необработанными в БД и будут проанализированы заново.
+
+    Запись снимает аренду и выполняется только для строк, аренда которых
+    все еще у этого анализатора: если она истекла и строку забрал другой
+    процесс, его результат не перезаписывается.
+
+    Строки, взятые в работу (hold), но еще не записанные, получают продление
+    аренды каждые lease_seconds / 3 секунды (при сбросе, см. flush_if_due):
+    пока процесс жив, строки в очередях конвейера не забирают ни другие
+    анализаторы, ни следующий claim_batch этого же процесса. Пропущенные
+    строки (release) больше не продлеваются и ждут истечения аренды.
+    """
+
+    def __init__(self, chunk_size=DB_WRITE_CHUNK_SIZE, flush_interval=DB_FLUSH_INTERVAL, worker=None,
+                 lease_seconds=DB_LEASE_SECONDS):
+        """
+        Args:
+            chunk_size (int): Сколько строк писать одной транзакцией.
+            flush_interval (float): Максимальное время ожидания записи (секунды).
+            worker (str): Имя анализатора, взявшего строки (None - worker_id()).
+            lease_seconds (int): Срок аренды, на который продлеваются взятые строки (как в claim_batch).
+        """
+        self.chunk_size = max(1, int(chunk_size))
+        self.flush_interval = flush_interval
+        self.worker = worker or worker_id()
+        self.lease_seconds = lease_seconds
+        self.written = 0
+        self.failed = 0
+        self._pending = []
+        self._first_added = None
+        self._held = set()
+        self._last_renewal = time.monotonic()
+        self._lock = threading.Lock()
+
+    def hold(self, row_ids):
+        """Строки взяты в работу (claim_batch): продлевать их аренду до записи или release."""
+        with self._lock:
+            self._held.update(row_ids)
+
+    def release(self, row_id):
+        """Строка пропущена в этом прогоне: аренда больше не продлевается и истечет сама."""
+        with self._lock:
+            self._held.discard(row_id)
+
+    def held_ids(self):
+        """id взятых в работу и еще не записанных строк (см. claim_batch exclude)."""
+        with self._lock:
+            return list(self._held)
+
+    @property
+    def in_progress(self):
+        """Сколько взятых в работу строк еще обрабатывается (не переданы в add и не пропущены)."""
+        with self._lock:
+            return max(0, len(self._held) - len(self._pending))
+
+    def renew_if_due(self):
+        """
+        Продлевает аренду взятых, но еще не записанных строк, если с прошлого продления
+        прошла треть срока аренды.
+
+        Returns:
+            int: Количество строк с продленной арендой.
+        """
+        with self._lock:
+            if time.monotonic() - self._last_renewal < self.lease_seconds / 3:
+                return 0
+            self._last_renewal = time.monotonic()
+            row_ids = list(self._held)
+        if not row_ids:
+            return 0
+
+        try:
+            with connection() as conn, conn.cursor() as cursor:
+                cursor.execute(
+                    """
+                    UPDATE fotos_data SET claimed_until = now() + %s * interval '1 second'
+                    WHERE id = ANY(%s) AND claimed_by = %s AND status = 'pending'
+                    """,
+                    (self.lease_seconds, row_ids, self.worker)
+                )
+                renewed = cursor.rowcount
+        except Exception as e:
+            logger.error(f"❌ Не удалось продлить аренду {len(row_ids)} строк: {e}")
+            return 0
+
+        if renewed < len(row_ids):
+            logger.warning(f"⚠️ Аренда {len(row_ids) - renewed} строк уже истекла и перешла другому процессу")
+        logger.debug(f"Аренда продлена для {renewed} строк")
+        return renewed
+
+    def add(self, row_id, info_detect):
+        """
+        Добавляет результат для строки fotos_data и при необходимости сбрасывает накопленное.
+
+        Args:
+            row_id (int): Первичный ключ строки (WorkItem.id).
+            info_detect (str): JSON с результатом анализа.
+        """
+        with self._lock:
+            if not self._pending:
+                self._first_added = time.monotonic()
+            self._pending.append((row_id, info_detect))
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        """Сбрасывает накопленное, если набралась пачка или истек flush_interval; продлевает аренду (renew_if_due)."""
+        with self._lock:
+            due = bool(self._pending) and (
+                len(self._pending) >= self.chunk_size
+                or time.monotonic() - self._first_added >= self.flush_interval
+            )
+        if due:
+            self.flush()
+        self.renew_if_due()
+
+    def flush(self):
+        """
+        Пишет все накопленные результаты.
+
+        Returns:
+            int: Количество обновленных строк.
+        """
+        with self._lock:
+            rows, self._pending = self._pending, []
+            # Записанные строки больше не арендуются; не записанные (ошибка) ждут истечения аренды
+            self._held.difference_update(row_id for row_id, _ in rows)
+        if not rows:
+            return 0
+
+        updated = 0
+        try:
+            with connection() as conn, conn.cursor() as cursor:
+                for start in range(0, len(rows), self.chunk_size):
+                    execute_values(
+                        cursor,
+                        """
+                        UPDATE fotos_data AS f
+                        SET info_detect = v.info_detect::jsonb, status = 'done',
+                            claimed_by = NULL, claimed_until = NULL
+                        FROM (VALUES %s) AS v (id, info_detect, worker)
+                        WHERE f.id = v.id AND f.claimed_by = v.worker
+                        """,
+                        [(row_id, info_detect, self.worker) for row_id, info_detect in rows[start:start + self.chunk_size]],
+                        page_size=self.chunk_size,
+                    )
+                    updated += cursor.rowcount
+        except Exception as e:
+            self.failed += len(rows)
+            logger.error(f"❌ Не удалось записать {len(rows)} результатов в БД: {e}")
+            return 0
+
+        self.written += updated
+        if updated < len(rows):
+            logger.warning(f"⚠️ {len(rows) - updated} результатов не записаны: аренда истекла и строки взял другой процесс")
+        logger.info(f"💾 Записано результатов: {updated} из {len(rows)}")
+        return updated
+
+    def __len__(self):
+        return len(self._pending)
@@ -0,0 +1,150 @@
+# detection_cache.py
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+''' Кэш результатов детекции по хэшу содержимого изображения (SQLite в каталоге fc_media) '''
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = './fc_media/detect_cache.sqlite3'
+
+
+class DetectionCache:
+    """
+    Постоянный кэш детекций.
+
+    Ключ - SHA-256 содержимого файла плюс подпись настроек детектора (модель,
+    порог, набор классов ...), поэтому повторно присланные вложения, тот же файл
+    под другим регистром имени и повторные прогоны после сброса info_detect
+    не проходят inference заново.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=200_000, max_age_days=180, evict_every=500):
+        """
+        Args:
+            path (str): Файл базы SQLite.
+            max_entries (int): Максимум записей; при превышении удаляются давно не использованные.
+            max_age_days (int): Записи старше этого срока удаляются.
+            evict_every (int): Через сколько новых записей запускать очистку.
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.evict_every = evict_every
+
+        self.hits = 0
+        self.misses = 0
+        self._puts_since_evict = 0
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS detections (
+                key TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                used_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS detections_used_at ON detections (used_at)")
+        self._conn.commit()
+        logger.info(f"Кэш детекций: {path}")
+        self.evict()
+
+    @staticmethod
+    def content_digest(data):
+        """SHA-256 содержимого: байты файла или массив изображения."""
+        if isinstance(data, np.ndarray):
+            data = np.ascontiguousarray(data)
+        return hashlib.sha256(memoryview(data)).hexdigest()
+
+    @staticmethod
+    def make_key(digest, signature):
+        """Ключ кэша: хэш содержимого + подпись настроек детектора."""
+        return f"{digest}:{signature}"
+
+    def get(self, key):
+        """
+        Возвращает сохраненные детекции или None.
+
+        Returns:
+            tuple: boxes, confidences, class_ids (numpy) и names {id: name}.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT payload FROM detections WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE detections SET used_at = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+
+        payload = json.loads(row[0])
+        return (
+            np.array(payload['boxes'], dtype=np.int32).reshape(-1, 4),
+            np.array(payload['confidences'], dtype=np.float32),
+            np.array(payload['class_ids'], dtype=np.int32),
+            {int(class_id): name for class_id, name in payload['names'].items()},
+        )
+
+    def put(self, key, detection):
+        """Сохраняет детекции DetectionResult под ключом key."""
+        class_ids = detection.class_ids.tolist()
+        payload = json.dumps({
+            'boxes': detection.boxes.tolist(),
+            'confidences': detection.confidences.tolist(),
+            'class_ids': class_ids,
+            # Имена только встреченных классов - достаточно для восстановления результата
+            'names': {class_id: detection.names[class_id] for class_id in set(class_ids)},
+        })
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO detections (key, payload, created_at, used_at) VALUES (?, ?, ?, ?)",
+                (key, payload, now, now)
+            )
+            self._conn.commit()
+            self._puts_since_evict += 1
+            evict = self._puts_since_evict >= self.evict_every
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Удаляет записи старше max_age_days и самые давно использованные сверх max_entries."""
+        with self._lock:
+            expired = self._conn.execute(
+                "DELETE FROM detections WHERE created_at < ?",
+                (time.time() - self.max_age_days * 86400,)
+            ).rowcount
+            overflow = self._conn.execute(
+                """
+                DELETE FROM detections WHERE key IN (
+                    SELECT key FROM detections ORDER BY used_at DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,)
+            ).rowcount
+            self._conn.commit()
+            self._puts_since_evict = 0
+
+        if expired or overflow:
+            logger.info(f"Кэш детекций: удалено устаревших {expired}, лишних {overflow}")
+
+    @property
+    def hit_rate(self):
+        """Доля попаданий в кэш (None, если обращений не было)."""
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,82 @@
+# detection_metrics.py
+import numpy as np
+
+''' Сравнение результатов детекции (разные бэкенды, модели, разрешения) '''
+
+
+def box_iou(boxes_a, boxes_b):
+    """
+    Матрица IoU между двумя наборами рамок.
+
+    Args:
+        boxes_a (numpy.ndarray): Рамки (N, 4) в формате xyxy.
+        boxes_b (numpy.ndarray): Рамки (M, 4) в формате xyxy.
+
+    Returns:
+        numpy.ndarray: Матрица (N, M) значений IoU.
+    """
+    boxes_a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+
+    top_left = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    bottom_right = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+
+    area_a = np.prod(boxes_a[:, 2:] - boxes_a[:, :2], axis=1)
+    area_b = np.prod(boxes_b[:, 2:] - boxes_b[:, :2], axis=1)
+    union = area_a[:, None] + area_b[None, :] - intersection
+
+    return intersection / np.maximum(union, 1e-9)
+
+
+def match_detections(reference, candidate, iou_threshold=0.5):
+    """
+    Жадно сопоставляет детекции двух результатов одного кадра.
+
+    Рамки сопоставляются только внутри одного класса, в порядке убывания IoU.
+
+    Args:
+        reference (DetectionResult): Эталонный результат.
+        candidate (DetectionResult): Проверяемый результат.
+        iou_threshold (float): Минимальный IoU, при котором рамки считаются одним объектом.
+
+    Returns:
+        list: Пары (индекс в reference, индекс в candidate, IoU).
+    """
+    iou = box_iou(reference.boxes, candidate.boxes)
+    if iou.size:
+        # Рамки разных классов не сопоставляем
+        iou[reference.class_ids[:, None] != candidate.class_ids[None, :]] = 0.0
+
+    pairs = []
+    used_ref, used_cand = set(), set()
+    for flat_index in np.argsort(iou, axis=None)[::-1]:
+        ref_index, cand_index = np.unravel_index(flat_index, iou.shape)
+        value = float(iou[ref_index, cand_index])
+        if value < iou_threshold:
+            break
+        if ref_index in used_ref or cand_index in used_cand:
+            continue
+        used_ref.add(ref_index)
+        used_cand.add(cand_index)
+        pairs.append((int(ref_index), int(cand_index), value))
+    return pairs
+
+
+def compare_detections(reference, candidate, iou_threshold=0.5):
+    """
+    Сводка расхождений двух результатов детекции одного кадра.
+
+    Returns:
+        dict: matched, missed (есть только в reference), extra (есть только в candidate),
+              min_iou и max_conf_diff по сопоставленным парам.
+    """
+    pairs = match_detections(reference, candidate, iou_threshold)
+    conf_diffs = [abs(float(reference.confidences[r]) - float(candidate.confidences[c])) for r, c, _ in pairs]
+    return {
+        'matched': len(pairs),
+        'missed': len(reference) - len(pairs),
+        'extra': len(candidate) - len(pairs),
+        'min_iou': min((iou for _, _, iou in pairs), default=1.0),
+        'max_conf_diff': max(conf_diffs, default=0.0),
+    }
@@ -0,0 +1,148 @@
+# inference_pool.py
+import logging
+import multiprocessing
+import os
+
+from truck_detector import DetectionResult
+
+''' Пул процессов для inference на нескольких ядрах с общими (copy-on-write) весами модели '''
+
+logger = logging.getLogger(__name__)
+
+# Детектор, загруженный в родительском процессе до fork; рабочие процессы получают его копией страниц памяти
+_worker_detector = None
+
+
+def _init_worker(threads_per_worker):
+    """Настройка рабочего процесса: число потоков torch и отключение кэша (он остается у родителя)."""
+    import torch
+
+    torch.set_num_threads(threads_per_worker)
+    # Соединение SQLite нельзя использовать после fork - кэш читает и пишет только родитель
+    _worker_detector.cache = None
+    logger.debug(f"Рабочий процесс {os.getpid()} готов, потоков torch: {threads_per_worker}")
+
+
+def _detect_in_worker(task):
+    """
+    Детекция пачки файлов в рабочем процессе.
+
+    Returns:
+        tuple: Результаты (DetectionResult без изображения или None при ошибке)
+               и приращения счетчиков детектора (кадры, передачи в дорогую модель каскада).
+    """
+    filepaths, rois, conf_threshold, imgsz = task
+    detector = _worker_detector
+    frames_before, escalated_before = detector.stats['frames'], detector.stats['escalated']
+
+    try:
+        detections = detector.detect_trucks_batch(filepaths, conf_threshold=conf_threshold,
+                                                  batch_size=len(filepaths), render=False, rois=rois,
+                                                  imgsz=imgsz)
+    except Exception as e:
+        logger.warning(f"⚠️ Пакетная детекция в процессе {os.getpid()} не удалась ({e}), файлы по одному")
+        detections = []
+        for filepath, roi in zip(filepaths, rois):
+            try:
+                detections.append(detector.detect_truck(filepath, conf_threshold=conf_threshold,
+                                                        render=False, roi=roi, imgsz=imgsz))
+            except Exception as e:
+                logger.error(f"❌ Ошибка при анализе {os.path.basename(filepath)}: {e}")
+                detections.append(None)
+
+    return (detections, detector.stats['frames'] - frames_before,
+            detector.stats['escalated'] - escalated_before)
+
+
+class InferencePool:
+    """
+    Пул рабочих процессов для TruckDetector.
+
+    Модель загружается один раз в родительском процессе, рабочие процессы
+    создаются через fork и разделяют ее веса copy-on-write, а не грузят
+    каждый свою копию. Файлы раздаются процессам пачками; результаты
+    возвращаются родителю, который один пишет в БД и в кэш детекций.
+
+    Пул нужно создать до первого inference в родительском процессе и только
+    с бэкендом torch: сессии ONNX Runtime / OpenVINO и потоки уже запущенного
+    inference не переживают fork.
+    """
+
+    def __init__(self, detector, workers=4, threads_per_worker=1):
+        """
+        Args:
+            detector (TruckDetector): Загруженный детектор (бэкенд torch).
+            workers (int): Количество рабочих процессов.
+            threads_per_worker (int): torch.set_num_threads в каждом процессе.
+        """
+        global _worker_detector
+
+        if detector.backend != 'torch':
+            raise ValueError(f"Пул процессов поддерживает только бэкенд torch, задан: {detector.backend}")
+
+        self.detector = detector
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker
+
+        _worker_detector = detector
+        context = multiprocessing.get_context('fork')
+        self.pool = context.Pool(workers, initializer=_init_worker, initargs=(threads_per_worker,))
+        logger.info(f"Пул inference: {workers} процессов по {threads_per_worker} потоков")
+
+    def detect_batch(self, filepaths, rois=None, conf_threshold=0.6, render=True, imgsz=None):
+        """
+        Детекция списка файлов на всех рабочих процессах.
+
+        Args:
+            filepaths (list): Пути к файлам.
+            rois (list): Области интереса (None - весь кадр).
+            conf_threshold (float): Порог уверенности.
+            render (bool): Сохранять ли в результатах путь для ленивой отрисовки в родителе.
+            imgsz (int): Размер входа модели (None - размер детектора по умолчанию).
+
+        Returns:
+            list: DetectionResult (или None при ошибке) для каждого файла в порядке входа.
+        """
+        rois = list(rois) if rois is not None else [None] * len(filepaths)
+        detections = [None] * len(filepaths)
+        keys = [None] * len(filepaths)
+        cache = self.detector.cache
+
+        pending = []
+        for index, (filepath, roi) in enumerate(zip(filepaths, rois)):
+            if cache is not None:
+                try:
+                    keys[index], detections[index] = self.detector.cached_result(filepath, conf_threshold,
+                                                                                 roi, render, imgsz=imgsz)
+                except Exception as e:
+                    logger.warning(f"⚠️ Кэш детекций недоступен для {os.path.basename(filepath)}: {e}")
+            if detections[index] is None:
+                pending.append(index)
+
+        if not pending:
+            return detections
+
+        # Делим файлы поровну между процессами
+        chunk_size = -(-len(pending) // self.workers)
+        chunks = [pending[start:start + chunk_size] for start in range(0, len(pending), chunk_size)]
+        tasks = [([filepaths[i] for i in chunk], [rois[i] for i in chunk], conf_threshold, imgsz)
+                 for chunk in chunks]
+
+        for chunk, (results, frames, escalated) in zip(chunks, self.pool.imap(_detect_in_worker, tasks)):
+            self.detector.stats['frames'] += frames
+            self.detector.stats['escalated'] += escalated
+            for index, detection in zip(chunk, results):
+                if detection is None:
+                    continue
+                if cache is not None and keys[index] is not None:
+                    cache.put(keys[index], detection)
+                # Изображение с рамками родитель нарисует сам и только при обращении
+                detections[index] = DetectionResult(detection.boxes, detection.confidences, detection.class_ids,
+                                                     detection.names, source=filepaths[index] if render else None)
+
+        return detections
+
+    def close(self):
+        """Дожидается завершения рабочих процессов."""
+        self.pool.close()
+        self.pool.join()
@@ -22,6 +22,7 @@ logger = logging.getLogger(__name__)
 
 DB_CONFIG = config.DB_CONFIG
 TELEGRAM_CONFIG = config.TELEGRAM_CONFIG  # Конфиг Telegram
+TDM_SEND_WORKERS = getattr(config, 'TDM_SEND_WORKERS', 8)  # Сколько групп TDM оповещать одновременно
 
 # Инициализируем бота один раз
 telegram_bot = TelegramBot(TELEGRAM_CONFIG['token'], TELEGRAM_CONFIG['chat_id'])
@@ -143,6 +144,9 @@ def analyze_date():
         # base_dir = './fc_media/'
         # # base_dir = '/home/adm_1/foto_catcher/fc_media'
 
+        # Сообщения собираются для всех ловушек и отправляются разом: группы округов - параллельно,
+        # внутри группы - по порядку
+        messages = []
         for item_ in list_device_of_low_memory:
             date_last = item_[3]
             imei_id = item_[6]
@@ -154,12 +158,10 @@ def analyze_date():
                     group_id = i
                     break
 
-            tdm_success = tdm_bot.send_info_message(
-                group_id=group_id,
-                caption=f'В ловушке {imei_id} осталось места менне чем на {config.FREE_MEMORY} фото'
-            )
+            messages.append((group_id, f'В ловушке {imei_id} осталось места менне чем на {config.FREE_MEMORY} фото'))
 
-            logger.info(f"Результаты отправки: {tdm_success}")
+        tdm_results = tdm_bot.send_batch(messages, max_workers=TDM_SEND_WORKERS)
+        logger.info(f"Результаты отправки: {sum(tdm_results)} из {len(tdm_results)} сообщений доставлено")
 
 
             # try:
@@ -0,0 +1,110 @@
+# media_index.py
+import logging
+import os
+import threading
+import time
+
+''' Индекс файлов каталога fc_media: поиск без учета регистра без повторного чтения каталога '''
+
+logger = logging.getLogger(__name__)
+
+# Запас на грубую точность mtime (FAT, SMB, старые ext): изменения в ту же секунду, что и сканирование, не теряются
+MTIME_SLACK = 2.0
+
+
+class MediaIndex:
+    """
+    Отображение имени файла в нижнем регистре на реальный путь.
+
+    Каталог читается один раз при создании. При промахе индекс сверяет mtime
+    каталога и, только если каталог изменился, дочитывает его: новые файлы
+    добавляются, удаленные убираются, остальное не трогается. Поиск по
+    известному файлу не делает ни одного обращения к файловой системе.
+    """
+
+    def __init__(self, directory, extensions=None):
+        """
+        Args:
+            directory (str): Каталог с файлами.
+            extensions (tuple): Учитываемые расширения в нижнем регистре ('.jpg', ...); None - все файлы.
+        """
+        self.directory = directory
+        self.extensions = tuple(extensions) if extensions else None
+        self._names = set()
+        self._by_lower = {}
+        self._mtime = None
+        self._scanned_at = 0.0
+        self._lock = threading.Lock()
+        self.refresh(force=True)
+
+    def _wanted(self, name):
+        return self.extensions is None or name.lower().endswith(self.extensions)
+
+    def refresh(self, force=False):
+        """
+        Дочитывает каталог, если он изменился с прошлого сканирования.
+
+        Returns:
+            bool: Было ли выполнено сканирование.
+        """
+        with self._lock:
+            mtime = os.stat(self.directory).st_mtime
+            if not force and mtime == self._mtime and self._scanned_at > mtime + MTIME_SLACK:
+                return False
+
+            scanned_at = time.time()
+            with os.scandir(self.directory) as entries:
+                current = {entry.name for entry in entries if self._wanted(entry.name) and entry.is_file()}
+
+            added, removed = current - self._names, self._names - current
+            for name in removed:
+                lower = name.lower()
+                if self._by_lower.get(lower) == name:
+                    del self._by_lower[lower]
+            for name in sorted(added):
+                self._by_lower.setdefault(name.lower(), name)
+            if removed:
+                # Если удалили один из файлов, отличавшихся только регистром, - на его место встает оставшийся
+                for name in current:
+                    self._by_lower.setdefault(name.lower(), name)
+            self._names = current
+            self._mtime = mtime
+            self._scanned_at = scanned_at
+
+        if added or removed:
+            logger.debug(f"Индекс {self.directory}: +{len(added)} / -{len(removed)}, всего {len(current)}")
+        return True
+
+    def find(self, filename):
+        """
+        Путь к файлу без учета регистра имени.
+
+        Точное совпадение имени имеет приоритет. Если файла нет в индексе,
+        каталог дочитывается (только при изменившемся mtime) и поиск повторяется.
+
+        Returns:
+            str: Путь к файлу или None.
+        """
+        name = self._lookup(filename)
+        if name is None and self.refresh():
+            name = self._lookup(filename)
+        return os.path.join(self.directory, name) if name is not None else None
+
+    def _lookup(self, filename):
+        if filename in self._names:
+            return filename
+        return self._by_lower.get(filename.lower())
+
+    def __iter__(self):
+        """
+        Имена файлов индекса по одному, без упорядочивания.
+
+        Обход идет по снимку множества (список ссылок на уже хранимые строки):
+        refresh() в другом потоке может менять множество во время обхода.
+        """
+        with self._lock:
+            names = list(self._names)
+        return iter(names)
+
+    def __len__(self):
+        return len(self._names)
@@ -0,0 +1,263 @@
+# migrations.py
+import logging
+import time
+
+import config
+from db import get_pool
+
+''' Миграции схемы fotos_data: применяются по порядку один раз, номера примененных хранятся в schema_migrations '''
+
+logger = logging.getLogger(__name__)
+
+# Сколько строк обновлять одной транзакцией при заполнении новых столбцов
+MIGRATION_BATCH_SIZE = getattr(config, 'DB_MIGRATION_BATCH_SIZE', 10_000)
+# Ключ pg_advisory_lock: пока один анализатор применяет миграции, остальные ждут
+ADVISORY_LOCK_KEY = 0x666F746F  # 'foto'
+# Канал LISTEN/NOTIFY службы анализа (analyzer_service): триггер будит ее при вставке новых фото
+NOTIFY_CHANNEL = getattr(config, 'ANALYZER_NOTIFY_CHANNEL', 'fotos_data_new')
+
+_migrated = False
+
+
+def _column_type(cursor, column):
+    """Тип столбца fotos_data (None - столбца нет)."""
+    cursor.execute(
+        "SELECT data_type FROM information_schema.columns WHERE table_name = 'fotos_data' AND column_name = %s",
+        (column,)
+    )
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _backfill(conn, statement, batch_size=MIGRATION_BATCH_SIZE):
+    """
+    Выполняет UPDATE по диапазонам id, каждый диапазон - отдельной транзакцией.
+
+    Args:
+        conn: Соединение с БД.
+        statement (str): UPDATE с параметрами %(lo)s и %(hi)s - границами диапазона id.
+        batch_size (int): Ширина диапазона.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT min(id), max(id) FROM fotos_data")
+        low, high = cursor.fetchone()
+    conn.commit()
+    if low is None:
+        return
+
+    updated = 0
+    for lo in range(low, high + 1, batch_size):
+        with conn.cursor() as cursor:
+            cursor.execute(statement, {'lo': lo, 'hi': lo + batch_size - 1})
+            updated += cursor.rowcount
+        conn.commit()
+    logger.info(f"Заполнено строк: {updated} (id {low}-{high}, пачки по {batch_size})")
+
+
+def _primary_key(conn):
+    """Суррогатный ключ id: таблицу создает pandas.to_sql (mail_pusher) без первичного ключа."""
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT 1 FROM information_schema.table_constraints
+            WHERE table_name = 'fotos_data' AND constraint_type = 'PRIMARY KEY'
+        """)
+        if cursor.fetchone() is None:
+            cursor.execute("ALTER TABLE fotos_data ADD COLUMN IF NOT EXISTS id BIGSERIAL")
+            cursor.execute("ALTER TABLE fotos_data ADD PRIMARY KEY (id)")
+    conn.commit()
+
+
+def _claim_columns(conn):
+    """Аренда строк анализаторами: кто и до какого времени взял строку в работу."""
+    with conn.cursor() as cursor:
+        cursor.execute("ALTER TABLE fotos_data ADD COLUMN IF NOT EXISTS claimed_by TEXT")
+        cursor.execute("ALTER TABLE fotos_data ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMPTZ")
+    conn.commit()
+
+
+def _status_column(conn):
+    """
+    Статус обработки photo_status ('pending' / 'done') и частичный индекс по ожидающим строкам.
+
+    Существующие строки получают 'done' без перезаписи таблицы (значение по умолчанию
+    при добавлении столбца), новые - 'pending'. Затем по диапазонам id в 'pending'
+    переводятся строки с пустым info_detect. В индекс попадают только ожидающие
+    строки, поэтому поиск работы не зависит от размера истории.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_type WHERE typname = 'photo_status'")
+        if cursor.fetchone() is None:
+            cursor.execute("CREATE TYPE photo_status AS ENUM ('pending', 'done')")
+        if _column_type(cursor, 'status') is None:
+            # В одной транзакции: строки, вставленные между этими командами, не получат 'done'
+            cursor.execute("ALTER TABLE fotos_data ADD COLUMN status photo_status NOT NULL DEFAULT 'done'")
+            cursor.execute("ALTER TABLE fotos_data ALTER COLUMN status SET DEFAULT 'pending'")
+    conn.commit()
+
+    _backfill(conn, """
+        UPDATE fotos_data SET status = 'pending'
+        WHERE id BETWEEN %(lo)s AND %(hi)s AND status = 'done'
+          AND (info_detect IS NULL OR info_detect::text = '')
+    """)
+
+    # CREATE INDEX CONCURRENTLY не блокирует запись, но выполняется только вне транзакции
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS fotos_data_pending ON fotos_data (id) WHERE status = 'pending'"
+            )
+    finally:
+        conn.autocommit = False
+
+
+def _info_detect_jsonb(conn):
+    """
+    info_detect: TEXT -> JSONB.
+
+    Чтобы не переписывать всю таблицу под одной блокировкой, значения копируются
+    в новый столбец пачками по id, и только замена столбцов (с догоняющим
+    обновлением строк, записанных во время копирования) идет под блокировкой.
+    """
+    with conn.cursor() as cursor:
+        if _column_type(cursor, 'info_detect') == 'jsonb':
+            conn.commit()
+            return
+        cursor.execute("ALTER TABLE fotos_data ADD COLUMN IF NOT EXISTS info_detect_jsonb JSONB")
+    conn.commit()
+
+    _backfill(conn, """
+        UPDATE fotos_data SET info_detect_jsonb = info_detect::jsonb
+        WHERE id BETWEEN %(lo)s AND %(hi)s AND info_detect_jsonb IS NULL
+          AND info_detect IS NOT NULL AND info_detect <> ''
+    """)
+
+    with conn.cursor() as cursor:
+        cursor.execute("LOCK TABLE fotos_data IN ACCESS EXCLUSIVE MODE")
+        cursor.execute("""
+            UPDATE fotos_data SET info_detect_jsonb = info_detect::jsonb
+            WHERE info_detect_jsonb IS NULL AND info_detect IS NOT NULL AND info_detect <> ''
+        """)
+        cursor.execute("ALTER TABLE fotos_data DROP COLUMN info_detect")
+        cursor.execute("ALTER TABLE fotos_data RENAME COLUMN info_detect_jsonb TO info_detect")
+    conn.commit()
+
+
+def _notify_trigger(conn):
+    """
+    Триггер AFTER INSERT на fotos_data: pg_notify в канал службы анализа.
+
+    Срабатывает один раз на команду INSERT (mail_pusher вставляет вложения письма
+    одной командой), уведомление доставляется после фиксации транзакции.
+    """
+    channel = NOTIFY_CHANNEL.replace("'", "''")
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            CREATE OR REPLACE FUNCTION fotos_data_notify() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('{channel}', '');
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        """)
+        cursor.execute("DROP TRIGGER IF EXISTS fotos_data_notify ON fotos_data")
+        cursor.execute("""
+            CREATE TRIGGER fotos_data_notify AFTER INSERT ON fotos_data
+            FOR EACH STATEMENT EXECUTE PROCEDURE fotos_data_notify()
+        """)
+    conn.commit()
+
+
+# Порядок важен: каждая миграция рассчитывает на схему после предыдущих
+MIGRATIONS = [
+    ('0001_primary_key', _primary_key),
+    ('0002_claim_columns', _claim_columns),
+    ('0003_status_column', _status_column),
+    ('0004_info_detect_jsonb', _info_detect_jsonb),
+    ('0005_notify_trigger', _notify_trigger),
+]
+
+
+def _acquire_lock(conn):
+    """
+    Берет pg_advisory_lock миграций.
+
+    Ожидание - опросом pg_try_advisory_lock вне транзакции: заблокированный
+    в pg_advisory_lock сеанс держал бы открытую транзакцию, и CREATE INDEX
+    CONCURRENTLY в миграции ждал бы его завершения (взаимная блокировка).
+    """
+    conn.autocommit = True
+    try:
+        waiting = False
+        while True:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_try_advisory_lock(%s)", (ADVISORY_LOCK_KEY,))
+                if cursor.fetchone()[0]:
+                    return
+            if not waiting:
+                logger.info("⏳ Миграции применяет другой процесс, ждем...")
+                waiting = True
+            time.sleep(1)
+    finally:
+        conn.autocommit = False
+
+
+def migrate():
+    """
+    Применяет неприменённые миграции (один раз за процесс).
+
+    Миграции выполняются под pg_advisory_lock, поэтому несколько анализаторов,
+    запущенных одновременно, не применяют их параллельно.
+
+    Returns:
+        list: Номера примененных сейчас миграций.
+    """
+    global _migrated
+    if _migrated:
+        return []
+
+    pool = get_pool()
+    conn = pool.getconn()
+    applied_now = []
+    try:
+        _acquire_lock(conn)
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version TEXT PRIMARY KEY,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            """)
+            cursor.execute("SELECT version FROM schema_migrations")
+            applied = {row[0] for row in cursor.fetchall()}
+        conn.commit()
+
+        for version, migration in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info(f"🛠️ Миграция {version}...")
+            migration(conn)
+            with conn.cursor() as cursor:
+                cursor.execute("INSERT INTO schema_migrations (version) VALUES (%s)", (version,))
+            conn.commit()
+            applied_now.append(version)
+            logger.info(f"✅ Миграция {version} применена")
+        _migrated = True
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (ADVISORY_LOCK_KEY,))
+        conn.commit()
+        pool.putconn(conn)
+
+    return applied_now
+
+
+if __name__ == '__main__':
+    from logging_config import setup_logging
+    setup_logging()
+
+    applied = migrate()
+    logger.info(f"Применено миграций: {len(applied)}" + (f" ({', '.join(applied)})" if applied else ""))
@@ -0,0 +1,290 @@
+# model_export.py
+import hashlib
+import logging
+import os
+import random
+import shutil
+import tempfile
+
+import cv2
+import numpy as np
+
+from ultralytics import YOLO
+
+''' Экспорт весов YOLO в ONNX / OpenVINO и настройка CPU-бэкендов для TruckDetector '''
+
+logger = logging.getLogger(__name__)
+
+# Поддерживаемые бэкенды inference
+BACKENDS = ('torch', 'onnxruntime', 'openvino')
+
+# Формат экспорта ultralytics для каждого бэкенда
+EXPORT_FORMATS = {
+    'onnxruntime': 'onnx',
+    'openvino': 'openvino',
+}
+
+# Точность весов/вычислений экспортированной модели
+PRECISIONS = ('fp32', 'fp16', 'int8')
+
+# Каталог с фото ловушек - из него берется выборка для калибровки INT8
+DEFAULT_MEDIA_DIR = './fc_media'
+
+
+def weights_digest(model_path):
+    """SHA-256 файла весов - по нему определяем, что экспорт устарел."""
+    digest = hashlib.sha256()
+    with open(model_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def exported_path(model_path, backend, precision='fp32'):
+    """Путь к экспорту рядом с файлом .pt (для fp16/int8 - с суффиксом точности)."""
+    stem = os.path.splitext(model_path)[0]
+    if precision != 'fp32':
+        stem = f'{stem}_{precision}'
+    if backend == 'onnxruntime':
+        return f'{stem}.onnx'
+    if backend == 'openvino':
+        return f'{stem}_openvino_model'
+    raise ValueError(f"Неизвестный бэкенд: {backend} (допустимо {', '.join(BACKENDS)})")
+
+
+def sample_calibration_images(media_dir=DEFAULT_MEDIA_DIR, sample_size=200, seed=0):
+    """
+    Случайная выборка наших фото для калибровки INT8.
+
+    Args:
+        media_dir (str): Каталог с фото ловушек.
+        sample_size (int): Размер выборки.
+        seed (int): Зерно генератора, чтобы выборка была воспроизводимой.
+
+    Returns:
+        list: Пути к файлам jpg.
+    """
+    image_paths = sorted(
+        os.path.join(media_dir, name) for name in os.listdir(media_dir) if name.lower().endswith(('.jpg', '.jpeg'))
+    )
+    if not image_paths:
+        raise FileNotFoundError(f"В {media_dir} нет фото для калибровки")
+    random.Random(seed).shuffle(image_paths)
+    return image_paths[:sample_size]
+
+
+def letterbox_tensor(image, imgsz=640):
+    """Подготовка кадра BGR так же, как у ultralytics: letterbox 114, RGB, CHW, 0..1, батч из одного кадра."""
+    height, width = image.shape[:2]
+    ratio = min(imgsz / height, imgsz / width)
+    new_w, new_h = int(round(width * ratio)), int(round(height * ratio))
+    resized = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+
+    canvas = np.full((imgsz, imgsz, 3), 114, dtype=np.uint8)
+    top, left = (imgsz - new_h) // 2, (imgsz - new_w) // 2
+    canvas[top:top + new_h, left:left + new_w] = resized
+
+    tensor = canvas[:, :, ::-1].transpose(2, 0, 1).astype(np.float32) / 255.0
+    return np.ascontiguousarray(tensor[None])
+
+
+def _write_calibration_dataset(image_paths, names, work_dir):
+    """Датасет в формате ultralytics (только изображения) для калибровки INT8 через NNCF."""
+    images_dir = os.path.join(work_dir, 'images', 'val')
+    os.makedirs(images_dir, exist_ok=True)
+    for index, image_path in enumerate(image_paths):
+        shutil.copyfile(image_path, os.path.join(images_dir, f'{index:05d}.jpg'))
+
+    yaml_path = os.path.join(work_dir, 'calibration.yaml')
+    with open(yaml_path, 'w', encoding='utf-8') as f:
+        f.write(f"path: {os.path.abspath(work_dir)}\ntrain: images/val\nval: images/val\nnames:\n")
+        for class_id, name in sorted(names.items()):
+            f.write(f"  {class_id}: {name}\n")
+    return yaml_path
+
+
+def _quantize_onnx_int8(fp32_path, int8_path, image_paths, imgsz):
+    """
+    Статическая INT8-квантизация ONNX (QDQ) с калибровкой на наших фото.
+
+    Голова детекции (последний модуль /model.N/) остается в FP32: в ней в одном
+    тензоре склеены координаты рамок (до сотен пикселей) и вероятности классов (0..1),
+    и общий масштаб INT8 для них губит точность.
+    """
+    import onnx
+    from onnxruntime.quantization import (CalibrationDataReader, QuantFormat, QuantType,
+                                          quantize_static)
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    class _ImageReader(CalibrationDataReader):
+        def __init__(self, input_name):
+            self.input_name = input_name
+            self.paths = iter(image_paths)
+
+        def get_next(self):
+            for image_path in self.paths:
+                image = cv2.imdecode(np.fromfile(image_path, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if image is not None:
+                    return {self.input_name: letterbox_tensor(image, imgsz)}
+            return None
+
+    prepared_path = f'{int8_path}.prep.onnx'
+    quant_pre_process(fp32_path, prepared_path)
+    try:
+        model = onnx.load(prepared_path)
+        input_name = model.graph.input[0].name
+        module_ids = [int(node.name.split('/')[1].split('.')[1]) for node in model.graph.node
+                      if node.name.startswith('/model.') and node.name.split('/')[1].split('.')[1].isdigit()]
+        head_prefix = f'/model.{max(module_ids)}/' if module_ids else None
+        nodes_to_exclude = [node.name for node in model.graph.node
+                            if head_prefix and node.name.startswith(head_prefix)]
+
+        quantize_static(prepared_path, int8_path, _ImageReader(input_name),
+                        quant_format=QuantFormat.QDQ, activation_type=QuantType.QUInt8,
+                        weight_type=QuantType.QInt8, per_channel=True, nodes_to_exclude=nodes_to_exclude)
+    finally:
+        if os.path.exists(prepared_path):
+            os.remove(prepared_path)
+
+
+def _export(pt_model, model_path, backend, precision, imgsz, calibration_images):
+    """Экспорт модели в нужной точности; возвращает путь к результату."""
+    target = exported_path(model_path, backend, precision)
+
+    if backend == 'onnxruntime':
+        if precision == 'fp16':
+            raise ValueError("fp16 для onnxruntime на CPU не поддерживается: используйте openvino или int8")
+        # dynamic=True - модель принимает пачки любого размера (detect_trucks_batch)
+        fp32_path = pt_model.export(format=EXPORT_FORMATS[backend], imgsz=imgsz, dynamic=True, half=False)
+        if precision == 'int8':
+            _quantize_onnx_int8(fp32_path, target, calibration_images, imgsz)
+            return target
+        return fp32_path
+
+    # OpenVINO: FP16 - сжатие весов, INT8 - квантизация NNCF с калибровкой на наших фото
+    with tempfile.TemporaryDirectory() as work_dir:
+        options = {'format': 'openvino', 'imgsz': imgsz, 'dynamic': True, 'half': precision == 'fp16'}
+        if precision == 'int8':
+            options.update(int8=True, data=_write_calibration_dataset(calibration_images, pt_model.names, work_dir))
+        exported = pt_model.export(**options)
+
+    if os.path.abspath(exported) != os.path.abspath(target):
+        # ultralytics не различает fp32 и fp16 в имени каталога - переносим под свое имя
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        shutil.move(exported, target)
+    return target
+
+
+def export_model(model_path, backend, imgsz=640, precision='fp32', calibration_images=None):
+    """
+    Возвращает путь к модели для бэкенда, при необходимости выполняя экспорт.
+
+    Экспорт кэшируется на диске рядом с файлом .pt и пересобирается только
+    при изменении весов (рядом лежит файл .sha256 с хэшем исходного .pt и точностью).
+
+    Args:
+        model_path (str): Путь к весам .pt (скачиваются ultralytics, если файла нет).
+        backend (str): 'torch', 'onnxruntime' или 'openvino'.
+        imgsz (int): Размер входа модели при экспорте.
+        precision (str): 'fp32', 'fp16' (openvino) или 'int8'.
+        calibration_images (list): Фото для калибровки INT8 (None - выборка из fc_media).
+
+    Returns:
+        str: Путь к .pt (torch), .onnx или каталогу *_openvino_model.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Неизвестный бэкенд: {backend} (допустимо {', '.join(BACKENDS)})")
+    if precision not in PRECISIONS:
+        raise ValueError(f"Неизвестная точность: {precision} (допустимо {', '.join(PRECISIONS)})")
+    if backend == 'torch':
+        if precision != 'fp32':
+            raise ValueError("Квантизация доступна только для бэкендов onnxruntime и openvino")
+        return model_path
+
+    pt_model = None
+    if not os.path.exists(model_path):
+        # Стандартные веса (yolov8l.pt ...) ultralytics скачивает при загрузке
+        pt_model = YOLO(model_path)
+        model_path = pt_model.ckpt_path or model_path
+
+    target = exported_path(model_path, backend, precision)
+    stamp_path = f'{target}.sha256'
+    stamp = f'{weights_digest(model_path)}:{precision}'
+
+    if os.path.exists(target) and os.path.exists(stamp_path):
+        with open(stamp_path, encoding='utf-8') as f:
+            if f.read().strip() == stamp:
+                logger.info(f"Используем готовый экспорт {backend}/{precision}: {target}")
+                return target
+
+    if precision == 'int8' and calibration_images is None:
+        calibration_images = sample_calibration_images()
+
+    logger.info(f"Экспорт {model_path} в формат {backend}/{precision} (imgsz={imgsz})...")
+    if pt_model is None:
+        pt_model = YOLO(model_path)
+    target = _export(pt_model, model_path, backend, precision, imgsz, calibration_images)
+
+    with open(f'{target}.sha256', 'w', encoding='utf-8') as f:
+        f.write(stamp)
+    logger.info(f"Экспорт готов: {target}")
+    return target
+
+
+def configure_backend(model, backend, model_file, options=None):
+    """
+    Пересоздает сессию экспортированной модели с заданными настройками потоков.
+
+    ultralytics создает сессию ONNX Runtime / OpenVINO с настройками по умолчанию
+    при первом predict. Здесь она заменяется на сессию с нашими параметрами.
+    Вызывать после первого (прогревочного) predict.
+
+    Args:
+        model (ultralytics.YOLO): Модель, загруженная из экспортированного файла.
+        backend (str): 'onnxruntime' или 'openvino'.
+        model_file (str): Путь к .onnx или каталогу *_openvino_model.
+        options (dict): Для onnxruntime - intra_op_num_threads, inter_op_num_threads,
+                        execution_mode ('sequential'/'parallel'), graph_optimization_level
+                        ('basic'/'extended'/'all'). Для openvino - свойства компиляции
+                        (INFERENCE_NUM_THREADS, PERFORMANCE_HINT, NUM_STREAMS ...).
+    """
+    if not options or backend == 'torch':
+        return
+
+    auto_backend = model.predictor.model if model.predictor is not None else None
+    if auto_backend is None:
+        raise RuntimeError("Модель еще не инициализирована: сначала выполните прогревочный predict")
+
+    if backend == 'onnxruntime':
+        import onnxruntime
+
+        session_options = onnxruntime.SessionOptions()
+        if 'intra_op_num_threads' in options:
+            session_options.intra_op_num_threads = int(options['intra_op_num_threads'])
+        if 'inter_op_num_threads' in options:
+            session_options.inter_op_num_threads = int(options['inter_op_num_threads'])
+        if options.get('execution_mode') == 'parallel':
+            session_options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+        if 'graph_optimization_level' in options:
+            session_options.graph_optimization_level = {
+                'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+                'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+                'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+            }[options['graph_optimization_level']]
+
+        auto_backend.session = onnxruntime.InferenceSession(
+            model_file, sess_options=session_options, providers=['CPUExecutionProvider']
+        )
+    elif backend == 'openvino':
+        import openvino as ov
+
+        xml_files = [name for name in os.listdir(model_file) if name.endswith('.xml')]
+        if not xml_files:
+            raise FileNotFoundError(f"В {model_file} нет модели OpenVINO (*.xml)")
+        core = ov.Core()
+        ov_model = core.read_model(os.path.join(model_file, xml_files[0]))
+        config = {key: str(value) for key, value in options.items()}
+        auto_backend.ov_compiled_model = core.compile_model(ov_model, device_name='CPU', config=config)
+
+    logger.info(f"Сессия {backend} пересоздана с настройками: {options}")
@@ -0,0 +1,520 @@
+# notify_outbox.py
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+''' Постоянная очередь оповещений (SQLite в каталоге fc_media) и фоновая отправка в мессенджеры '''
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTBOX_PATH = './fc_media/notify_outbox.sqlite3'
+
+
+class Delivery(NamedTuple):
+    """Доставка одного оповещения в один канал."""
+    alert_id: int
+    channel: str
+    target: object
+    caption: str
+    image: bytes
+    attempts: int
+    imei: str
+
+
+class NotificationOutbox:
+    """
+    Постоянная очередь оповещений.
+
+    Оповещение (JPEG, подпись, ловушка) сохраняется один раз, а для каждого
+    канала (Telegram, TDM) заводится своя доставка со статусом, числом попыток,
+    временем следующей попытки и последней ошибкой. Взятая в отправку доставка
+    получает аренду: если процесс умер на середине отправки, после ее истечения
+    доставку снова возьмет отправитель (этого или следующего запуска). Аренда
+    должна быть длиннее самой долгой отправки (со всеми повторами внутри
+    клиента мессенджера), иначе другой процесс отправит оповещение повторно. Файл
+    можно использовать из нескольких процессов - доставки берутся в отдельной
+    транзакции BEGIN IMMEDIATE.
+
+    Оповещения одной ловушки в один и тот же чат/группу, пришедшие в течение
+    окна объединения, берутся в отправку одной пачкой (альбомом, см. take_due).
+    """
+
+    def __init__(self, path=DEFAULT_OUTBOX_PATH, keep_days=7, sending_lease=300):
+        """
+        Args:
+            path (str): Файл базы SQLite.
+            keep_days (int): Сколько дней хранить полностью обработанные оповещения.
+            sending_lease (float): Аренда доставки на время отправки (секунды) - больше самой долгой отправки.
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.keep_days = keep_days
+        self.sending_lease = sending_lease
+        self._lock = threading.Lock()
+
+        # isolation_level=None: транзакциями управляем сами (BEGIN IMMEDIATE при взятии доставок)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS alerts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                imei TEXT,
+                caption TEXT NOT NULL,
+                image BLOB NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        # target без типа: ID чата/группы хранится как есть (число или строка)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS deliveries (
+                alert_id INTEGER NOT NULL REFERENCES alerts (id) ON DELETE CASCADE,
+                channel TEXT NOT NULL,
+                target NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                sent_at REAL,
+                PRIMARY KEY (alert_id, channel)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS deliveries_due ON deliveries (status, next_attempt_at)")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        logger.info(f"Очередь оповещений: {path}")
+        self.purge()
+
+    def enqueue(self, image, caption, imei, targets, hold=0):
+        """
+        Сохраняет оповещение и заводит доставку в каждый канал.
+
+        Args:
+            image (bytes): Готовый JPEG.
+            caption (str): Подпись.
+            imei (str): ID ловушки.
+            targets (dict): {канал: ID чата/группы}.
+            hold (float): Отложить первую попытку на столько секунд - чтобы собрать следующие
+                          кадры серии в один альбом.
+
+        Returns:
+            int: ID оповещения.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                alert_id = self._conn.execute(
+                    "INSERT INTO alerts (imei, caption, image, created_at) VALUES (?, ?, ?, ?)",
+                    (imei, caption, sqlite3.Binary(image), now)
+                ).lastrowid
+                self._conn.executemany(
+                    "INSERT INTO deliveries (alert_id, channel, target, next_attempt_at) VALUES (?, ?, ?, ?)",
+                    [(alert_id, channel, target, now + hold) for channel, target in targets.items()]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return alert_id
+
+    def take_due(self, limit, group_channels=(), window=0, max_group=1, include_held=False,
+                 channel_limits=None, exclude=()):
+        """
+        Берет в отправку до limit пачек доставок, время которых пришло.
+
+        Сюда же попадают доставки в статусе sending с истекшей арендой
+        (процесс, который их отправлял, завершился на середине). Доставки из
+        exclude вызывающий еще отправляет сам - они не берутся, даже если аренда истекла.
+
+        Для каналов из group_channels к подошедшей доставке добавляются ожидающие
+        доставки того же канала, получателя и ловушки, созданные не позже чем через
+        window секунд после нее (всего не больше max_group) - такие пачки
+        отправляются одним сообщением.
+
+        Args:
+            limit (int): Максимум пачек.
+            group_channels (tuple): Каналы, поддерживающие отправку пачкой.
+            window (float): Окно объединения (секунды).
+            max_group (int): Максимальный размер пачки.
+            include_held (bool): Брать и отложенные для объединения первые попытки (при завершении работы).
+            channel_limits (dict): Максимум пачек по каналам {канал: n}; каналы, которых нет, - без ограничения.
+            exclude (set): Доставки (alert_id, канал), которые еще отправляются.
+
+        Returns:
+            list: Пачки - списки Delivery в порядке создания оповещений.
+        """
+        if limit <= 0:
+            return []
+        channel_limits = dict(channel_limits or {})
+        full = tuple(channel for channel, free in channel_limits.items() if free <= 0)
+        now = time.time()
+        columns = "d.alert_id, d.channel, d.target, a.caption, a.image, d.attempts, a.imei, a.created_at"
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Отправляемые доставки из exclude отбрасываются ниже - выбираем с запасом на них
+                rows = self._conn.execute(
+                    f"""
+                    SELECT {columns}
+                    FROM deliveries AS d JOIN alerts AS a ON a.id = d.alert_id
+                    WHERE d.status IN ('pending', 'sending')
+                      AND (d.next_attempt_at <= ? OR (? AND d.status = 'pending' AND d.attempts = 0))
+                      AND d.channel NOT IN ({', '.join('?' * len(full))})
+                    ORDER BY d.alert_id
+                    LIMIT ?
+                    """,
+                    (now, include_held, *full, limit + len(exclude))
+                ).fetchall()
+
+                batches, taken = [], set()
+                for row in rows:
+                    if len(batches) >= limit:
+                        break
+                    if row[:2] in taken or row[:2] in exclude or channel_limits.get(row[1], 1) <= 0:
+                        continue
+                    if row[1] in channel_limits:
+                        channel_limits[row[1]] -= 1
+                    batch = [row]
+                    taken.add(row[:2])
+                    alert_id, channel, target, imei, created_at = row[0], row[1], row[2], row[6], row[7]
+                    if channel in group_channels and max_group > 1:
+                        siblings = self._conn.execute(
+                            f"""
+                            SELECT {columns}
+                            FROM deliveries AS d JOIN alerts AS a ON a.id = d.alert_id
+                            WHERE d.status = 'pending' AND d.channel = ? AND d.target = ? AND a.imei IS ?
+                              AND a.created_at BETWEEN ? AND ? AND d.alert_id <> ?
+                            ORDER BY d.alert_id
+                            LIMIT ?
+                            """,
+                            (channel, target, imei, created_at, created_at + window, alert_id, max_group - 1)
+                        ).fetchall()
+                        for sibling in siblings:
+                            if sibling[:2] not in taken and sibling[:2] not in exclude and len(batch) < max_group:
+                                batch.append(sibling)
+                                taken.add(sibling[:2])
+                    batches.append(batch)
+
+                self._conn.executemany(
+                    "UPDATE deliveries SET status = 'sending', next_attempt_at = ? WHERE alert_id = ? AND channel = ?",
+                    [(now + self.sending_lease, alert_id, channel) for alert_id, channel in taken]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [[Delivery(alert_id, channel, target, caption, bytes(image), attempts, imei)
+                 for alert_id, channel, target, caption, image, attempts, imei, _ in batch]
+                for batch in batches]
+
+    def _update(self, statement, params):
+        with self._lock:
+            self._conn.execute(statement, params)
+
+    def mark_sent(self, delivery):
+        """Доставка выполнена."""
+        self._update(
+            "UPDATE deliveries SET status = 'sent', attempts = attempts + 1, sent_at = ?, last_error = NULL "
+            "WHERE alert_id = ? AND channel = ?",
+            (time.time(), delivery.alert_id, delivery.channel)
+        )
+
+    def mark_retry(self, delivery, error, delay):
+        """Доставка не удалась - повторить через delay секунд."""
+        self._update(
+            "UPDATE deliveries SET status = 'pending', attempts = attempts + 1, next_attempt_at = ?, last_error = ? "
+            "WHERE alert_id = ? AND channel = ?",
+            (time.time() + delay, error, delivery.alert_id, delivery.channel)
+        )
+
+    def mark_failed(self, delivery, error):
+        """Доставка окончательно не удалась (попытки исчерпаны)."""
+        self._update(
+            "UPDATE deliveries SET status = 'failed', attempts = attempts + 1, last_error = ? "
+            "WHERE alert_id = ? AND channel = ?",
+            (error, delivery.alert_id, delivery.channel)
+        )
+
+    def counts(self):
+        """Количество доставок по каналам и статусам: {канал: {статус: n}}."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT channel, status, count(*) FROM deliveries GROUP BY channel, status"
+            ).fetchall()
+        counts = {}
+        for channel, status, count in rows:
+            counts.setdefault(channel, {})[status] = count
+        return counts
+
+    def next_due_in(self, include_held=False, skip_channels=(), exclude=()):
+        """
+        Через сколько секунд подойдет ближайшая доставка (None - ожидающих нет).
+
+        include_held - отложенные для объединения первые попытки считать подошедшими (см. take_due);
+        доставки каналов skip_channels и доставки из exclude (еще отправляются) не учитываются.
+        """
+        skip_channels = tuple(skip_channels)
+        with self._lock:
+            rows = self._conn.execute(
+                f"""
+                SELECT alert_id, channel,
+                       CASE WHEN ? AND status = 'pending' AND attempts = 0 THEN 0 ELSE next_attempt_at END AS due
+                FROM deliveries
+                WHERE status IN ('pending', 'sending') AND channel NOT IN ({', '.join('?' * len(skip_channels))})
+                ORDER BY due
+                LIMIT ?
+                """,
+                (include_held, *skip_channels, len(exclude) + 1)
+            ).fetchall()
+        due = next((row[2] for row in rows if row[:2] not in exclude), None)
+        return None if due is None else max(0.0, due - time.time())
+
+    def purge(self):
+        """Удаляет оповещения старше keep_days, все доставки которых завершены (sent / failed)."""
+        with self._lock:
+            removed = self._conn.execute(
+                """
+                DELETE FROM alerts WHERE created_at < ? AND NOT EXISTS (
+                    SELECT 1 FROM deliveries WHERE alert_id = alerts.id AND status IN ('pending', 'sending')
+                )
+                """,
+                (time.time() - self.keep_days * 86400,)
+            ).rowcount
+        if removed:
+            logger.info(f"Очередь оповещений: удалено {removed} старых оповещений")
+        return removed
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class OutboxSender:
+    """
+    Фоновая отправка оповещений из NotificationOutbox.
+
+    Отдельный поток берет подошедшие доставки и отправляет их в пуле из
+    max_workers потоков, поэтому медленный или недоступный мессенджер не
+    задерживает анализ. Неудачная доставка повторяется с экспоненциально
+    растущей задержкой (base_delay * 2^попытка, не больше max_delay, со
+    случайным разбросом), после max_attempts попыток получает статус failed.
+
+    При coalesce_window > 0 первая попытка откладывается на это время, и серия
+    кадров одной ловушки в один чат/группу уходит одним сообщением через
+    group_channels (альбом, коллаж) - не больше max_group кадров в сообщении.
+
+    channel_workers ограничивает одновременные отправки в отдельный канал:
+    зависший мессенджер не занимает все потоки. Доставки, которые этот процесс
+    еще отправляет, не берутся повторно, даже если их аренда истекла.
+
+    Раз в purge_interval секунд поток отправки удаляет старые обработанные
+    оповещения (NotificationOutbox.purge) - файл очереди долго работающей
+    службы не растет без ограничений.
+    """
+
+    def __init__(self, outbox, channels, max_workers=4, max_attempts=8, base_delay=5.0, max_delay=600.0,
+                 poll_interval=5.0, group_channels=None, coalesce_window=0, max_group=10, channel_workers=None,
+                 purge_interval=3600):
+        """
+        Args:
+            outbox (NotificationOutbox): Очередь оповещений.
+            channels (dict): {канал: send(target, image, caption) -> bool}.
+            max_workers (int): Сколько доставок выполнять одновременно.
+            max_attempts (int): Максимум попыток на доставку.
+            base_delay (float): Задержка перед первым повтором (секунды).
+            max_delay (float): Максимальная задержка между повторами (секунды).
+            poll_interval (float): Как часто проверять очередь без сигнала wake (секунды).
+            group_channels (dict): {канал: send_group(target, images, captions) -> bool} для отправки пачкой.
+            coalesce_window (float): Окно объединения кадров одной ловушки (секунды; 0 - не объединять).
+            max_group (int): Максимум кадров в одном сообщении.
+            channel_workers (dict): {канал: сколько доставок в него выполнять одновременно}; по умолчанию - max_workers.
+            purge_interval (float): Как часто удалять старые обработанные оповещения (секунды; None - не удалять).
+        """
+        self.outbox = outbox
+        self.channels = channels
+        self.group_channels = group_channels or {}
+        self.max_workers = max(1, int(max_workers))
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.coalesce_window = coalesce_window if self.group_channels else 0
+        self.max_group = max(1, int(max_group))
+        self.channel_workers = {channel: max(1, min(self.max_workers, int(workers)))
+                                for channel, workers in (channel_workers or {}).items()}
+        self.purge_interval = purge_interval
+
+        self._executor = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        # Взведен при завершении: отложенные для объединения доставки отправляются сразу
+        self._flushing = threading.Event()
+        self._in_flight = 0
+        # Отправляемые сейчас доставки (alert_id, канал) и число отправляемых пачек по каналам
+        self._sending = set()
+        self._channel_in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        # NotificationOutbox.purge вызывается при создании очереди - следующая очистка через purge_interval
+        self._last_purge = time.monotonic()
+
+    def start(self):
+        """Запускает фоновую отправку."""
+        if self._thread is not None:
+            return self
+        self._stop.clear()
+        self._flushing.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='outbox-send')
+        self._thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+        self._thread.start()
+        logger.info(f"Отправка оповещений запущена: каналы {', '.join(self.channels)}, потоков {self.max_workers}"
+                    + (f", объединение за {self.coalesce_window} с (до {self.max_group} кадров)"
+                       if self.coalesce_window else ""))
+        return self
+
+    def enqueue(self, image, caption, imei, targets):
+        """Ставит оповещение в очередь и будит отправителя (см. NotificationOutbox.enqueue)."""
+        alert_id = self.outbox.enqueue(image, caption, imei, targets, hold=self.coalesce_window)
+        self._wake.set()
+        return alert_id
+
+    def _purge_if_due(self):
+        """Удаляет старые обработанные оповещения, если с прошлой очистки прошло purge_interval секунд."""
+        if not self.purge_interval or time.monotonic() - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = time.monotonic()
+        try:
+            self.outbox.purge()
+        except Exception as e:
+            logger.error(f"❌ Очередь оповещений: не удалось удалить старые оповещения: {e}")
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._purge_if_due()
+            try:
+                flushing = self._flushing.is_set()
+                with self._in_flight_lock:
+                    free = self.max_workers - self._in_flight
+                    channel_free = {channel: workers - self._channel_in_flight.get(channel, 0)
+                                    for channel, workers in self.channel_workers.items()}
+                    sending = set(self._sending)
+                batches = self.outbox.take_due(free, tuple(self.group_channels), self.coalesce_window,
+                                               self.max_group, include_held=flushing,
+                                               channel_limits=channel_free, exclude=sending)
+                for batch in batches:
+                    channel = batch[0].channel
+                    with self._in_flight_lock:
+                        self._in_flight += 1
+                        self._channel_in_flight[channel] = self._channel_in_flight.get(channel, 0) + 1
+                        self._sending.update((delivery.alert_id, channel) for delivery in batch)
+                        if channel in channel_free:
+                            channel_free[channel] -= 1
+                    self._executor.submit(self._deliver, batch)
+
+                if len(batches) >= free:
+                    # Все потоки заняты - ждем, пока какой-то освободится (_deliver будит поток)
+                    timeout = self.poll_interval
+                else:
+                    # Каналы, где все места заняты, и еще отправляемые доставки ждут _deliver
+                    full = [channel for channel, channel_left in channel_free.items() if channel_left <= 0]
+                    with self._in_flight_lock:
+                        sending = set(self._sending)
+                    next_due = self.outbox.next_due_in(include_held=flushing, skip_channels=full, exclude=sending)
+                    timeout = self.poll_interval if next_due is None else min(self.poll_interval, next_due)
+            except Exception as e:
+                logger.error(f"❌ Очередь оповещений: {e}")
+                timeout = self.poll_interval
+            self._wake.wait(timeout)
+            self._wake.clear()
+
+    def _send(self, batch):
+        """Отправляет пачку доставок одного канала и получателя одним сообщением."""
+        channel, target = batch[0].channel, batch[0].target
+        if len(batch) > 1:
+            return self.group_channels[channel](target, [delivery.image for delivery in batch],
+                                                [delivery.caption for delivery in batch])
+        send = self.channels.get(channel)
+        if send is None:
+            raise KeyError(f"неизвестный канал {channel}")
+        return send(target, batch[0].image, batch[0].caption)
+
+    def _deliver(self, batch):
+        head = batch[0]
+        ids = ', '.join(str(delivery.alert_id) for delivery in batch)
+        # Пачка повторяется целиком - попытки считаем по самой "старой" доставке
+        attempts = max(delivery.attempts for delivery in batch)
+        permanent = head.channel not in self.channels and head.channel not in self.group_channels
+        try:
+            ok, error = bool(self._send(batch)), 'отправка не удалась'
+        except Exception as e:
+            ok, error = False, f"{type(e).__name__}: {e}"
+
+        try:
+            if ok:
+                for delivery in batch:
+                    self.outbox.mark_sent(delivery)
+                logger.info(f"✅ Оповещения {ids} доставлены: {head.channel} ({head.target})"
+                            + (f", одним сообщением из {len(batch)} кадров" if len(batch) > 1 else ""))
+            elif attempts + 1 >= self.max_attempts or permanent:
+                for delivery in batch:
+                    self.outbox.mark_failed(delivery, error)
+                logger.error(f"❌ Оповещения {ids} не доставлены в {head.channel} "
+                             f"после {attempts + 1} попыток: {error}")
+            else:
+                delay = min(self.max_delay, self.base_delay * 2 ** attempts) * random.uniform(0.8, 1.2)
+                for delivery in batch:
+                    self.outbox.mark_retry(delivery, error, delay)
+                logger.warning(f"⚠️ Оповещения {ids} ({head.channel}): {error}, повтор через {delay:.0f} с")
+        except Exception as e:
+            # Статус не записан - после истечения аренды доставки будут взяты снова
+            logger.error(f"❌ Очередь оповещений: не удалось записать статус доставки {ids}: {e}")
+        finally:
+            with self._in_flight_lock:
+                self._in_flight -= 1
+                self._channel_in_flight[head.channel] -= 1
+                self._sending.difference_update((delivery.alert_id, delivery.channel) for delivery in batch)
+            self._wake.set()
+
+    def drain(self, timeout):
+        """
+        Ждет отправки подошедших доставок, но не дольше timeout секунд.
+
+        Отложенные для объединения доставки отправляются сразу (серия уже не
+        пополнится). Доставки, ожидающие повтора позже, не ждем - они останутся в очереди.
+
+        Returns:
+            bool: Все подошедшие доставки отправлены.
+        """
+        self._flushing.set()
+        self._wake.set()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._in_flight_lock:
+                in_flight = self._in_flight
+            next_due = self.outbox.next_due_in(include_held=True)
+            if not in_flight and (next_due is None or next_due > 0):
+                return True
+            time.sleep(0.1)
+        return False
+
+    def stop(self, drain_timeout=0):
+        """
+        Останавливает отправку: ждет начатые доставки, неотправленное остается в очереди.
+
+        Args:
+            drain_timeout (float): Сколько секунд дать на отправку уже подошедших доставок.
+        """
+        if self._thread is None:
+            return
+        if drain_timeout:
+            self.drain(drain_timeout)
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+        self._thread = self._executor = None
+        logger.info(f"Отправка оповещений остановлена, доставки: {self.outbox.counts()}")
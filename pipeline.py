@@ -0,0 +1,202 @@
+# pipeline.py
+import logging
+import queue
+import threading
+import time
+
+''' Конвейер из стадий на потоках, связанных ограниченными очередями (с обратным давлением) '''
+
+logger = logging.getLogger(__name__)
+
+# Маркер конца потока данных: каждая стадия получает по одному на каждый свой поток
+_DONE = object()
+
+
+class Stage:
+    """Стадия конвейера: обработчик, потоки и входная очередь."""
+
+    def __init__(self, name, handler, threads=1, queue_size=16, batch_size=1, batch_wait=0.05,
+                 idle_interval=None, on_idle=None, on_close=None):
+        """
+        Args:
+            name (str): Имя стадии (по нему в нее отправляют элементы).
+            handler (callable): handler(item) или handler(list) при batch_size > 1.
+            threads (int): Количество потоков стадии.
+            queue_size (int): Размер входной очереди; при заполнении отправитель ждет.
+            batch_size (int): Сколько элементов собирать в пачку для одного вызова handler.
+            batch_wait (float): Сколько ждать добора пачки после первого элемента (секунды).
+            idle_interval (float): Как часто вызывать on_idle, если элементов нет (секунды).
+            on_idle (callable): Вызывается при простое (например, сброс накопленной записи).
+            on_close (callable): Вызывается один раз после завершения всех потоков стадии.
+        """
+        self.name = name
+        self.handler = handler
+        self.threads = max(1, int(threads))
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = max(1, int(batch_size))
+        self.batch_wait = batch_wait
+        self.idle_interval = idle_interval
+        self.on_idle = on_idle
+        self.on_close = on_close
+
+        self.processed = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self._running = 0
+        self._lock = threading.Lock()
+
+
+class Pipeline:
+    """
+    Конвейер: источник и последовательность стадий.
+
+    Каждая стадия работает в своих потоках и читает свою ограниченную очередь.
+    Элементы передаются только вперед по порядку стадий (через emit), поэтому
+    стадия завершается, когда завершились все предыдущие и ее очередь пуста.
+    Ошибка в обработчике записывается в лог и счетчик ошибок, элемент
+    пропускается, а конвейер продолжает работу.
+    """
+
+    def __init__(self, name='pipeline'):
+        self.name = name
+        self.stages = []
+        self._by_name = {}
+        self._threads = []
+
+    def add_stage(self, name, handler, **options):
+        """Добавляет стадию в конец конвейера (параметры - см. Stage)."""
+        stage = Stage(name, handler, **options)
+        self.stages.append(stage)
+        self._by_name[name] = stage
+        return stage
+
+    def emit(self, stage_name, item):
+        """Отправляет элемент в стадию; ждет, если ее очередь заполнена."""
+        self._by_name[stage_name].queue.put(item)
+
+    def queue_depths(self):
+        """Текущая длина и размер входной очереди каждой стадии: {имя: (длина, максимум)}."""
+        return {stage.name: (stage.queue.qsize(), stage.queue.maxsize) for stage in self.stages}
+
+    def stats(self):
+        """Счетчики стадий: очередь (длина/максимум), обработано, ошибок, время в обработчике."""
+        return {
+            stage.name: {
+                'queue': stage.queue.qsize(),
+                'queue_max': stage.queue.maxsize,
+                'processed': stage.processed,
+                'errors': stage.errors,
+                'busy_s': round(stage.busy_seconds, 2),
+            }
+            for stage in self.stages
+        }
+
+    def _next_batch(self, stage):
+        """Следующий элемент или пачка; (items, done) - done, если получен маркер конца."""
+        while True:
+            try:
+                item = stage.queue.get(timeout=stage.idle_interval)
+                break
+            except queue.Empty:
+                self._call(stage, stage.on_idle)
+        if item is _DONE:
+            return [], True
+
+        items = [item]
+        deadline = time.monotonic() + stage.batch_wait
+        while len(items) < stage.batch_size:
+            try:
+                item = stage.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is _DONE:
+                return items, True
+            items.append(item)
+        return items, False
+
+    def _call(self, stage, callback, *args):
+        if callback is None:
+            return
+        try:
+            callback(*args)
+        except Exception as e:
+            stage.errors += 1
+            logger.error(f"❌ Стадия {stage.name}: {e}")
+
+    def _run_stage(self, index):
+        stage = self.stages[index]
+        done = False
+        while not done:
+            items, done = self._next_batch(stage)
+            if not items:
+                continue
+            started = time.monotonic()
+            if stage.batch_size > 1:
+                self._call(stage, stage.handler, items)
+            else:
+                for item in items:
+                    self._call(stage, stage.handler, item)
+            with stage._lock:
+                stage.busy_seconds += time.monotonic() - started
+                stage.processed += len(items)
+        self._finish_thread(index)
+
+    def _finish_thread(self, index):
+        """Последний завершившийся поток стадии закрывает ее и передает маркеры конца следующей."""
+        stage = self.stages[index]
+        with stage._lock:
+            stage._running -= 1
+            last = stage._running == 0
+        if not last:
+            return
+        self._call(stage, stage.on_close)
+        if index + 1 < len(self.stages):
+            following = self.stages[index + 1]
+            for _ in range(following.threads):
+                following.queue.put(_DONE)
+
+    def _run_source(self, source):
+        first = self.stages[0]
+        try:
+            for item in source:
+                first.queue.put(item)
+        except Exception as e:
+            logger.error(f"❌ Источник конвейера {self.name}: {e}")
+        finally:
+            for _ in range(first.threads):
+                first.queue.put(_DONE)
+
+    def run(self, source, stats_interval=30.0):
+        """
+        Прогоняет элементы источника через все стадии и ждет завершения.
+
+        Args:
+            source (iterable): Источник элементов для первой стадии (читается в отдельном потоке).
+            stats_interval (float): Как часто писать в лог глубину очередей (секунды; None - не писать).
+
+        Returns:
+            dict: Итоговые счетчики стадий (см. stats).
+        """
+        for index, stage in enumerate(self.stages):
+            stage._running = stage.threads
+            for number in range(stage.threads):
+                thread = threading.Thread(target=self._run_stage, args=(index,),
+                                          name=f'{self.name}-{stage.name}-{number}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+        source_thread = threading.Thread(target=self._run_source, args=(source,),
+                                         name=f'{self.name}-source', daemon=True)
+        source_thread.start()
+
+        last_report = time.monotonic()
+        for thread in [source_thread] + self._threads:
+            while thread.is_alive():
+                thread.join(timeout=1.0)
+                if stats_interval and time.monotonic() - last_report >= stats_interval:
+                    last_report = time.monotonic()
+                    depths = ', '.join(f"{name}={size}/{maxsize}"
+                                       for name, (size, maxsize) in self.queue_depths().items())
+                    logger.info(f"📊 Очереди {self.name}: {depths}")
+        self._threads = []
+        return self.stats()
@@ -0,0 +1,114 @@
+import argparse
+import json
+import logging
+import sys
+import time
+
+import numpy as np
+
+from logging_config import setup_logging
+from model_export import PRECISIONS, export_model, sample_calibration_images
+from truck_detector import TruckDetector
+from detection_metrics import compare_detections
+
+''' Квантизация модели (FP16 / INT8) с калибровкой на наших фото и сравнение с FP32 по точности и скорости '''
+
+logger = logging.getLogger('quantize_model')
+
+
+def measure(detector, image_paths, conf_threshold):
+    """
+    Детекция файлов по одному с замером времени.
+
+    Returns:
+        tuple: Список DetectionResult и время на кадр (секунды) для каждого файла.
+    """
+    # Прогрев: первые вызовы включают инициализацию бэкенда
+    detector.detect_truck(image_paths[0], conf_threshold=conf_threshold, render=False)
+
+    detections, timings = [], []
+    for image_path in image_paths:
+        started = time.perf_counter()
+        detections.append(detector.detect_truck(image_path, conf_threshold=conf_threshold, render=False))
+        timings.append(time.perf_counter() - started)
+    return detections, timings
+
+
+def compare_precisions(model_path, backend, calibration_images, eval_images, precisions, conf_threshold=0.6):
+    """
+    Экспортирует модель в каждой точности и сравнивает с FP32 того же бэкенда.
+
+    Калибровочные и проверочные фото не пересекаются, чтобы оценка не была завышена.
+
+    Returns:
+        dict: Отчет по каждой точности: задержка (средняя, p50, p95, мс), совпадение рамок с FP32
+              (найдено / пропущено / лишние, минимальный IoU, максимальная разница уверенности).
+    """
+    report = {}
+    reference = None
+    for precision in ['fp32'] + [p for p in precisions if p != 'fp32']:
+        export_model(model_path, backend, precision=precision, calibration_images=calibration_images)
+        detector = TruckDetector(model_path, backend=backend, precision=precision)
+        detections, timings = measure(detector, eval_images, conf_threshold)
+        timings_ms = np.array(timings) * 1000
+
+        item = {
+            'mean_ms': round(float(timings_ms.mean()), 2),
+            'p50_ms': round(float(np.percentile(timings_ms, 50)), 2),
+            'p95_ms': round(float(np.percentile(timings_ms, 95)), 2),
+        }
+        if reference is None:
+            reference = detections
+        else:
+            matched = missed = extra = 0
+            min_iou, max_conf_diff = 1.0, 0.0
+            for ref, cand in zip(reference, detections):
+                result = compare_detections(ref, cand, iou_threshold=0.5)
+                matched += result['matched']
+                missed += result['missed']
+                extra += result['extra']
+                min_iou = min(min_iou, result['min_iou'])
+                max_conf_diff = max(max_conf_diff, result['max_conf_diff'])
+            item.update(matched=matched, missed=missed, extra=extra,
+                        recall_vs_fp32=round(matched / (matched + missed), 4) if matched + missed else None,
+                        min_iou=round(min_iou, 4), max_conf_diff=round(max_conf_diff, 4),
+                        speedup=round(report['fp32']['mean_ms'] / item['mean_ms'], 2))
+        report[precision] = item
+        logger.info(f"{backend}/{precision}: {item}")
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Квантизация модели и сравнение с FP32')
+    parser.add_argument('folder', nargs='?', default='./fc_media', help='Каталог с jpg')
+    parser.add_argument('--backend', default='openvino', choices=['onnxruntime', 'openvino'])
+    parser.add_argument('--model', default='yolov8l.pt')
+    parser.add_argument('--precisions', nargs='+', default=['int8'], choices=PRECISIONS)
+    parser.add_argument('--calibration', type=int, default=200, help='Сколько фото для калибровки INT8')
+    parser.add_argument('--eval', type=int, default=100, help='Сколько фото для сравнения')
+    parser.add_argument('--conf', type=float, default=0.6, help='Порог уверенности')
+    parser.add_argument('--output', help='Сохранить отчет в JSON')
+    args = parser.parse_args()
+
+    setup_logging()
+    try:
+        sample = sample_calibration_images(args.folder, args.calibration + args.eval)
+    except FileNotFoundError as e:
+        logger.error(str(e))
+        sys.exit(2)
+    calibration_images, eval_images = sample[:args.calibration], sample[args.calibration:]
+    if not eval_images:
+        logger.error(f"В {args.folder} не осталось фото для сравнения после калибровочной выборки")
+        sys.exit(2)
+
+    report = compare_precisions(args.model, args.backend, calibration_images, eval_images,
+                                args.precisions, conf_threshold=args.conf)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
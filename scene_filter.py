@@ -0,0 +1,209 @@
+# scene_filter.py
+import json
+import logging
+import os
+import tempfile
+
+import cv2
+import numpy as np
+
+from truck_detector import DetectionResult, roi_to_pixels
+
+''' Подавление повторного анализа статичной сцены по перцептивному хэшу кадра (для каждой ловушки) '''
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STATE_PATH = './fc_media/scene_state.json'
+# Сторона сетки хэша: 16x16 = 256 бит. На кадре 12-20 Мп ячейка 9x8 была около 290x240 пикселей,
+# и далекий грузовик менял 1-3 бита из 64; на сетке 16x16 по области интереса ячейка в разы меньше
+HASH_SIZE = 16
+
+
+def frame_hash(image_path, roi=None, hash_size=HASH_SIZE):
+    """
+    Разностный хэш (dHash) области интереса кадра, hash_size * hash_size бит.
+
+    Файл декодируется в оттенках серого с уменьшением в 8 раз прямо в декодере JPEG,
+    из него вырезается область интереса ловушки (дорога, а не небо), она сжимается
+    до (hash_size + 1) x hash_size и сравниваются соседние пиксели по строкам. Хэш
+    устойчив к смене освещения и шуму сжатия, но меняется при появлении объекта.
+
+    Args:
+        image_path (str): Путь к файлу изображения.
+        roi (tuple | list): Область интереса в долях кадра (см. truck_detector.roi_to_pixels); None - весь кадр.
+        hash_size (int): Сторона сетки хэша.
+
+    Returns:
+        int: Хэш кадра.
+    """
+    image = cv2.imdecode(np.fromfile(image_path, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if image is None:
+        raise ValueError(f"Не удалось декодировать изображение: {image_path}")
+
+    if roi is not None:
+        height, width = image.shape[:2]
+        (x1, y1, x2, y2), points = roi_to_pixels(roi, width, height)
+        image = image[y1:y2, x1:x2]
+        if points is not None:
+            # Вне многоугольника - постоянный фон, он не меняет биты хэша
+            mask = np.zeros(image.shape, dtype=np.uint8)
+            cv2.fillPoly(mask, [points - np.array([x1, y1], dtype=np.int32)], 255)
+            image = np.where(mask > 0, image, 0).astype(np.uint8)
+
+    small = cv2.resize(image, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming_distance(hash_a, hash_b):
+    """Количество различающихся бит двух хэшей."""
+    return bin(hash_a ^ hash_b).count('1')
+
+
+class SceneReference:
+    """Последний проанализированный кадр ловушки: хэш, имя файла и результат детекции."""
+
+    def __init__(self, frame_hash, filename, detection=None):
+        self.frame_hash = frame_hash
+        self.filename = filename
+        # Заполняется после inference; до этого кадр ждет своей очереди в текущей пачке
+        self.detection = detection
+
+
+class SceneFilter:
+    """
+    Хранит для каждой ловушки (IMEI) хэш последнего проанализированного кадра.
+
+    Если новый кадр почти не отличается от него (ветер, смена освещения, стоящий
+    грузовик), inference пропускается и переиспользуется прошлый результат.
+    Сравнение идет всегда с последним проанализированным кадром, поэтому
+    медленно меняющаяся сцена рано или поздно будет проанализирована заново.
+
+    По умолчанию подавление выключено: пропущенный кадр с подъехавшим грузовиком -
+    это пропущенное оповещение. Порог включается для отдельных ловушек после
+    проверки на их сохраненных кадрах (test_scene_filter.py).
+
+    Состояние принадлежит одному процессу: оно читается при запуске, а save()
+    целиком перезаписывает файл. Если несколько процессов анализатора работают
+    с одним state_path, файл остается целым, но в нем останутся опорные кадры
+    того процесса, который сохранил его последним.
+    """
+
+    def __init__(self, default_threshold=None, thresholds=None, state_path=DEFAULT_STATE_PATH,
+                 hash_size=HASH_SIZE):
+        """
+        Args:
+            default_threshold (int): Максимальное расстояние Хэмминга (из hash_size^2 бит),
+                                     при котором кадр считается повтором; None - не подавлять.
+            thresholds (dict): Пороги для отдельных ловушек {imei: порог}; None - не подавлять.
+            state_path (str): Файл, в котором состояние сохраняется между запусками (None - не сохранять).
+            hash_size (int): Сторона сетки хэша (см. frame_hash); состояние с другим размером не загружается.
+        """
+        self.default_threshold = default_threshold
+        self.thresholds = thresholds or {}
+        self.state_path = state_path
+        self.hash_size = hash_size
+        self.references = {}
+        self.skipped = 0
+        self.load()
+
+    def threshold_for(self, imei):
+        """Порог похожести для ловушки (None - подавление выключено)."""
+        return self.thresholds.get(imei, self.default_threshold)
+
+    def looks_repeated(self, imei, frame_hash):
+        """
+        Быстрая проверка без изменения состояния: похож ли кадр на текущий опорный кадр ловушки.
+
+        Нужна загрузчикам, чтобы не декодировать кадры, которые почти наверняка окажутся
+        повтором. Окончательное решение принимает check.
+        """
+        threshold = self.threshold_for(imei)
+        reference = self.references.get(imei)
+        return (threshold is not None and reference is not None
+                and hamming_distance(reference.frame_hash, frame_hash) <= threshold)
+
+    def check(self, imei, frame_hash, filename):
+        """
+        Проверяет, повторяет ли кадр последний проанализированный кадр ловушки.
+
+        Args:
+            imei (str): ID ловушки.
+            frame_hash (int): Хэш нового кадра (см. frame_hash).
+            filename (str): Имя файла нового кадра.
+
+        Returns:
+            tuple: (повтор ли кадр, SceneReference). Для повтора возвращается прежний
+                   опорный кадр, иначе новый кадр становится опорным и вызывающий код
+                   должен заполнить reference.detection после inference.
+        """
+        threshold = self.threshold_for(imei)
+        reference = self.references.get(imei)
+        if (threshold is not None and reference is not None
+                and hamming_distance(reference.frame_hash, frame_hash) <= threshold):
+            self.skipped += 1
+            return True, reference
+
+        reference = SceneReference(frame_hash, filename)
+        self.references[imei] = reference
+        return False, reference
+
+    def forget(self, imei, reference):
+        """Сбрасывает опорный кадр ловушки, если его анализ не удался."""
+        if self.references.get(imei) is reference:
+            del self.references[imei]
+
+    def load(self):
+        """Загружает состояние прошлого запуска."""
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, encoding='utf-8') as f:
+                state = json.load(f)
+            for imei, item in state.items():
+                # Хэши другого размера (64-битные прошлых версий) несравнимы с текущими
+                if item.get('hash_size', 8) != self.hash_size:
+                    continue
+                detection = DetectionResult(
+                    np.array(item['boxes'], dtype=np.int32).reshape(-1, 4),
+                    np.array(item['confidences'], dtype=np.float32),
+                    np.array(item['class_ids'], dtype=np.int32),
+                    {int(class_id): name for class_id, name in item['names'].items()},
+                )
+                self.references[imei] = SceneReference(int(item['hash'], 16), item['filename'], detection)
+            logger.info(f"Загружены опорные кадры для {len(self.references)} ловушек")
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось загрузить состояние сцен {self.state_path}: {e}")
+
+    def save(self):
+        """Сохраняет опорные кадры с готовыми результатами для следующего запуска."""
+        if not self.state_path:
+            return
+        state = {}
+        for imei, reference in self.references.items():
+            detection = reference.detection
+            if detection is None:
+                continue
+            class_ids = detection.class_ids.tolist()
+            state[imei] = {
+                'hash': f'{reference.frame_hash:x}',
+                'hash_size': self.hash_size,
+                'filename': reference.filename,
+                'boxes': detection.boxes.tolist(),
+                'confidences': detection.confidences.tolist(),
+                'class_ids': class_ids,
+                'names': {class_id: detection.names[class_id] for class_id in set(class_ids)},
+            }
+
+        # Уникальный временный файл в том же каталоге: процессы не пишут в один .tmp,
+        # а os.replace в пределах файловой системы атомарен
+        state_dir = os.path.dirname(os.path.abspath(self.state_path))
+        f = tempfile.NamedTemporaryFile('w', dir=state_dir, prefix='.scene_state.', suffix='.tmp',
+                                        delete=False, encoding='utf-8')
+        try:
+            with f:
+                json.dump(state, f)
+            os.replace(f.name, self.state_path)
+        except BaseException:
+            os.unlink(f.name)
+            raise
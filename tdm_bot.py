@@ -6,6 +6,8 @@ import requests
 from messenger_bot_api import *
 import config
 import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
 # from PIL import Image
 from PIL import Image as PILImage
 from datetime import datetime
@@ -43,25 +45,74 @@ class TDMBot:
             'file_upload_base_url': self.file
         })
 
+        # Клиент messenger_bot_api не принимает таймаут: запрос выполняется в отдельном потоке,
+        # а отправка считается неудачной, если ответа нет за send_timeout секунд
+        self.send_timeout = getattr(config, 'TDM_SEND_TIMEOUT', 60)
+        # Сколько зависших (брошенных по таймауту) запросов допускается; пока их больше, новые не начинаются
+        self.max_abandoned = getattr(config, 'TDM_MAX_ABANDONED', 2)
+        self._abandoned = []
+        self._abandoned_lock = threading.Lock()
+
         self.logger = logging.getLogger('tdm_bot')
         self.logger.info("TDMBot инициализирован")
 
+    def _call_api(self, method, *args):
+        """
+        Вызов метода клиента TDM, но не дольше send_timeout секунд.
+
+        Зависший запрос остается в фоновом потоке (daemon - не мешает завершению
+        процесса); если он все же выполнится, сообщение может прийти дважды
+        (после повтора очередью оповещений). Пока зависших запросов max_abandoned
+        или больше, новые запросы сразу завершаются ошибкой: при долгом сбое TDM
+        потоки не копятся, а повторы (и возможные дубли) ждут его восстановления.
+        """
+        with self._abandoned_lock:
+            self._abandoned = [thread for thread in self._abandoned if thread.is_alive()]
+            if len(self._abandoned) >= self.max_abandoned:
+                raise ConnectionError(f"TDM не отвечает: {len(self._abandoned)} запросов зависли, "
+                                      f"новые не отправляются")
+
+        result = {}
+
+        def call():
+            try:
+                result['value'] = method(*args)
+            except Exception as e:
+                result['error'] = e
+
+        thread = threading.Thread(target=call, name='tdm-api', daemon=True)
+        thread.start()
+        thread.join(self.send_timeout)
+        if thread.is_alive():
+            with self._abandoned_lock:
+                self._abandoned.append(thread)
+            raise TimeoutError(f"TDM не ответил за {self.send_timeout} с")
+        if 'error' in result:
+            raise result['error']
+        return result.get('value')
+
 
     def send_photo_with_caption(self, group_id, image_path, caption):
         """
         Отправка фото с подписью в TDM
+
+        image_path - изображение numpy array или готовый JPEG (bytes)
         """
         try:
             self.logger.info(f"🔄 Попытка отправки фото в TDM, группа: {group_id}")
 
-            # Конвертируем numpy array в PIL Image
-            pil_image = PILImage.fromarray(image_path)
+            if isinstance(image_path, (bytes, bytearray)):
+                # Уже закодированный JPEG (очередь оповещений) - отправляем как есть
+                img_data = bytes(image_path)
+            else:
+                # Конвертируем numpy array в PIL Image
+                pil_image = PILImage.fromarray(image_path)
 
-            # Сохраняем изображение в буфер
-            img_buffer = io.BytesIO()
-            pil_image.save(img_buffer, format='JPEG')
-            img_data = img_buffer.getvalue()
-            img_buffer.close()
+                # Сохраняем изображение в буфер
+                img_buffer = io.BytesIO()
+                pil_image.save(img_buffer, format='JPEG')
+                img_data = img_buffer.getvalue()
+                img_buffer.close()
 
             # Создаем объект Image для messenger_bot_api
             image_obj = Image(f"detected_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg", img_data)
@@ -70,7 +121,8 @@ class TDMBot:
             self.logger.debug(f"📊 Диагностика: workspace_id={self.workspace_id}, group_id={group_id}")
 
             # Отправляем сообщение
-            self.bot._request.send_image_message(
+            self._call_api(
+                self.bot._request.send_image_message,
                 self.workspace_id,
                 group_id,
                 image_obj,
@@ -101,7 +153,8 @@ class TDMBot:
             self.logger.info(f"🔄 Попытка отправки фото в TDM, группа: {group_id}")
 
             # Отправляем сообщение
-            self.bot._request.send_text(
+            self._call_api(
+                self.bot._request.send_text,
                 self.workspace_id,
                 group_id,
                 MessageRequest(caption)
@@ -124,6 +177,47 @@ class TDMBot:
             return False
 
 
+    def send_batch(self, items, max_workers=8):
+        """
+        Параллельная отправка многих сообщений по группам TDM
+
+        Группы обслуживаются одновременно (не больше max_workers), а сообщения
+        одной группы уходят по очереди, в порядке items.
+
+        Args:
+            items (list): Пары (group_id, payload); payload - текст (send_info_message)
+                          или (изображение, подпись) (send_photo_with_caption)
+            max_workers (int): Сколько групп обслуживать одновременно
+
+        Returns:
+            list: Результат (True/False) для каждого элемента items в том же порядке
+        """
+        results = [False] * len(items)
+        by_group = {}
+        for index, (group_id, payload) in enumerate(items):
+            if group_id is None:
+                self.logger.warning(f"❌ Не указана группа TDM для сообщения: {str(payload)[:40]}...")
+                continue
+            by_group.setdefault(group_id, []).append((index, payload))
+
+        def send_group(group_id, group_items):
+            for index, payload in group_items:
+                if isinstance(payload, str):
+                    results[index] = self.send_info_message(group_id, payload)
+                else:
+                    image, caption = payload
+                    results[index] = self.send_photo_with_caption(group_id, image, caption)
+
+        if by_group:
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(by_group))),
+                                    thread_name_prefix='tdm-send') as executor:
+                for future in [executor.submit(send_group, group_id, group_items)
+                               for group_id, group_items in by_group.items()]:
+                    future.result()
+
+        self.logger.info(f"📨 Отправлено в TDM {sum(results)} из {len(items)} сообщений ({len(by_group)} групп)")
+        return results
+
     def start_bot(self):
         """Запуск бота (для асинхронной работы)"""
         self.logger.info("Запуск TDMBot")
@@ -1,58 +1,198 @@
 # telegram_bot.py
 import requests
 import io
+import json
+import threading
+import time
 from PIL import Image
 import numpy as np
+from requests.adapters import HTTPAdapter
 
 import logging
 # Только получаем логгер
 logger = logging.getLogger(__name__)
 
+# Ограничения Bot API: ~30 сообщений в секунду всего, 1 в секунду в личный чат, 20 в минуту в группу
+GLOBAL_RATE = 30
+CHAT_RATE = 1.0
+GROUP_RATE = 20 / 60
+# Альбом (sendMediaGroup): от 2 до 10 фото, подпись - до 1024 символов
+MEDIA_GROUP_MAX = 10
+CAPTION_MAX = 1024
+
+
+class TokenBucket:
+    """
+    Ведро токенов: в среднем не больше rate запросов в секунду, всплеск до capacity.
+
+    pause() останавливает выдачу токенов на заданное время (ответ 429 с retry_after).
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        """Не выдавать токены seconds секунд; после паузы сразу разрешен один запрос."""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._tokens = min(self._tokens, 1)
+
+    def acquire(self):
+        """
+        Ждет и забирает один токен.
+
+        Returns:
+            float: Сколько секунд пришлось ждать.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    delay = self._blocked_until - now
+                    # Во время паузы токены не накапливаются
+                    self._updated = self._blocked_until
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return waited
+                    delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
 
 class TelegramBot:
-    def __init__(self, token, chat_id):
+    def __init__(self, token, chat_id, timeout=(5, 30), global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE,
+                 group_rate=GROUP_RATE, max_retries=3, max_retry_after=60, pool_maxsize=4):
         """
         Инициализация телеграм бота
 
         Args:
             token (str): Токен вашего бота (получить у @BotFather)
             chat_id (str): ID чата для отправки сообщений
+            timeout (tuple): Таймауты (подключение, чтение ответа) в секундах
+            global_rate (float): Максимум запросов в секунду для бота в целом
+            chat_rate (float): Максимум сообщений в секунду в один личный чат
+            group_rate (float): Максимум сообщений в секунду в одну группу (ID группы отрицательный)
+            max_retries (int): Сколько раз повторить запрос после ответа 429
+            max_retry_after (float): Повторять сразу, только если сервер просит подождать не дольше (секунды);
+                                     иначе отправка считается неудачной и повторяется очередью оповещений
+            pool_maxsize (int): Сколько соединений держать открытыми (по числу потоков отправки)
         """
         self.token = token
         self.chat_id = chat_id
         self.base_url = f"https://api.telegram.org/bot{token}"
+        self.timeout = timeout
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+
+        # Одна сессия на все запросы: соединение и TLS переиспользуются (keep-alive)
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize))
+
+        self._global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self._chat_buckets = {}
+        self._buckets_lock = threading.Lock()
         logger.info("TelegramBot инициализирован")
 
+    @property
+    def max_send_seconds(self):
+        """
+        Самая долгая отправка одного сообщения (секунды): все повторы после 429
+        с ожиданием до max_retry_after и полным таймаутом запроса.
+        """
+        request_timeout = sum(self.timeout) if isinstance(self.timeout, (tuple, list)) else self.timeout
+        return (self.max_retries + 1) * (self.max_retry_after + request_timeout)
+
+    def _chat_bucket(self, chat_id):
+        """Ведро токенов чата (создается при первой отправке в чат)."""
+        with self._buckets_lock:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                is_group = str(chat_id).startswith('-')
+                bucket = self._chat_buckets[chat_id] = TokenBucket(self.group_rate if is_group else self.chat_rate)
+            return bucket
+
+    @staticmethod
+    def _retry_after(response):
+        """Сколько секунд просит подождать сервер в ответе 429."""
+        try:
+            return float(response.json()['parameters']['retry_after'])
+        except (ValueError, KeyError, TypeError):
+            return float(response.headers.get('Retry-After', 1))
+
+    def _post(self, method, chat_id, data, files=None):
+        """
+        Запрос к Bot API с учетом ограничений на частоту.
+
+        Перед запросом ждет токены чата и бота; на ответ 429 приостанавливает
+        отправку в чат на retry_after и повторяет запрос (не больше max_retries раз).
+
+        Returns:
+            requests.Response: Успешный ответ (иначе - исключение requests).
+        """
+        url = f"{self.base_url}/{method}"
+        bucket = self._chat_bucket(chat_id)
+        for attempt in range(self.max_retries + 1):
+            # Сначала чат, потом бот: ожидание медленного чата не занимает общие токены
+            bucket.acquire()
+            self._global_bucket.acquire()
+
+            response = self.session.post(url, data=data, files=files, timeout=self.timeout)
+            if response.status_code != 429:
+                break
+
+            retry_after = self._retry_after(response)
+            bucket.pause(retry_after)
+            logger.warning(f"⚠️ Telegram: превышен лимит для чата {chat_id}, повтор через {retry_after:.0f} с")
+            if retry_after > self.max_retry_after:
+                break
 
-    def send_photo(self, image_array, caption=""):
+        response.raise_for_status()
+        return response
+
+    def send_photo(self, image_array, caption="", chat_id=None):
         """
         Отправка фото с bounding boxes
 
         Args:
-            image_array (numpy.array): Изображение в формате numpy array
+            image_array (numpy.array | bytes): Изображение в формате numpy array или готовый JPEG
             caption (str): Подпись к фото
+            chat_id (str): ID чата (None - чат из конструктора)
         """
         logger.info(f"Отправка фото в Telegram, caption: {caption[:15]}...")
 
         try:
-            # Конвертируем numpy array в PIL Image
-            pil_image = Image.fromarray(image_array)
-
-            # Сохраняем изображение в буфер
-            img_buffer = io.BytesIO()
-            pil_image.save(img_buffer, format='JPEG')
-            img_buffer.seek(0)
+            if isinstance(image_array, (bytes, bytearray)):
+                # Уже закодированный JPEG (очередь оповещений) - отправляем как есть
+                img_data = bytes(image_array)
+            else:
+                # Конвертируем numpy array в PIL Image
+                pil_image = Image.fromarray(image_array)
 
-            url = f"{self.base_url}/sendPhoto"
+                # Сохраняем изображение в буфер
+                img_buffer = io.BytesIO()
+                pil_image.save(img_buffer, format='JPEG')
+                img_data = img_buffer.getvalue()
 
-            files = {'photo': ('detection.jpg', img_buffer, 'image/jpeg')}
+            chat_id = chat_id or self.chat_id
+            # Байты, а не буфер: при повторе после 429 файл отправляется заново целиком
+            files = {'photo': ('detection.jpg', img_data, 'image/jpeg')}
             data = {
-                'chat_id': self.chat_id,
+                'chat_id': chat_id,
                 'caption': caption
             }
 
-            response = requests.post(url, files=files, data=data)
-            response.raise_for_status()
+            self._post('sendPhoto', chat_id, data, files)
             print("✅ Фото отправлено в Telegram")
             logger.info("✅ Фото успешно отправлено в Telegram")
             return True
@@ -62,3 +202,43 @@ class TelegramBot:
             logger.error(f"❌ Ошибка отправки фото в Telegram: {e}")
             return False
 
+    def send_media_group(self, images, caption="", chat_id=None):
+        """
+        Отправка серии фото одним альбомом
+
+        Telegram показывает подпись альбома, только если она есть у одного фото,
+        поэтому общая подпись (до CAPTION_MAX символов) ставится первому фото.
+
+        Args:
+            images (list): Готовые JPEG (bytes), от 2 до 10
+            caption (str): Общая подпись альбома (см. alert_payload.merge_captions)
+            chat_id (str): ID чата (None - чат из конструктора)
+        """
+        logger.info(f"Отправка альбома из {len(images)} фото в Telegram")
+
+        try:
+            if not 2 <= len(images) <= MEDIA_GROUP_MAX:
+                raise ValueError(f"в альбоме должно быть от 2 до {MEDIA_GROUP_MAX} фото, передано {len(images)}")
+
+            chat_id = chat_id or self.chat_id
+            # Файлы прикрепляются к запросу и указываются в media как attach://<имя поля>
+            files = {f'photo{i}': (f'detection_{i}.jpg', bytes(image), 'image/jpeg') for i, image in enumerate(images)}
+            media = [{'type': 'photo', 'media': f'attach://photo{i}'} for i in range(len(images))]
+            if caption:
+                media[0]['caption'] = caption[:CAPTION_MAX]
+            data = {
+                'chat_id': chat_id,
+                'media': json.dumps(media, ensure_ascii=False)
+            }
+
+            self._post('sendMediaGroup', chat_id, data, files)
+            logger.info(f"✅ Альбом из {len(images)} фото отправлен в Telegram")
+            return True
+
+        except Exception as e:
+            logger.error(f"❌ Ошибка отправки альбома в Telegram: {e}")
+            return False
+
+    def close(self):
+        """Закрывает соединения сессии."""
+        self.session.close()
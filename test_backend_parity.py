@@ -0,0 +1,71 @@
+import argparse
+import logging
+import os
+import sys
+
+from logging_config import setup_logging
+from truck_detector import TruckDetector
+from detection_metrics import compare_detections
+
+''' Проверка совпадения детекций бэкендов onnxruntime / openvino с эталонным torch '''
+
+logger = logging.getLogger('backend_parity')
+
+
+def check_parity(image_paths, model_path='yolov8l.pt', backend='onnxruntime', conf_threshold=0.6,
+                 min_iou=0.9, max_conf_diff=0.05):
+    """
+    Прогоняет одни и те же изображения через torch и проверяемый бэкенд.
+
+    Args:
+        image_paths (list): Файлы для сравнения.
+        model_path (str): Веса .pt.
+        backend (str): Проверяемый бэкенд ('onnxruntime' или 'openvino').
+        conf_threshold (float): Порог уверенности.
+        min_iou (float): Минимальный IoU сопоставленных рамок.
+        max_conf_diff (float): Максимальная разница уверенности сопоставленных рамок.
+
+    Returns:
+        bool: True, если на всех изображениях набор рамок совпал в пределах допуска.
+    """
+    reference = TruckDetector(model_path, backend='torch').detect_trucks_batch(
+        image_paths, conf_threshold=conf_threshold, render=False)
+    candidate = TruckDetector(model_path, backend=backend).detect_trucks_batch(
+        image_paths, conf_threshold=conf_threshold, render=False)
+
+    ok = True
+    for image_path, ref, cand in zip(image_paths, reference, candidate):
+        # Сопоставляем с запасом (IoU 0.5), а допуск min_iou проверяем отдельно - так видно, насколько рамки разъехались
+        report = compare_detections(ref, cand, iou_threshold=0.5)
+        passed = (report['missed'] == 0 and report['extra'] == 0
+                  and report['min_iou'] >= min_iou and report['max_conf_diff'] <= max_conf_diff)
+        ok = ok and passed
+        log = logger.info if passed else logger.error
+        log(f"{'✅' if passed else '❌'} {os.path.basename(image_path)}: {report}")
+
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение детекций бэкенда с torch')
+    parser.add_argument('folder', nargs='?', default='./fc_media', help='Каталог с jpg')
+    parser.add_argument('--backend', default='onnxruntime', choices=['onnxruntime', 'openvino'])
+    parser.add_argument('--model', default='yolov8l.pt')
+    parser.add_argument('--limit', type=int, default=20, help='Сколько файлов взять')
+    args = parser.parse_args()
+
+    setup_logging()
+    image_paths = sorted(
+        os.path.join(args.folder, name) for name in os.listdir(args.folder) if name.lower().endswith('.jpg')
+    )[:args.limit]
+    if not image_paths:
+        logger.error(f"В {args.folder} нет jpg файлов")
+        sys.exit(2)
+
+    ok = check_parity(image_paths, model_path=args.model, backend=args.backend)
+    logger.info(f"Итог: {'совпадает' if ok else 'есть расхождения'}")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
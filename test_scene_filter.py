@@ -0,0 +1,81 @@
+import argparse
+import logging
+import os
+import sys
+
+import config
+from logging_config import setup_logging
+from scene_filter import SceneFilter, frame_hash
+from truck_detector import TruckDetector
+from tune_imgsz import trap_history
+
+''' Проверка подавления статичной сцены на сохраненных кадрах ловушки: подъехавший грузовик не должен теряться '''
+
+logger = logging.getLogger('scene_filter_check')
+
+
+def check_scene_filter(detector, image_paths, threshold, roi=None, conf_threshold=0.6):
+    """
+    Прогоняет кадры ловушки (от старых к новым) через SceneFilter так же, как анализатор.
+
+    Эталон - детекции на каждом кадре. Кадр, признанный повтором, получает результат
+    опорного кадра; если в кадре есть грузовик, а в опорном его нет, оповещение было бы
+    потеряно - это ошибка.
+
+    Args:
+        detector (TruckDetector): Детектор.
+        image_paths (list): Кадры ловушки в порядке съемки.
+        threshold (int): Проверяемый порог расстояния Хэмминга.
+        roi (tuple | list): Область интереса ловушки.
+        conf_threshold (float): Порог уверенности.
+
+    Returns:
+        dict: Число кадров, подавленных кадров и потерянных грузовиков (с именами файлов).
+    """
+    truth = detector.detect_trucks_batch(image_paths, conf_threshold=conf_threshold, render=False,
+                                         rois=[roi] * len(image_paths))
+    scene_filter = SceneFilter(default_threshold=threshold, state_path=None)
+
+    suppressed, missed = 0, []
+    for image_path, detection in zip(image_paths, truth):
+        name = os.path.basename(image_path)
+        is_repeat, reference = scene_filter.check('trap', frame_hash(image_path, roi), name)
+        if not is_repeat:
+            reference.detection = detection
+            continue
+        suppressed += 1
+        if detection.has_class('truck') and not reference.detection.has_class('truck'):
+            missed.append(name)
+            logger.error(f"❌ {name}: грузовик подавлен как повтор {reference.filename}")
+
+    return {'frames': len(image_paths), 'suppressed': suppressed, 'missed_trucks': missed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Проверка порога подавления статичной сцены по истории ловушки')
+    parser.add_argument('imei', help='ID ловушки (IMEI)')
+    parser.add_argument('--threshold', type=int, required=True, help='Проверяемый порог (из 256 бит)')
+    parser.add_argument('--media', default='./fc_media', help='Каталог с кадрами')
+    parser.add_argument('--limit', type=int, default=500, help='Сколько последних кадров ловушки взять')
+    parser.add_argument('--model', default='yolov8l.pt')
+    args = parser.parse_args()
+
+    setup_logging()
+    image_paths = trap_history(args.imei, args.media, args.limit)[::-1]
+    if not image_paths:
+        logger.error(f"❌ Нет кадров ловушки {args.imei}")
+        sys.exit(2)
+
+    detector = TruckDetector(args.model, target_classes=getattr(config, 'TARGET_CLASSES', ('truck', 'lorry')))
+    report = check_scene_filter(detector, image_paths, args.threshold, getattr(config, 'TRAP_ROI', {}).get(args.imei))
+    ok = not report['missed_trucks']
+    logger.info(f"{'✅' if ok else '❌'} Порог {args.threshold}: кадров {report['frames']}, "
+                f"подавлено {report['suppressed']}, потеряно грузовиков {len(report['missed_trucks'])}")
+    if ok:
+        # Готовая строка для config.py
+        print(f"SCENE_THRESHOLDS = {{'{args.imei}': {args.threshold}}}")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
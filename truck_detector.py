@@ -1,99 +1,667 @@
 from ultralytics import YOLO
 import cv2
-import os
 import numpy as np
-from PIL import Image
 import matplotlib.pyplot as plt
 import logging
 
+from model_export import export_model, configure_backend
+
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
+# Размер пачки по умолчанию для пакетной детекции
+DEFAULT_BATCH_SIZE = 8
+
+# Классы, которые ищем по умолчанию.
+# В COCO dataset (на котором обучена YOLO) класс 'truck' имеет id 7.
+# Можно расширить: ('truck', 'lorry', 'car', 'bus')
+DEFAULT_TARGET_CLASSES = ('truck', 'lorry')
+
+# Размер входа модели по умолчанию (сторона квадрата letterbox, кратна 32)
+DEFAULT_IMGSZ = 640
+
+# Каскад моделей: политики передачи кадра в дорогую модель и полоса неуверенности быстрой модели
+CASCADE_POLICIES = ('uncertain', 'any')
+DEFAULT_UNCERTAIN_BAND = (0.25, 0.8)
+
+# Флаги OpenCV для уменьшенного декодирования JPEG (масштабирование DCT в libjpeg)
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def decode_image(data, decode_scale=1, name='<bytes>'):
+    """
+    Декодирует содержимое файла изображения в массив numpy (BGR) за один проход.
+
+    Args:
+        data (numpy.ndarray): Байты файла (uint8).
+        decode_scale (int): Во сколько раз уменьшить изображение при декодировании
+                            (1, 2, 4 или 8). Для JPEG уменьшение делается прямо
+                            в декодере и обходится дешевле полного декодирования.
+        name (str): Имя файла для сообщения об ошибке.
+
+    Returns:
+        numpy.ndarray: Изображение в формате BGR.
+    """
+    flag = REDUCED_DECODE_FLAGS.get(decode_scale)
+    if flag is None:
+        raise ValueError(f"Неподдерживаемый decode_scale: {decode_scale} (допустимо 1, 2, 4, 8)")
+
+    image = cv2.imdecode(data, flag)
+    if image is None:
+        raise ValueError(f"Не удалось декодировать изображение: {name}")
+    return image
+
+
+def load_image(image_path, decode_scale=1):
+    """
+    Читает и декодирует файл изображения в массив numpy (BGR).
+
+    Args:
+        image_path (str): Путь к файлу изображения.
+        decode_scale (int): Уменьшение при декодировании (см. decode_image).
+
+    Returns:
+        numpy.ndarray: Изображение в формате BGR.
+    """
+    # np.fromfile + imdecode вместо imread, чтобы корректно читать пути с кириллицей
+    return decode_image(np.fromfile(image_path, dtype=np.uint8), decode_scale, image_path)
+
+
+def draw_detections(image_cv, boxes, confidences, class_names):
+    """Рисует bounding boxes и подписи найденных объектов на изображении BGR (на месте)."""
+    for (x1, y1, x2, y2), conf, class_name in zip(boxes.tolist(), confidences.tolist(), class_names):
+        label = f"{class_name} {conf:.2f}"
+
+        # Рисуем bounding box и label на изображении
+        # cv2.rectangle(image_cv, (x1, y1), (x2, y2), (0, 255, 0), 2) #--------- зелен
+        cv2.rectangle(image_cv, (x1, y1), (x2, y2), (0, 0, 255), 5)
+        cv2.putText(image_cv, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 5)
+    return image_cv
+
+
+def roi_to_pixels(roi, width, height):
+    """
+    Переводит область интереса из долей кадра в пиксели.
+
+    Args:
+        roi (tuple | list): Прямоугольник (x1, y1, x2, y2) или многоугольник
+                            [(x, y), (x, y), ...]; координаты в долях кадра от 0 до 1.
+        width (int): Ширина кадра.
+        height (int): Высота кадра.
+
+    Returns:
+        tuple: Ограничивающий прямоугольник (x1, y1, x2, y2) в пикселях и вершины
+               многоугольника в пикселях (None для прямоугольника).
+    """
+    size = np.array([width, height], dtype=np.float32)
+    if len(roi) == 4 and np.isscalar(roi[0]):
+        points = None
+        corners = np.array([roi[:2], roi[2:]], dtype=np.float32) * size
+    else:
+        points = np.round(np.array(roi, dtype=np.float32) * size).astype(np.int32)
+        corners = np.array([points.min(axis=0), points.max(axis=0)], dtype=np.float32)
+
+    x1, y1 = np.clip(np.floor(corners[0]), 0, size).astype(int)
+    x2, y2 = np.clip(np.ceil(corners[1]), 0, size).astype(int)
+    if x2 <= x1 or y2 <= y1:
+        raise ValueError(f"Пустая область интереса: {roi}")
+    return (int(x1), int(y1), int(x2), int(y2)), points
+
+
+class _Frame:
+    """
+    Кадр, подготовленный к inference: источник, декодированный буфер и вход модели с учетом ROI.
+
+    Создается в TruckDetector.prepare; для результата из кэша буфер не декодируется (image = None).
+    """
+
+    # Серый цвет, которым ultralytics заполняет поля при letterbox - им же закрываем все вне ROI
+    MASK_COLOR = (114, 114, 114)
+
+    def __init__(self, source, image, roi=None):
+        self.source = source
+        self.image = image
+        self.input = image
+        self.offset = (0, 0)
+        # Заполняются в TruckDetector.prepare: ключ кэша и готовый результат при попадании в кэш
+        self.cache_key = None
+        self.cached = None
+
+        if roi is not None:
+            height, width = image.shape[:2]
+            (x1, y1, x2, y2), points = roi_to_pixels(roi, width, height)
+            # Прямоугольник - просто срез без копирования
+            self.input = image[y1:y2, x1:x2]
+            self.offset = (x1, y1)
+            if points is not None:
+                # Многоугольник: копия области, все вне его закрашиваем (исходный буфер нужен для отрисовки)
+                mask = np.zeros((y2 - y1, x2 - x1), dtype=np.uint8)
+                cv2.fillPoly(mask, [points - np.array([x1, y1], dtype=np.int32)], 255)
+                self.input = self.input.copy()
+                self.input[mask == 0] = self.MASK_COLOR
+
+
+class DetectionResult:
+    """
+    Результат детекции для одного изображения.
+
+    Детекции хранятся компактными массивами numpy: boxes (N, 4) xyxy в пикселях
+    исходного кадра, confidences (N,) и class_ids (N,).
+
+    Изображение с рамками не строится заранее: оно рисуется при первом
+    обращении к annotated_image. Большинство кадров без грузовиков, и для них
+    полноразмерные копия и конвертация цвета так и не выполняются.
+    """
+
+    def __init__(self, boxes, confidences, class_ids, names, source=None, image=None):
+        """
+        Args:
+            boxes (numpy.ndarray): Рамки (N, 4) int32 в формате xyxy.
+            confidences (numpy.ndarray): Уверенность (N,) float32.
+            class_ids (numpy.ndarray): Классы (N,) int32.
+            names (dict): Имена классов модели {id: name}.
+            source (str | numpy.ndarray): Путь к файлу или массив BGR для отрисовки.
+                                          None - результат без изображения (render=False).
+            image (numpy.ndarray): Уже декодированный полноразмерный буфер BGR,
+                                   в котором можно рисовать без копирования.
+        """
+        self.boxes = boxes
+        self.confidences = confidences
+        self.class_ids = class_ids
+        self.names = names
+        self._source = source
+        self._image = image
+        self._annotated_image = None
+
+    @classmethod
+    def empty(cls, names, source=None, image=None):
+        """Результат без детекций."""
+        return cls(np.empty((0, 4), dtype=np.int32), np.empty(0, dtype=np.float32),
+                   np.empty(0, dtype=np.int32), names, source=source, image=image)
+
+    def detections_only(self):
+        """Копия результата без изображения - для долгого хранения, не удерживает кадр в памяти."""
+        return DetectionResult(self.boxes, self.confidences, self.class_ids, self.names)
+
+    @property
+    def class_names(self):
+        """Имена классов найденных объектов."""
+        return [self.names[class_id] for class_id in self.class_ids.tolist()]
+
+    @property
+    def trucks(self):
+        """Детекции в старом формате: список словарей class/confidence/bbox."""
+        return [
+            {"class": class_name, "confidence": conf, "bbox": bbox}
+            for class_name, conf, bbox in zip(self.class_names, self.confidences.tolist(), self.boxes.tolist())
+        ]
+
+    def has_class(self, class_name):
+        """Есть ли среди детекций объект класса class_name."""
+        return class_name in self.class_names
+
+    @property
+    def annotated_image(self):
+        """Изображение RGB с bounding boxes (None, если детекция шла с render=False)."""
+        if self._annotated_image is None and self._source is not None:
+            if self._image is not None:
+                image_cv = self._image
+            elif isinstance(self._source, np.ndarray):
+                image_cv = self._source.copy()
+            else:
+                image_cv = load_image(self._source)
+
+            draw_detections(image_cv, self.boxes, self.confidences, self.class_names)
+            # Конвертируем в RGB для отображения через matplotlib (на месте, без лишней копии кадра)
+            self._annotated_image = cv2.cvtColor(image_cv, cv2.COLOR_BGR2RGB, dst=image_cv)
+            self._source = self._image = None
+        return self._annotated_image
+
+    def __iter__(self):
+        # Совместимость со старым интерфейсом: trucks, image = detector.detect_truck(...)
+        return iter((self.trucks, self.annotated_image))
+
+    def __len__(self):
+        return len(self.class_ids)
+
 
 class TruckDetector:
     # def __init__(self, model_path='yolov8n.pt'):  # -------------- разные модели
     # def __init__(self, model_path='yolov8s.pt'):    #--------------- ПОКА круче других -----
     # def __init__(self, model_path='yolov8m.pt'):
-    def __init__(self, model_path='yolov8l.pt'):
+    def __init__(self, model_path='yolov8l.pt', decode_scale=1, target_classes=DEFAULT_TARGET_CLASSES,
+                 backend='torch', backend_options=None, screen_model_path=None,
+                 cascade_policy='uncertain', uncertain_band=DEFAULT_UNCERTAIN_BAND, cache=None,
+                 precision='fp32', imgsz=DEFAULT_IMGSZ):
         """
         Инициализация детектора.
         При первом запуске модель 'yolov8n.pt' будет автоматически скачана.
+
+        Args:
+            model_path (str): Путь к весам модели YOLO.
+            decode_scale (int): Уменьшение JPEG при декодировании для inference (1, 2, 4, 8).
+                                При значении больше 1 полноразмерный кадр декодируется
+                                только для отрисовки рамок.
+            target_classes (iterable): Имена классов, которые нужно искать ('truck', 'bus', 'car' ...).
+            backend (str): Бэкенд inference: 'torch', 'onnxruntime' или 'openvino'.
+                           Для последних двух веса экспортируются один раз и кэшируются рядом с .pt.
+            backend_options (dict): Настройки сессии бэкенда (потоки и т.п., см. model_export.configure_backend).
+            screen_model_path (str): Быстрая модель для каскада (например, 'yolov8n.pt').
+                                     Если задана, каждый кадр сначала проверяет она, а model_path
+                                     запускается только для кадров, отобранных по cascade_policy.
+            cascade_policy (str): 'uncertain' - дорогая модель только для кандидатов с уверенностью
+                                  внутри uncertain_band; 'any' - для любого кандидата.
+            uncertain_band (tuple): (нижняя, верхняя) граница уверенности быстрой модели. Ниже нижней
+                                    объект не считается кандидатом, от верхней - принимается без проверки.
+            cache (DetectionCache): Кэш детекций по хэшу содержимого; проверяется до вызова predict.
+            precision (str): Точность экспортированной модели: 'fp32', 'fp16' (openvino) или 'int8'
+                             (onnxruntime/openvino, калибровка на выборке фото из fc_media).
+                             Сравнить с fp32 по точности и скорости - quantize_model.py.
+            imgsz (int): Размер входа модели по умолчанию; для отдельных вызовов (ловушек)
+                         переопределяется параметром imgsz в detect_truck / detect_trucks_batch.
+        """
+        if decode_scale not in REDUCED_DECODE_FLAGS:
+            raise ValueError(f"Неподдерживаемый decode_scale: {decode_scale} (допустимо 1, 2, 4, 8)")
+        if cascade_policy not in CASCADE_POLICIES:
+            raise ValueError(f"Неизвестная политика каскада: {cascade_policy} (допустимо {', '.join(CASCADE_POLICIES)})")
+
+        logger.info(f"Инициализация детектора с моделью: {model_path}, бэкенд: {backend}, "
+                    f"точность: {precision}, decode_scale: {decode_scale}")
+        self.model_path = model_path
+        self.backend = backend
+        self.precision = precision
+        self.decode_scale = decode_scale
+        self.imgsz = imgsz
+
+        self.model = self._load_model(model_path, backend, backend_options, precision)
+
+        self.screen_model_path = screen_model_path
+        self.screen_model = None
+        self.cascade_policy = cascade_policy
+        self.uncertain_band = tuple(uncertain_band)
+        if screen_model_path:
+            logger.info(f"Каскад: быстрая модель {screen_model_path}, политика: {cascade_policy}, "
+                        f"полоса неуверенности: {self.uncertain_band}")
+            self.screen_model = self._load_model(screen_model_path, backend, backend_options, precision)
+
+        # Счетчики для сводки по прогону: сколько кадров обработано и сколько ушло в дорогую модель
+        self.stats = {'frames': 0, 'escalated': 0}
+        self.cache = cache
+
+        self.set_target_classes(target_classes)
+
+    @staticmethod
+    def _load_model(model_path, backend, backend_options, precision='fp32'):
+        """Загружает модель YOLO для выбранного бэкенда и точности."""
+        model_file = export_model(model_path, backend, precision=precision)
+        if backend == 'torch':
+            return YOLO(model_file)  # Загрузка предобученной модели
+
+        model = YOLO(model_file, task='detect')
+        # Первый predict создает сессию бэкенда - после него подменяем ее настройки
+        model.predict(source=np.zeros((64, 64, 3), dtype=np.uint8), save=False, verbose=False)
+        configure_backend(model, backend, model_file, backend_options)
+        return model
+
+    @staticmethod
+    def _resolve_class_ids(names, wanted):
+        """Переводит имена классов в ID классов модели."""
+        class_ids = sorted(class_id for class_id, name in names.items() if name.lower() in wanted)
+
+        missing = wanted - {names[class_id].lower() for class_id in class_ids}
+        if missing:
+            logger.debug(f"Классы отсутствуют в модели и пропущены: {sorted(missing)}")
+        if not class_ids:
+            raise ValueError(f"Ни один из классов {sorted(wanted)} не найден в модели")
+        return np.array(class_ids, dtype=np.int32)
+
+    def set_target_classes(self, target_classes):
+        """
+        Задает набор искомых классов.
+
+        Имена переводятся в ID классов модели один раз: эти ID передаются в predict,
+        и модель сама отбрасывает остальные классы еще до NMS.
+
+        Args:
+            target_classes (iterable): Имена классов ('truck', 'lorry', 'bus', 'car' ...).
         """
-        logger.info(f"Инициализация детектора с моделью: {model_path}")
-        self.model = YOLO(model_path)  # Загрузка предобученной модели
+        wanted = {name.lower() for name in target_classes}
+        self.class_ids = self._resolve_class_ids(self.model.names, wanted)
+        if self.screen_model is not None:
+            self.screen_class_ids = self._resolve_class_ids(self.screen_model.names, wanted)
+
+        self.target_classes = tuple(sorted(wanted))
+        logger.info(f"Искомые классы: {[self.model.names[class_id] for class_id in self.class_ids.tolist()]}")
+
+    @property
+    def escalation_rate(self):
+        """Доля кадров, переданных в дорогую модель каскада (None, если кадров не было)."""
+        if not self.stats['frames']:
+            return None
+        return self.stats['escalated'] / self.stats['frames']
 
-    def detect_truck(self, image_path, conf_threshold=0.8):
+    def detect_truck(self, image_path, conf_threshold=0.8, render=True, roi=None, imgsz=None):
         """
         Обнаруживает грузовики на изображении.
 
         Args:
             image_path (str): Путь к файлу изображения.
             conf_threshold (float): Порог уверенности (от 0.0 до 1.0).
+            render (bool): Готовить ли изображение с рамками. При False результат
+                           содержит только детекции, а кадр сразу освобождается.
+            roi (tuple | list): Область интереса в долях кадра (см. roi_to_pixels).
+                                Модель видит только ее, рамки возвращаются в координатах всего кадра.
+            imgsz (int): Размер входа модели для этого кадра (None - self.imgsz).
 
         Returns:
-            list: Список результатов обнаружения.
-            PIL.Image: Изображение с нарисованными bounding boxes.
+            DetectionResult: Найденные грузовики и (лениво) изображение с bounding boxes.
+                             Поддерживает распаковку `trucks, image = detector.detect_truck(...)`.
         """
         logger.info(f"Начало детекции: {image_path}, порог: {conf_threshold}")
 
         try:
-            # Выполнение inference (предсказания)
-            results = self.model.predict(source=image_path, conf=conf_threshold, save=False, verbose=False)
-
-            # Открываем изображение с помощью Pillow для последующей отрисовки
-            image = Image.open(image_path)
-            # Конвертируем в RGB (если это не так)
-            image_rgb = image.convert('RGB')
-            # Конвертируем в формат OpenCV (BGR) для отрисовки
-            image_cv = cv2.cvtColor(np.array(image_rgb), cv2.COLOR_RGB2BGR)
-
-            # Список для хранения найденных грузовиков
-            found_trucks = []
-
             # Обрабатываем результаты (предполагаем, что обрабатываем одно изображение)
-            for result in results:
-                # Проверяем, есть ли обнаруженные объекты
-                if result.boxes is not None:
-                    # Получаем bounding boxes, confidence scores и class IDs
-                    boxes = result.boxes.xyxy.cpu().numpy()
-                    confidences = result.boxes.conf.cpu().numpy()
-                    class_ids = result.boxes.cls.cpu().numpy().astype(int)
-
-                    # Получаем имена классов из модели
-                    class_names = result.names
-
-                    for box, conf, class_id in zip(boxes, confidences, class_ids):
-                        class_name = class_names[class_id]
-
-                        # Проверяем, является ли объект грузовиком
-                        # В COCO dataset (на котором обучена YOLO) класс 'truck' имеет id 7.
-                        # Также можно искать по имени: 'truck', 'car', 'bus' и т.д.
-                        # if class_name.lower() in ['truck', 'lorry', 'car', 'bus']:  # Можно расширить список
-                        if class_name.lower() in ['truck', 'lorry',]:  # Можно расширить список
-                        # if class_name.lower() in ['bus']:  # Можно расширить список
-                        # if class_id == 7: # Альтернативный вариант: проверка по ID класса 'truck' в COCO
-                            label = f"{class_name} {conf:.2f}"
-
-                            # Рисуем bounding box и label на изображении
-                            x1, y1, x2, y2 = map(int, box)
-                            # cv2.rectangle(image_cv, (x1, y1), (x2, y2), (0, 255, 0), 2) #--------- зелен
-                            cv2.rectangle(image_cv, (x1, y1), (x2, y2), (0, 0, 255), 5)
-                            cv2.putText(image_cv, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 5)
-
-                            found_trucks.append({
-                                "class": class_name,
-                                "confidence": float(conf),
-                                "bbox": [int(x1), int(y1), int(x2), int(y2)]
-                            })
-
-            # Конвертируем обратно в RGB для отображения через matplotlib
-            image_with_boxes = cv2.cvtColor(image_cv, cv2.COLOR_BGR2RGB)
-            return found_trucks, image_with_boxes
+            return self._detect_sources([image_path], conf_threshold, render, [roi], imgsz)[0]
 
         except Exception as e:
             logger.error(f"Ошибка при детекции {image_path}: {e}")
             raise
 
+    def detect_trucks_batch(self, paths_or_arrays, conf_threshold=0.8, batch_size=DEFAULT_BATCH_SIZE,
+                            render=True, rois=None, imgsz=None):
+        """
+        Пакетное обнаружение грузовиков на нескольких изображениях.
+
+        Изображения подаются в модель пачками по batch_size штук, что заметно
+        быстрее, чем отдельный вызов model.predict на каждый файл.
+
+        Args:
+            paths_or_arrays (list): Пути к файлам или изображения numpy (BGR, как cv2.imread).
+            conf_threshold (float): Порог уверенности (от 0.0 до 1.0).
+            batch_size (int): Количество изображений в одном вызове model.predict.
+            render (bool): Готовить ли изображения с рамками (см. detect_truck).
+            rois (list): Область интереса для каждого изображения (None - весь кадр), см. detect_truck.
+            imgsz (int): Размер входа модели для всей пачки (None - self.imgsz).
+
+        Returns:
+            list: DetectionResult для каждого входного изображения в том же порядке, что и на входе.
+        """
+        sources = list(paths_or_arrays)
+        rois = list(rois) if rois is not None else [None] * len(sources)
+        if len(rois) != len(sources):
+            raise ValueError(f"Количество ROI ({len(rois)}) не совпадает с количеством изображений ({len(sources)})")
+
+        batch_size = max(1, int(batch_size))
+        logger.info(f"Начало пакетной детекции: {len(sources)} изображений, пачка: {batch_size}, "
+                    f"порог: {conf_threshold}")
+
+        detections = []
+        for start in range(0, len(sources), batch_size):
+            chunk = sources[start:start + batch_size]
+            try:
+                detections.extend(self._detect_sources(chunk, conf_threshold, render,
+                                                       rois[start:start + batch_size], imgsz))
+            except Exception as e:
+                logger.error(f"Ошибка при пакетной детекции (изображения {start}-{start + len(chunk) - 1}): {e}")
+                raise
+
+        return detections
+
+    def _cache_signature(self, conf_threshold, imgsz=None):
+        """Подпись настроек детектора, влияющих на результат, - часть ключа кэша."""
+        parts = [self.backend, self.precision, self.model_path, f'conf={conf_threshold:.4f}',
+                 'classes=' + ','.join(self.target_classes), f'scale={self.decode_scale}',
+                 f'imgsz={imgsz or self.imgsz}']
+        if self.screen_model is not None:
+            parts += [self.screen_model_path, self.cascade_policy, f'band={self.uncertain_band}']
+        return '|'.join(parts)
+
+    def _detect_sources(self, sources, conf_threshold, render, rois, imgsz=None):
+        """
+        Детекция на пачке источников: сначала кэш, затем декодирование и inference.
+
+        Args:
+            sources (list): Пути к файлам или изображения numpy (BGR).
+            conf_threshold (float): Порог уверенности.
+            render (bool): Сохранять ли в результатах источник для отрисовки.
+            rois (list): Область интереса для каждого источника (None - весь кадр).
+            imgsz (int): Размер входа модели (None - self.imgsz).
+
+        Returns:
+            list: DetectionResult для каждого источника в порядке входа.
+        """
+        frames = [self.prepare(source, conf_threshold, roi, render, imgsz) for source, roi in zip(sources, rois)]
+        return self.detect_prepared(frames, conf_threshold, render, imgsz)
+
+    def prepare(self, source, conf_threshold, roi=None, render=True, imgsz=None):
+        """
+        Готовит источник к детекции: чтение файла, поиск в кэше и декодирование.
+
+        Модель здесь не используется, поэтому метод можно вызывать из потоков-загрузчиков
+        параллельно с inference. Файл читается с диска один раз: по этим же байтам
+        считается хэш для кэша, и из них же декодируется буфер для модели и отрисовки.
+
+        Args:
+            source (str | numpy.ndarray): Путь к файлу или изображение BGR.
+            conf_threshold (float): Порог уверенности (входит в ключ кэша).
+            roi (tuple | list): Область интереса (None - весь кадр).
+            render (bool): Сохранять ли источник для отрисовки.
+            imgsz (int): Размер входа модели (None - self.imgsz).
+
+        Returns:
+            _Frame: Кадр для detect_prepared (с теми же conf_threshold и imgsz). При попадании
+                    в кэш frame.cached содержит готовый результат, и кадр не декодируется.
+        """
+        data = source if isinstance(source, np.ndarray) else np.fromfile(source, dtype=np.uint8)
+
+        key = None
+        if self.cache is not None:
+            key, cached = self.cached_result(source, conf_threshold, roi, render, data, imgsz)
+            if cached is not None:
+                frame = _Frame(source, None)
+                frame.cached = cached
+                return frame
+
+        if isinstance(source, np.ndarray):
+            image = source
+        else:
+            # Декодируем файл один раз - этот же буфер идет и в модель, и под отрисовку
+            image = decode_image(data, self.decode_scale, source)
+        frame = _Frame(source, image, roi)
+        frame.cache_key = key
+        return frame
+
+    def detect_prepared(self, frames, conf_threshold, render=True, imgsz=None):
+        """
+        Детекция на кадрах, подготовленных prepare.
+
+        Args:
+            frames (list): Кадры _Frame.
+            conf_threshold (float): Порог уверенности (тот же, что в prepare).
+            render (bool): Сохранять ли в результатах источник для отрисовки.
+            imgsz (int): Размер входа модели (тот же, что в prepare; None - self.imgsz).
+
+        Returns:
+            list: DetectionResult для каждого кадра в порядке входа.
+        """
+        detections = [frame.cached for frame in frames]
+        pending = [index for index, frame in enumerate(frames) if frame.cached is None]
+
+        if pending:
+            results = self._detect_images([frames[index] for index in pending], conf_threshold, render, imgsz)
+            for index, detection in zip(pending, results):
+                detections[index] = detection
+                if self.cache is not None and frames[index].cache_key is not None:
+                    self.cache.put(frames[index].cache_key, detection)
+
+        if self.cache is not None and len(pending) < len(frames):
+            logger.debug(f"Кэш детекций: {len(frames) - len(pending)} из {len(frames)} кадров взяты из кэша")
+        return detections
+
+    def cached_result(self, source, conf_threshold, roi=None, render=True, data=None, imgsz=None):
+        """
+        Ищет результат для источника в кэше детекций.
+
+        Args:
+            source (str | numpy.ndarray): Путь к файлу или изображение BGR.
+            conf_threshold (float): Порог уверенности.
+            roi (tuple | list): Область интереса (входит в ключ).
+            render (bool): Сохранить ли источник для ленивой отрисовки.
+            data (numpy.ndarray): Уже прочитанные байты файла (чтобы не читать его повторно).
+            imgsz (int): Размер входа модели (входит в ключ; None - self.imgsz).
+
+        Returns:
+            tuple: Ключ кэша (для cache.put) и DetectionResult или None при промахе.
+        """
+        if data is None:
+            data = source if isinstance(source, np.ndarray) else np.fromfile(source, dtype=np.uint8)
+
+        signature = self._cache_signature(conf_threshold, imgsz)
+        if roi is not None:
+            signature = f'{signature}|roi={roi}'
+        key = self.cache.make_key(self.cache.content_digest(data), signature)
+
+        cached = self.cache.get(key)
+        if cached is None:
+            return key, None
+        # Кадр для отрисовки декодируется лениво, только если к нему обратятся
+        return key, DetectionResult(*cached, source=source if render else None)
+
+    @staticmethod
+    def _predict(model, images, conf_threshold, class_ids, imgsz=DEFAULT_IMGSZ):
+        """Один вызов model.predict на пачку уже декодированных изображений."""
+        return model.predict(source=images, conf=conf_threshold, classes=class_ids.tolist(), imgsz=imgsz,
+                             save=False, verbose=False, batch=len(images))
+
+    def _detect_images(self, frames, conf_threshold, render, imgsz=None):
+        """
+        Детекция на пачке декодированных кадров (с каскадом, если он настроен).
+
+        Args:
+            frames (list): Кадры _Frame (источник, буфер BGR, вход модели с учетом ROI).
+            conf_threshold (float): Порог уверенности.
+            render (bool): Сохранять ли в результатах источник для отрисовки.
+            imgsz (int): Размер входа модели (None - self.imgsz).
+
+        Returns:
+            list: DetectionResult для каждого кадра в порядке входа.
+        """
+        imgsz = imgsz or self.imgsz
+        self.stats['frames'] += len(frames)
+
+        if self.screen_model is None:
+            results = self._predict(self.model, [frame.input for frame in frames], conf_threshold,
+                                    self.class_ids, imgsz)
+            return [
+                self._make_result(frame, result, conf_threshold, render, self.class_ids)
+                for frame, result in zip(frames, results)
+            ]
+
+        # Быстрая модель смотрит все кадры с нижним порогом полосы неуверенности
+        screen_conf = min(conf_threshold, self.uncertain_band[0])
+        screen_results = self._predict(self.screen_model, [frame.input for frame in frames],
+                                       screen_conf, self.screen_class_ids, imgsz)
+
+        detections = [None] * len(frames)
+        escalate = []
+        for index, result in enumerate(screen_results):
+            _, confidences, _ = self._filter_boxes(result, screen_conf, class_ids=self.screen_class_ids)
+            if self._needs_escalation(confidences):
+                escalate.append(index)
+            else:
+                detections[index] = self._make_result(frames[index], result, conf_threshold, render,
+                                                      self.screen_class_ids)
+
+        if escalate:
+            # Дорогая модель - только для спорных кадров
+            results = self._predict(self.model, [frames[index].input for index in escalate],
+                                    conf_threshold, self.class_ids, imgsz)
+            for index, result in zip(escalate, results):
+                detections[index] = self._make_result(frames[index], result, conf_threshold, render,
+                                                      self.class_ids)
+
+        self.stats['escalated'] += len(escalate)
+        logger.debug(f"Каскад: {len(escalate)} из {len(frames)} кадров переданы в {self.model_path}")
+        return detections
+
+    def _needs_escalation(self, confidences):
+        """Нужно ли перепроверить кадр дорогой моделью по уверенности кандидатов быстрой модели."""
+        if not confidences.size:
+            # Кандидатов нет - кадр пустой, дорогая модель не нужна
+            return False
+        if self.cascade_policy == 'any':
+            return True
+        # 'uncertain': перепроверяем, если хоть один кандидат ниже верхней границы полосы
+        return bool((confidences < self.uncertain_band[1]).any())
+
+    def _make_result(self, frame, result, conf_threshold, render, class_ids):
+        """
+        Собирает DetectionResult по результату YOLO для одного кадра.
+
+        Args:
+            frame (_Frame): Кадр, поданный в модель.
+            result (ultralytics.engine.results.Results): Результат для этого кадра.
+            conf_threshold (float): Порог уверенности.
+            render (bool): Сохранять ли в результате источник для отрисовки.
+            class_ids (numpy.ndarray): ID искомых классов модели, давшей результат.
+        """
+        source = frame.source
+        if isinstance(source, np.ndarray):
+            scale = 1
+            # Исходный массив принадлежит вызывающему коду - при отрисовке будет сделана копия
+            render_image = None
+        elif self.decode_scale == 1:
+            scale = 1
+            # Буфер декодирован нами и в модель уже ушел - рисовать можно прямо в нем
+            render_image = frame.image
+        else:
+            # Inference шел по уменьшенному кадру - для отрисовки понадобится полный размер
+            scale = self.decode_scale
+            render_image = None
+
+        boxes, confidences, class_ids = self._filter_boxes(result, conf_threshold, scale, class_ids, frame.offset)
+        if not render:
+            source = render_image = None
+        return DetectionResult(boxes, confidences, class_ids, result.names, source=source, image=render_image)
+
+    @staticmethod
+    def _filter_boxes(result, conf_threshold, scale=1, class_ids=None, offset=(0, 0)):
+        """
+        Отбирает объекты искомых классов из результата YOLO масками numpy.
+
+        Args:
+            result (ultralytics.engine.results.Results): Результат для одного изображения.
+            conf_threshold (float): Порог уверенности.
+            scale (int): Во сколько раз кадр для inference меньше исходного.
+            class_ids (numpy.ndarray): ID искомых классов (None - без фильтра по классу).
+            offset (tuple): Смещение (x, y) вырезанной области ROI в кадре для inference.
+
+        Returns:
+            tuple: boxes (N, 4) int32 в пикселях исходного кадра, confidences (N,) float32,
+                   class_ids (N,) int32.
+        """
+        if result.boxes is None or len(result.boxes) == 0:
+            return np.empty((0, 4), dtype=np.int32), np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int32)
+
+        # Получаем bounding boxes, confidence scores и class IDs
+        boxes = result.boxes.xyxy.cpu().numpy()
+        confidences = result.boxes.conf.cpu().numpy().astype(np.float32)
+        result_class_ids = result.boxes.cls.cpu().numpy().astype(np.int32)
+
+        # Модель уже получила classes=..., маска страхует от весов/бэкендов, где фильтр не применился
+        mask = confidences >= conf_threshold
+        if class_ids is not None:
+            mask &= np.isin(result_class_ids, class_ids)
+
+        # Из координат области ROI - в координаты всего кадра
+        boxes = (boxes[mask] + np.array([offset[0], offset[1], offset[0], offset[1]], dtype=np.float32)) * scale
+        return boxes.astype(np.int32), confidences[mask], result_class_ids[mask]
+
     def show_result(self, image_with_boxes):
         """Показывает результат с помощью matplotlib."""
         try:
@@ -105,43 +673,49 @@ class TruckDetector:
         except Exception as e:
             logger.error(f"Ошибка при отображении результата: {e}")
 
-def load_file_jpg():
-    '''Сбор в список файлов jpg из folder_path'''
+def load_file_jpg(folder_path='/home/adm_1/foto_catcher/fc_media', index=None):
+    '''Имена файлов jpg из folder_path - по одному, из индекса каталога (см. media_index.MediaIndex)'''
+    from media_index import MediaIndex
 
     # folder_path = 'c:/Users/TurchinMV/Downloads/truck_foto'
-    folder_path = '/home/adm_1/foto_catcher/fc_media'
-    logger.info(f"Сканирование директории: {folder_path}")
-
-    jpg_files = []
     try:
-        with os.scandir(folder_path) as entries:
-            for entry in entries:
-                if entry.is_file() and entry.name.lower().endswith('.jpg'):
-                    jpg_files.append(entry.name)
-        logger.info(f"Найдено {len(jpg_files)} JPG файлов")
+        if index is None:
+            logger.info(f"Сканирование директории: {folder_path}")
+            index = MediaIndex(folder_path, extensions=('.jpg',))
+        logger.info(f"Найдено {len(index)} JPG файлов")
     except Exception as e:
         logger.error(f"Ошибка при сканировании директории: {e}")
+        return
 
-    return jpg_files
+    for name in index:
+        if name.lower().endswith('.jpg'):
+            yield name
 
 # Пример использования
 if __name__ == "__main__":
+    from itertools import islice
+
     # Инициализация логирования
     # Только при прямом запуске модуля настраиваем логирование
     from logging_config import setup_logging
     setup_logging()
 
     detector = TruckDetector()
-    file_list = load_file_jpg()
+    files = load_file_jpg()
 
-    for i_foto in file_list:
-        image_path = f'/home/adm_1/foto_catcher/fc_media/{i_foto}'
-        trucks, annotated_image = detector.detect_truck(image_path, conf_threshold=0.6)
+    # Файлы берутся из индекса пачками, список всех путей не строится
+    while True:
+        file_list = list(islice(files, DEFAULT_BATCH_SIZE))
+        if not file_list:
+            break
 
-        if trucks:
-            logger.info(f"Файл {i_foto}: найдено {len(trucks)} грузовиков/машин")
-            for i, truck in enumerate(trucks, 1):
-                logger.info(f"Объект {i}: {truck['class']} (уверенность: {truck['confidence']:.2f})")
-        else:
-            logger.info(f"Файл {i_foto}: грузовики не обнаружены")
+        image_paths = [f'/home/adm_1/foto_catcher/fc_media/{i_foto}' for i_foto in file_list]
+        detections = detector.detect_trucks_batch(image_paths, conf_threshold=0.6, render=False)
 
+        for i_foto, detection in zip(file_list, detections):
+            if len(detection):
+                logger.info(f"Файл {i_foto}: найдено {len(detection)} грузовиков/машин")
+                for i, (class_name, conf) in enumerate(zip(detection.class_names, detection.confidences), 1):
+                    logger.info(f"Объект {i}: {class_name} (уверенность: {conf:.2f})")
+            else:
+                logger.info(f"Файл {i_foto}: грузовики не обнаружены")
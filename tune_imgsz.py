@@ -0,0 +1,155 @@
+import argparse
+import json
+import logging
+import sys
+import time
+
+import psycopg2
+
+import config
+from logging_config import setup_logging
+from media_index import MediaIndex
+from truck_detector import TruckDetector
+from detection_metrics import compare_detections
+
+''' Подбор размера входа модели (imgsz) для ловушки по истории ее кадров '''
+
+logger = logging.getLogger('tune_imgsz')
+
+DEFAULT_SIZES = (320, 416, 512, 640, 768, 960)
+
+
+def trap_history(imei, media_dir='./fc_media', limit=200):
+    """
+    Последние кадры ловушки из fotos_data, найденные на диске.
+
+    Args:
+        imei (str): ID ловушки.
+        media_dir (str | MediaIndex): Каталог с кадрами или готовый индекс.
+        limit (int): Сколько последних кадров взять.
+
+    Returns:
+        list: Пути к файлам (от новых к старым).
+    """
+    conn = psycopg2.connect(**config.DB_CONFIG)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT filename FROM fotos_data WHERE imei = %s ORDER BY date DESC, time_accident DESC LIMIT %s",
+                (imei, limit)
+            )
+            filenames = [row[0] for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+    # Имена в БД и на диске могут отличаться регистром
+    index = media_dir if isinstance(media_dir, MediaIndex) else MediaIndex(media_dir)
+    paths = [path for path in map(index.find, filenames) if path is not None]
+    if len(paths) < len(filenames):
+        logger.warning(f"⚠️ {len(filenames) - len(paths)} из {len(filenames)} кадров ловушки {imei} нет на диске")
+    return paths
+
+
+def tune_trap(detector, image_paths, sizes=DEFAULT_SIZES, reference_size=None, roi=None,
+              conf_threshold=0.6, min_agreement=0.99, min_recall=0.95):
+    """
+    Прогоняет историю ловушки на нескольких размерах входа и выбирает наименьший подходящий.
+
+    Эталон - детекции на reference_size (по умолчанию наибольший из sizes). Размер подходит,
+    если решение "есть грузовик / нет" совпадает с эталоном не реже min_agreement кадров
+    и найдено не меньше min_recall эталонных рамок.
+
+    Args:
+        detector (TruckDetector): Детектор (кэш детекций лучше отключить - иначе замер времени неверен).
+        image_paths (list): Кадры ловушки.
+        sizes (tuple): Проверяемые размеры (кратны 32).
+        reference_size (int): Эталонный размер.
+        roi (tuple | list): Область интереса ловушки.
+        conf_threshold (float): Порог уверенности.
+        min_agreement (float): Минимальная доля кадров с тем же решением, что у эталона.
+        min_recall (float): Минимальная доля найденных эталонных рамок.
+
+    Returns:
+        dict: Выбранный размер (эталонный, если меньшие не подошли) и отчет по каждому размеру.
+    """
+    reference_size = reference_size or max(sizes)
+    rois = [roi] * len(image_paths)
+
+    def run(imgsz):
+        started = time.perf_counter()
+        detections = detector.detect_trucks_batch(image_paths, conf_threshold=conf_threshold, render=False,
+                                                  rois=rois, imgsz=imgsz)
+        return detections, (time.perf_counter() - started) / len(image_paths) * 1000
+
+    reference, reference_ms = run(reference_size)
+    report = {reference_size: {'ms_per_frame': round(reference_ms, 2), 'agreement': 1.0, 'recall': 1.0}}
+
+    chosen = None
+    for imgsz in sorted(size for size in sizes if size != reference_size):
+        detections, ms_per_frame = run(imgsz)
+        agree = matched = expected = 0
+        for ref, cand in zip(reference, detections):
+            agree += ref.has_class('truck') == cand.has_class('truck')
+            result = compare_detections(ref, cand, iou_threshold=0.5)
+            matched += result['matched']
+            expected += result['matched'] + result['missed']
+
+        item = {
+            'ms_per_frame': round(ms_per_frame, 2),
+            'agreement': round(agree / len(image_paths), 4),
+            'recall': round(matched / expected, 4) if expected else 1.0,
+        }
+        item['ok'] = item['agreement'] >= min_agreement and item['recall'] >= min_recall
+        report[imgsz] = item
+        logger.info(f"imgsz={imgsz}: {item}")
+        if item['ok'] and chosen is None and imgsz < reference_size:
+            chosen = imgsz
+
+    return {'imgsz': chosen or reference_size, 'reference_size': reference_size, 'frames': len(image_paths),
+            'sizes': report}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Подбор imgsz для ловушек по истории кадров')
+    parser.add_argument('imei', nargs='+', help='ID ловушек (IMEI)')
+    parser.add_argument('--media', default='./fc_media', help='Каталог с кадрами')
+    parser.add_argument('--limit', type=int, default=200, help='Сколько последних кадров ловушки взять')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES))
+    parser.add_argument('--reference', type=int, help='Эталонный imgsz (по умолчанию наибольший)')
+    parser.add_argument('--model', default='yolov8l.pt')
+    parser.add_argument('--backend', default=getattr(config, 'DETECT_BACKEND', 'torch'),
+                        choices=['torch', 'onnxruntime', 'openvino'])
+    parser.add_argument('--min-agreement', type=float, default=0.99)
+    parser.add_argument('--min-recall', type=float, default=0.95)
+    parser.add_argument('--output', help='Сохранить отчет в JSON')
+    args = parser.parse_args()
+
+    setup_logging()
+    detector = TruckDetector(args.model, backend=args.backend,
+                             target_classes=getattr(config, 'TARGET_CLASSES', ('truck', 'lorry')))
+    trap_roi = getattr(config, 'TRAP_ROI', {})
+
+    media_index = MediaIndex(args.media)
+    report, suggested = {}, {}
+    for imei in args.imei:
+        image_paths = trap_history(imei, media_index, args.limit)
+        if not image_paths:
+            logger.error(f"❌ Нет кадров ловушки {imei}")
+            continue
+        logger.info(f"▶️ Ловушка {imei}: {len(image_paths)} кадров, размеры {args.sizes}")
+        report[imei] = tune_trap(detector, image_paths, args.sizes, args.reference, trap_roi.get(imei),
+                                 min_agreement=args.min_agreement, min_recall=args.min_recall)
+        suggested[imei] = report[imei]['imgsz']
+        logger.info(f"✅ Ловушка {imei}: imgsz={suggested[imei]}")
+
+    if not report:
+        sys.exit(2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    # Готовая строка для config.py
+    print(f"TRAP_IMGSZ = {json.dumps(suggested, indent=4)}")
+
+
+if __name__ == '__main__':
+    main()